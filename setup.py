@@ -24,4 +24,10 @@ setup(name='siyavula.latex2image',
       include_package_data=True,
       zip_safe=False,
       install_requires=requires,
+      entry_points={
+          'console_scripts': [
+              'latex2image = siyavula.latex2image.cli:main',
+              'latex2image-daemon = siyavula.latex2image.daemon:main',
+          ],
+      },
       )
@@ -0,0 +1,61 @@
+"""
+Render without blocking the caller, for services that render equations on demand.
+
+An AsyncRenderer runs at most concurrency renders at a time on a pool of threads and
+returns a multiprocessing AsyncResult for every request, which can be waited for with a
+timeout or passed to a callback. The renders use the same cache and image names as
+run_latex and replace_latex_with_images, so images rendered either way are shared, and
+they run on the backend of the process.
+"""
+from multiprocessing.pool import ThreadPool
+
+from imageutils import (EQUATION_DPI, LATEX_TIMEOUT, equation_hash, replace_latex_with_images,
+                        run_latex)
+from utils import unicode_replacements
+
+
+class AsyncRenderer(object):
+    """Render equations and documents into cache_path on a pool of threads."""
+
+    def __init__(self, cache_path, concurrency=4, timeout=LATEX_TIMEOUT):
+        self.cache_path = cache_path
+        self.timeout = timeout
+        self.pool = ThreadPool(concurrency)
+
+    def render_equation(self, latex, dpi=EQUATION_DPI, output_format='png', timeout=None,
+                        callback=None):
+        """
+        Render the equation latex, as found in an equation element, at dpi, by default the
+        resolution of the 1x images of replace_latex_with_images.
+
+        Returns an AsyncResult of the cache path of the image, or None if the equation
+        failed to render. callback is called with the path when the render is done. The
+        latex and convert processes are killed after timeout seconds.
+        """
+        if isinstance(latex, unicode):
+            latex = latex.encode('utf-8')
+        latex = unicode_replacements(latex.strip())
+        codehash = equation_hash(latex, dpi, output_format)
+        return self.pool.apply_async(
+            run_latex, ('equation', codehash, latex, self.cache_path),
+            {'dpi': dpi, 'timeout': timeout or self.timeout, 'output_format': output_format},
+            callback=callback)
+
+    def replace_latex_with_images(self, xml_dom, class_to_replace, image_path, timeout=None,
+                                  callback=None, **kwargs):
+        """
+        Run replace_latex_with_images on xml_dom.
+
+        Returns an AsyncResult of xml_dom. The equations of the document are rendered one
+        after the other, so that a document takes a single place in the pool. The other
+        keyword arguments are those of replace_latex_with_images.
+        """
+        kwargs['timeout'] = timeout or self.timeout
+        return self.pool.apply_async(
+            replace_latex_with_images, (xml_dom, class_to_replace, self.cache_path, image_path),
+            kwargs, callback=callback)
+
+    def close(self):
+        """Wait for the renders that were requested and stop the threads."""
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,174 @@
+"""
+Atlases of the equation images of a page, one PNG per pixel density.
+
+A page with many small inline equations would otherwise load an image per equation and
+density. The images of the equations that are at most ATLAS_MAX_WIDTH by ATLAS_MAX_HEIGHT
+pixels are packed onto the shelves of an atlas ATLAS_WIDTH pixels wide instead, and every
+equation shows its region of the atlas as the background of an inline block. The layout
+is made in CSS pixels, the pixels of an image divided by its density, and the atlas of
+every density holds the images at the same positions times the density.
+
+The atlases and their layout are cached under the hash of the images they hold, so pages
+with the same equations share them. Building an atlas needs Pillow, without it the
+equations keep their own images.
+"""
+import hashlib
+import json
+import math
+import os
+import tempfile
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from metrics import timed
+from postprocess import active_steps, postprocess_png
+
+# the width of an atlas and the largest image packed into it, in CSS pixels
+ATLAS_WIDTH = 1024
+ATLAS_MAX_WIDTH = 256
+ATLAS_MAX_HEIGHT = 64
+
+# the space around every image, so that scaled neighbours do not show at the edges
+ATLAS_GAP = 1
+
+# the fewest images worth an atlas
+ATLAS_MIN_IMAGES = 2
+
+
+def atlas_key(members, densities):
+    """Return the hash naming the atlases of members, lists of codehashes per density."""
+    key = ';'.join([','.join('%g' % density for density in densities)] +
+                   sorted(','.join(codehashes) for codehashes in members))
+    return hashlib.md5('atlas;' + key).hexdigest()
+
+
+def atlas_name(key, density):
+    """Return the cache name of the atlas of key at density."""
+    return '%s-%gx.png' % (key, density)
+
+
+def pack(sizes, width=ATLAS_WIDTH):
+    """
+    Pack boxes of sizes onto shelves, the tallest first.
+
+    Returns the (x, y) position of every box and the size of the atlas.
+    """
+    positions = [None] * len(sizes)
+    x = y = shelf_height = atlas_width = 0
+    for index in sorted(range(len(sizes)), key=lambda index: (-sizes[index][1], index)):
+        box_width, box_height = sizes[index]
+        if x and x + box_width > width:
+            x = 0
+            y += shelf_height
+            shelf_height = 0
+        positions[index] = (x, y)
+        x += box_width
+        atlas_width = max(atlas_width, x)
+        shelf_height = max(shelf_height, box_height)
+    return positions, (atlas_width, y + shelf_height)
+
+
+def page_atlas(cache, fingerprint, members, densities):
+    """
+    Return the layout of the atlases of the images of members, building them if needed.
+
+    members is a list with the cached codehashes of every distinct equation at every
+    density. The layout is a dictionary with the atlas key, its size and the region
+    (x, y, width, height) of every equation in the atlas, under its first codehash.
+    Equations that are missing or too large for the atlas have no region.
+    """
+    key = atlas_key(members, densities)
+    layout_path = cache.lookup(key + '.json', fingerprint)
+    if layout_path:
+        with open(layout_path) as fp:
+            layout = json.load(fp)
+        if not layout['regions'] or all(cache.lookup(atlas_name(key, density), fingerprint)
+                                        for density in densities):
+            return layout
+    if Image is None:
+        return {'key': key, 'size': [0, 0], 'regions': {}}
+
+    with timed('atlas'):
+        layout, atlases = _build(cache, fingerprint, members, densities, key)
+        for density, atlas in zip(densities, atlases):
+            fd, path = tempfile.mkstemp(suffix='.png')
+            os.close(fd)
+            atlas.save(path)
+            # trimming would move the images
+            postprocess_png(path, [step for step in active_steps() if step != 'trim'])
+            cache.store(path, atlas_name(key, density), fingerprint, move=True)
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(layout, fp, sort_keys=True)
+        cache.store(path, key + '.json', fingerprint, move=True)
+    return layout
+
+
+def _build(cache, fingerprint, members, densities, key):
+    """Return the layout of page_atlas and the atlas images of the densities."""
+    opened = []
+    try:
+        entries = []
+        for codehashes in members:
+            paths = [cache.lookup(codehash + '.png', fingerprint) for codehash in codehashes]
+            if not all(paths):
+                continue
+            try:
+                images = []
+                for path in paths:
+                    images.append(Image.open(path))
+                    opened.append(images[-1])
+            except IOError:
+                continue
+            # the size in CSS pixels, at which the first image is shown
+            size = [int(math.ceil(length / float(densities[0]))) for length in images[0].size]
+            if size[0] > ATLAS_MAX_WIDTH or size[1] > ATLAS_MAX_HEIGHT:
+                continue
+            # the slot holds the image at every density
+            slot = [max(int(math.ceil(image.size[axis] / float(density)))
+                        for image, density in zip(images, densities)) + 2 * ATLAS_GAP
+                    for axis in (0, 1)]
+            entries.append((codehashes[0], images, size, slot))
+        if len(entries) < ATLAS_MIN_IMAGES:
+            entries = []
+
+        positions, atlas_size = pack([slot for _, _, _, slot in entries])
+        layout = {'key': key, 'size': list(atlas_size), 'regions': {}}
+        atlases = [Image.new('RGBA', (int(math.ceil(atlas_size[0] * density)),
+                                      int(math.ceil(atlas_size[1] * density))))
+                   for density in densities]
+        for (codehash, images, size, _), (x, y) in zip(entries, positions):
+            x += ATLAS_GAP
+            y += ATLAS_GAP
+            layout['regions'][codehash] = [x, y] + size
+            for atlas, image, density in zip(atlases, images, densities):
+                atlas.paste(image.convert('RGBA'), (int(round(x * density)),
+                                                    int(round(y * density))))
+    finally:
+        for image in opened:
+            image.close()
+    return layout, (atlases if entries else [])
+
+
+def atlas_style(layout, codehash, image_path, densities):
+    """
+    Return the CSS of an inline block showing the region of codehash in the atlas.
+
+    The region and the size of the atlas are in CSS pixels, so the atlas of every density
+    is scaled to the same background size.
+    """
+    x, y, width, height = layout['regions'][codehash]
+    urls = ['{}/{}'.format(image_path, atlas_name(layout['key'], density))
+            for density in densities]
+    style = ('display:inline-block;width:{}px;height:{}px;'
+             'background:url({}) -{}px -{}px/{}px {}px no-repeat').format(
+                 width, height, urls[0], x, y, layout['size'][0], layout['size'][1])
+    if len(densities) > 1:
+        image_set = ', '.join('url({}) {:g}x'.format(url, density)
+                              for url, density in zip(urls, densities))
+        style += (';background-image:-webkit-image-set({0})'
+                  ';background-image:image-set({0})').format(image_set)
+    return style
@@ -0,0 +1,245 @@
+"""
+Backends that run the latex and image conversion commands.
+
+Every backend has the exec_run interface of a docker container, so latex2png can be given
+either. The backend for the process is chosen once by get_backend, from the
+LATEX2IMAGE_BACKEND environment variable: docker (the default), local or worker.
+"""
+import json
+import logging
+import os
+import Queue
+import subprocess
+import sys
+import threading
+
+import docker
+
+log = logging.getLogger(__name__)
+
+# the status of commands lost with the worker that ran them, which no process exits with
+WORKER_DIED_STATUS = 256
+
+# The worker reads one JSON encoded command per line from stdin and writes the JSON encoded
+# exit status and output of the command to stdout. It only uses the standard library so
+# that it can run inside the latex container without this package installed.
+WORKER_SCRIPT = '''
+import json
+import subprocess
+import sys
+
+for line in iter(sys.stdin.readline, ''):
+    try:
+        p = subprocess.Popen(json.loads(line), stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        output = p.communicate()[0].decode('utf-8', 'replace')
+        result = [p.returncode, output]
+    except OSError as error:
+        result = [127, str(error)]
+    sys.stdout.write(json.dumps(result) + '\\n')
+    sys.stdout.flush()
+'''
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def execute(args, cwd=None, shell=False, env=None, status=False):
+    """
+    Run a command and return its stdout and stderr.
+
+    If status is True the exit status of the command is returned before the output.
+    """
+    p = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         shell=shell, env=env)
+    stdout, stderr = p.communicate()
+    if status:
+        return p.returncode, stdout, stderr
+    return stdout, stderr
+
+
+def find_pdflatex():
+    """Return the path of pdflatex, looking in LATEX_PATH or PATH, or None."""
+    path = os.environ.get('LATEX_PATH', os.environ.get('PATH'))
+    texpath = [p for p in path.split(':') if 'tex' in p]
+    if texpath:
+        return texpath[0] + '/pdflatex'
+    # no custom latex installed. Try /usr/local/bin and /usr/local
+    for path in ['/usr/local/bin/', '/usr/bin/']:
+        texpath = os.path.join(path, 'pdflatex')
+        if os.path.exists(texpath):
+            return texpath
+    return None
+
+
+class Backend(object):
+    """Base class of the backends."""
+
+    name = None
+    # whether the commands run on this machine and see all of its files, including tmpfs
+    local = False
+
+    def exec_run(self, command, stdout=True, stderr=True):
+        """Run command and return a tuple of its exit status and output."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release the resources held by the backend."""
+        pass
+
+
+class LocalBackend(Backend):
+    """Run the commands in local subprocesses."""
+
+    name = 'local'
+    local = True
+
+    def __init__(self, pdflatexpath=None):
+        if pdflatexpath is None:
+            pdflatexpath = find_pdflatex()
+        self.env = None
+        if pdflatexpath is not None:
+            # put the directory holding pdflatex first, for latex, dvips etc. as well
+            self.env = dict(os.environ)
+            self.env['PATH'] = os.path.dirname(pdflatexpath) + ':' + self.env.get('PATH', '')
+
+    def exec_run(self, command, stdout=True, stderr=True):
+        try:
+            exit_code, out, err = execute(command, env=self.env, status=True)
+        except OSError as error:
+            return 127, str(error)
+        return exit_code, (out if stdout else '') + (err if stderr else '')
+
+
+class DockerBackend(Backend):
+    """
+    Run the commands in the latex docker container.
+
+    The container is looked up when the first command runs, so that a render served from
+    the cache never connects to docker.
+    """
+
+    name = 'docker'
+
+    def __init__(self, container_name='latex'):
+        self.container_name = container_name
+        self.client = None
+        self.container = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        with self.lock:
+            if self.container is None:
+                self.client = docker.from_env()
+                self.container = self.client.containers.get(self.container_name)
+            return self.container
+
+    def exec_run(self, command, stdout=True, stderr=True):
+        return self._connect().exec_run(command, stdout=stdout, stderr=stderr)
+
+    def close(self):
+        with self.lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+                self.container = None
+
+
+class WorkerBackend(Backend):
+    """
+    Run the commands in long-lived worker processes that read them from a pipe.
+
+    A worker is started with worker_command followed by the worker script, e.g.
+    ['docker', 'exec', '-i', 'latex', 'python', '-c'] to run it in the latex container.
+    Every command checks out an idle worker, or starts a new one if all of them are busy,
+    so there are as many workers as commands that ran at the same time. A worker that
+    dies is replaced, the command it was running then has WORKER_DIED_STATUS.
+    """
+
+    name = 'worker'
+
+    def __init__(self, worker_command=None):
+        if worker_command is None:
+            worker_command = [sys.executable, '-c']
+        self.worker_command = worker_command
+        self.local = worker_command[0] == sys.executable
+        # the workers that are not running a command, the most recently used last
+        self.idle = Queue.LifoQueue()
+
+    def _start(self):
+        return subprocess.Popen(self.worker_command + [WORKER_SCRIPT],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _checkout(self):
+        """Return an idle worker that is still running, or a new one."""
+        while True:
+            try:
+                process = self.idle.get_nowait()
+            except Queue.Empty:
+                return self._start()
+            if process.poll() is None:
+                return process
+            self._stop(process)
+
+    def exec_run(self, command, stdout=True, stderr=True):
+        process = self._checkout()
+        try:
+            process.stdin.write(json.dumps(command) + '\n')
+            process.stdin.flush()
+            line = process.stdout.readline()
+        except IOError:
+            line = ''
+        if not line:
+            log.warning('A render worker died, it will be replaced.')
+            self._stop(process)
+            return WORKER_DIED_STATUS, ''
+        self.idle.put(process)
+        exit_code, output = json.loads(line)
+        return exit_code, output.encode('utf-8') if stdout or stderr else ''
+
+    @staticmethod
+    def _stop(process):
+        try:
+            process.stdin.close()
+        except IOError:
+            pass
+        process.wait()
+
+    def close(self):
+        """Stop the idle workers, the busy ones are stopped by the next close."""
+        while True:
+            try:
+                process = self.idle.get_nowait()
+            except Queue.Empty:
+                return
+            self._stop(process)
+
+
+BACKENDS = {
+    'docker': DockerBackend,
+    'local': LocalBackend,
+    'worker': WorkerBackend,
+}
+
+
+def get_backend():
+    """Return the backend of this process, creating it the first time."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            name = os.environ.get('LATEX2IMAGE_BACKEND', 'docker')
+            try:
+                _backend = BACKENDS[name]()
+            except KeyError:
+                raise ValueError('Unknown LATEX2IMAGE_BACKEND %r, expected one of %s.' % (
+                    name, ', '.join(sorted(BACKENDS))))
+        return _backend
+
+
+def set_backend(backend):
+    """Use backend for every render in this process and return the previous backend."""
+    global _backend
+    with _backend_lock:
+        previous = _backend
+        _backend = backend
+    return previous
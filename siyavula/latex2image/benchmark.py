@@ -0,0 +1,320 @@
+"""
+Benchmark rendering with the equations in test-equations-short.txt.
+
+The corpus is replayed through render_images, one equation at a time to measure the
+latency, and through replace_latex_with_images as one document, first with an empty
+cache and then again with the warm cache. --corpus test-equations.txt replays the full
+corpus. The results, including the time spent in every stage, are printed and can be saved
+as JSON to compare runs:
+
+    python -m siyavula.latex2image.benchmark --backend stub --output before.json
+    python -m siyavula.latex2image.benchmark --backend stub --compare before.json
+
+With --normalise only the text preprocessing of the equations is timed, without rendering.
+The stub backend does not need TeX or docker and measures the Python side only.
+
+--postprocess STEPS renders with the PNG post-processing steps, e.g. trim,quantise,optimise.
+With --images it post-processes copies of the PNG images in a directory instead, such as a
+cache rendered from the corpus, and reports their total size before and after and the
+time per image:
+
+    python -m siyavula.latex2image.benchmark --postprocess trim,quantise,optimise \
+        --images images
+"""
+from __future__ import print_function
+import argparse
+import json
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+from lxml import etree
+
+import backends
+import metrics
+import postprocess
+from equation2png import equation2png
+from imageutils import (EQUATION_DPI, equation_hash, prepare_code, render_images,
+                        replace_latex_with_images)
+from utils import cleanup_code, unescape, unicode_replacements
+
+# the 1x and 2x resolutions used by replace_latex_with_images
+DPIS = (EQUATION_DPI, EQUATION_DPI * 2)
+
+
+class StubBackend(backends.Backend):
+    """
+    Pretend to run the commands by writing placeholder output files.
+
+    Used to benchmark and test the Python side of rendering without TeX or docker, it is
+    not one of the backends of LATEX2IMAGE_BACKEND. Every command takes delay seconds.
+    """
+
+    name = 'stub'
+    local = True
+
+    def __init__(self, delay=0):
+        self.delay = delay
+
+    def exec_run(self, command, stdout=True, stderr=True):
+        if command[0] == 'timeout':
+            command = command[2:]
+        if self.delay:
+            time.sleep(self.delay)
+
+        program = command[0]
+        options = dict(arg.lstrip('-').split('=', 1) for arg in command if '=' in arg)
+        if program == 'pdflatex' and '--version' in command:
+            return 0, 'pdfTeX stub\n'
+        elif program == 'pdflatex' and '-ini' in command:
+            self._write(os.path.join(options['output-directory'], options['jobname'] + '.fmt'))
+        elif program == 'pdflatex':
+            with open(command[-1]) as fp:
+                pages = max(fp.read().count('\\begin{standalone}'), 1)
+            extension = '.dvi' if '-output-format=dvi' in command else '.pdf'
+            self._write(os.path.splitext(command[-1])[0] + extension, pages)
+        elif program == 'dvips':
+            self._write(command[command.index('-o') + 1])
+        elif program == 'ps2pdf':
+            self._write(command[-1])
+        elif program == 'pdfinfo':
+            return 0, 'Pages:          %i\nPage size:      144 x 72 pts\n' % (
+                self._pages(command[-1]))
+        elif program == 'pdfseparate':
+            for page in range(self._pages(command[1])):
+                self._write(command[2] % (page + 1))
+        elif program == 'gs':
+            pdf_path = command[-1]
+            for page in range(self._pages(pdf_path)):
+                self._write(options['sOutputFile'] % (page + 1))
+        elif program == 'mutool':
+            for page in range(self._pages(command[-1])):
+                self._write(command[command.index('-o') + 1] % (page + 1))
+        elif program == 'convert':
+            reads = command.count('-density')
+            pages = self._pages(command[3])
+            if '%d' in command[-1]:
+                for index in range(reads * pages):
+                    self._write(command[-1] % index)
+            else:
+                self._write(command[-1])
+        elif program == 'pdf2svg':
+            self._write(command[-1])
+        elif program == 'dvisvgm':
+            self._write(options['output'])
+        else:
+            return 127, ''
+        return 0, ''
+
+    def _write(self, path, pages=1):
+        with open(path, 'w') as fp:
+            fp.write('stub pages=%i\n' % pages)
+
+    def _pages(self, path):
+        with open(path) as fp:
+            return int(fp.read().strip().split('=')[1])
+
+
+def read_corpus(path, limit=None):
+    """Return the equations in a file of equations separated by ---- lines."""
+    with open(path) as fp:
+        equations = [e.strip() for e in fp.read().split('----') if len(e.strip()) > 0]
+    return equations[:limit] if limit else equations
+
+
+def percentile(values, percent):
+    """Return the percentile of the values, using the nearest rank."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def run_equations(equations, cache_path, backend):
+    """Render the equations one by one and return the latency of every equation."""
+    latencies = []
+    for equation in equations:
+        start = time.time()
+        latex = unicode_replacements(equation)
+        images = [(equation_hash(latex, dpi), dpi) for dpi in DPIS]
+        render_images('equation', latex, cache_path, images, backend=backend)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def run_document(equations, cache_path, workers):
+    """Render the equations as a single document with replace_latex_with_images."""
+    dom = etree.Element('div')
+    for equation in equations:
+        span = etree.SubElement(dom, 'span', {'class': 'latex-math'})
+        span.text = equation.decode('utf-8')
+    replace_latex_with_images(dom, 'latex-math', cache_path, '', workers=workers)
+
+
+def measure(name, function, count):
+    """Run function with fresh stage timings and return its results."""
+    metrics.reset()
+    start = time.time()
+    latencies = function()
+    elapsed = time.time() - start
+    result = {
+        'seconds': elapsed,
+        'equations': count,
+        'throughput': count / elapsed if elapsed else 0.0,
+        'stages': metrics.stage_totals(),
+    }
+    if latencies:
+        result.update({
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+        })
+    return name, result
+
+
+def run_benchmark(equations, backend, workers=None):
+    """Return the results of the cold and warm cache runs of the equations."""
+    previous = backends.set_backend(backend)
+    results = {}
+    try:
+        for mode in ['equations', 'document']:
+            cache_path = tempfile.mkdtemp()
+            try:
+                for cache_state in ['cold', 'warm']:
+                    if mode == 'equations':
+                        function = lambda: run_equations(equations, cache_path, backend)
+                    else:
+                        function = lambda: run_document(equations, cache_path, workers)
+                    name, result = measure('%s-%s' % (mode, cache_state), function,
+                                           len(equations))
+                    results[name] = result
+            finally:
+                shutil.rmtree(cache_path)
+    finally:
+        backends.set_backend(previous)
+    return results
+
+
+def run_normalise(equations, repeat=10):
+    """Return the seconds per equation spent in every preprocessing function."""
+    steps = [
+        ('unescape', unescape),
+        ('unicode_replacements', unicode_replacements),
+        ('equation2png', equation2png),
+        ('cleanup_code', cleanup_code),
+        ('prepare_code', prepare_code),
+    ]
+    results = {}
+    for name, function in steps:
+        start = time.time()
+        for _ in range(repeat):
+            for equation in equations:
+                function(equation)
+        results[name] = (time.time() - start) / (repeat * len(equations))
+    return results
+
+
+def run_postprocess(paths, steps):
+    """Post-process copies of the PNG files paths with steps, return the sizes and time."""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        copies = []
+        for index, path in enumerate(paths):
+            copy = os.path.join(temp_dir, '%i.png' % index)
+            shutil.copyfile(path, copy)
+            copies.append(copy)
+        before = sum(os.path.getsize(copy) for copy in copies)
+        start = time.time()
+        for copy in copies:
+            postprocess.postprocess_png(copy, steps)
+        elapsed = time.time() - start
+        after = sum(os.path.getsize(copy) for copy in copies)
+    finally:
+        shutil.rmtree(temp_dir)
+    return {'images': len(paths), 'before': before, 'after': after, 'seconds': elapsed}
+
+
+def format_results(results, baseline=None):
+    """Return the results as text, with the change in throughput against baseline."""
+    lines = []
+    for name in sorted(results):
+        result = results[name]
+        line = '%-16s %8.1f eq/s %8.2fs' % (name, result['throughput'], result['seconds'])
+        if 'p50' in result:
+            line += '  p50 %.1fms p95 %.1fms p99 %.1fms' % (
+                result['p50'] * 1000, result['p95'] * 1000, result['p99'] * 1000)
+        if baseline and name in baseline and baseline[name]['throughput']:
+            change = result['throughput'] / baseline[name]['throughput'] - 1
+            line += '  %+.1f%%' % (change * 100)
+        lines.append(line)
+        for stage in sorted(result['stages']):
+            lines.append('    %-12s %8.3fs %8i runs' % (
+                stage, result['stages'][stage]['seconds'], result['stages'][stage]['count']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--corpus', default=os.path.join(here, '..', '..',
+                                                         'test-equations-short.txt'))
+    parser.add_argument('--limit', type=int, help='only use the first LIMIT equations')
+    parser.add_argument('--backend', default='stub',
+                        choices=sorted(list(backends.BACKENDS) + ['stub']))
+    parser.add_argument('--delay', type=float, default=0,
+                        help='seconds every command of the stub backend takes')
+    parser.add_argument('--workers', type=int, help='workers for the document runs')
+    parser.add_argument('--output', help='save the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--normalise', action='store_true',
+                        help='only time the text preprocessing of the equations')
+    parser.add_argument('--postprocess', type=postprocess.parse_steps, default=(),
+                        help='post-process the PNG images with these steps')
+    parser.add_argument('--images', help='only post-process the PNG images in this directory')
+    args = parser.parse_args(argv)
+
+    if args.images:
+        result = run_postprocess(sorted(glob.glob(os.path.join(args.images, '*.png'))),
+                                 args.postprocess or postprocess.STEPS)
+        print('%i images, %i bytes before, %i after (%.1f%% smaller), %.2fms/image' % (
+            result['images'], result['before'], result['after'],
+            100.0 * (result['before'] - result['after']) / (result['before'] or 1),
+            1000 * result['seconds'] / (result['images'] or 1)))
+        return
+
+    equations = read_corpus(args.corpus, args.limit)
+    if args.normalise:
+        for name, seconds in sorted(run_normalise(equations).items()):
+            print('%-20s %8.2fus/eq' % (name, seconds * 1e6))
+        return
+
+    if args.backend == 'stub':
+        backend = StubBackend(args.delay)
+    else:
+        backend = backends.BACKENDS[args.backend]()
+    # the progress dots would swamp the results
+    metrics.remove_hook(metrics.progress)
+    steps = postprocess.set_steps(args.postprocess)
+    try:
+        results = run_benchmark(equations, backend, args.workers)
+    finally:
+        postprocess.set_steps(steps)
+        metrics.add_hook(metrics.progress)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)['results']
+    print(format_results(results, baseline))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({'corpus': os.path.basename(args.corpus), 'backend': args.backend,
+                       'workers': args.workers, 'postprocess': args.postprocess,
+                       'results': results}, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+"""
+The cache of rendered images.
+
+Files are named by the hash of the code that was rendered, so that they can be served
+directly. A SQLite index in the cache directory records the size and last access time of
+every file, along with the fingerprint of the preamble, backend and TeX version that
+rendered it. A file rendered with a different fingerprint is treated as missing.
+
+The names and fingerprints of the index are loaded into memory, so that looking up a cached
+file only reads the data_version counter of SQLite. Other processes may store, merge and
+evict files in the same cache, which changes the counter, and the index is loaded again.
+Files must therefore be removed with evict, a file removed by hand is still treated as
+cached. The TeX version
+of every backend is recorded in the index as well, which lets a fully cached render skip
+the backend altogether; the version is checked again as soon as something has to be
+rendered.
+
+Failed renders are recorded in the index too, under the name of the file they failed to
+produce, with the kind of failure, the source and the excerpt of the LaTeX log. They are
+not attempted again until FAILURE_TTL has passed, the fingerprint changes or the file is
+stored after all.
+
+RenderCache.merge combines caches, e.g. the caches that build nodes rendered shards of a
+corpus into, into one.
+"""
+import errno
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from formats import backend_name, format_key, tex_version
+from metrics import increment, timed
+from postprocess import postprocess_key
+from utils import mkdir_p
+
+INDEX_NAME = 'index.sqlite'
+
+# last access times are written to the index in batches of this size
+ACCESS_FLUSH_SIZE = 1000
+
+# seconds for which a failed render is not attempted again
+FAILURE_TTL = 7 * 24 * 3600
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def render_fingerprint(preamble, backend, cache=None, verify=True):
+    """Return the fingerprint of rendering with preamble on backend, see tex_version."""
+    parts = [format_key(preamble), backend_name(backend), tex_version(backend, cache, verify)]
+    if postprocess_key():
+        parts.append(postprocess_key())
+    return hashlib.md5(';'.join(parts)).hexdigest()
+
+
+def get_cache(cache_path):
+    """Return the RenderCache for cache_path, shared by the whole process."""
+    cache_path = os.path.abspath(cache_path)
+    with _caches_lock:
+        if cache_path not in _caches:
+            _caches[cache_path] = RenderCache(cache_path)
+        return _caches[cache_path]
+
+
+class RenderCache(object):
+    """A directory of rendered files with an index of their sizes and last access times."""
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        mkdir_p(cache_path)
+        self.lock = threading.Lock()
+        self.accessed = {}
+        self.settings = None
+        self.failure_ttl = FAILURE_TTL
+        self.db = sqlite3.connect(os.path.join(cache_path, INDEX_NAME), timeout=60,
+                                  check_same_thread=False, isolation_level=None)
+        with self.lock:
+            created = not self.db.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='entries'").fetchone()
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                            'name TEXT PRIMARY KEY, fingerprint TEXT, size INTEGER, '
+                            'last_access REAL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS settings ('
+                            'key TEXT PRIMARY KEY, value TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS failures ('
+                            'name TEXT PRIMARY KEY, fingerprint TEXT, kind TEXT, source TEXT, '
+                            'log TEXT, failed_at REAL)')
+            if created:
+                self._import_files()
+            self._load()
+
+    def _load(self):
+        """Load the names of the index and the failures into memory. Hold the lock."""
+        # changes when another connection commits to the index
+        self.data_version = self.db.execute('PRAGMA data_version').fetchone()[0]
+        self.entries = dict(self.db.execute('SELECT name, fingerprint FROM entries'))
+        # the name of every failure to its fingerprint and time
+        self.failed = dict((name, (fingerprint, failed_at)) for name, fingerprint, failed_at
+                           in self.db.execute('SELECT name, fingerprint, failed_at '
+                                              'FROM failures'))
+        self.settings = None
+
+    def _reload_changed(self):
+        """Load the index again if another process changed it. Hold the lock."""
+        if self.db.execute('PRAGMA data_version').fetchone()[0] != self.data_version:
+            self._flush_accessed()
+            self._load()
+
+    def _import_files(self):
+        """Index the files of a cache directory created before the index existed."""
+        now = time.time()
+        rows = []
+        for name in os.listdir(self.cache_path):
+            if name.endswith(('.png', '.pdf', '.svg')):
+                # the fingerprint is unknown, so accept the file for any fingerprint
+                rows.append((name, None, os.path.getsize(self.path(name)), now))
+        self.db.execute('BEGIN')
+        self.db.executemany('INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?)', rows)
+        self.db.execute('COMMIT')
+
+    def path(self, name):
+        """Return the path of the cached file called name."""
+        return os.path.join(self.cache_path, name)
+
+    def lookup(self, name, fingerprint=None):
+        """Return the path of the cached file called name, or None if it is not cached."""
+        with timed('cache'), self.lock:
+            self._reload_changed()
+            if not self._matches(name, fingerprint):
+                return None
+            self.accessed[name] = time.time()
+            if len(self.accessed) >= ACCESS_FLUSH_SIZE:
+                self._flush_accessed()
+        return self.path(name)
+
+    def _matches(self, name, fingerprint):
+        """Return whether the loaded index has name with fingerprint. Hold the lock."""
+        if name not in self.entries:
+            return False
+        entry_fingerprint = self.entries[name]
+        return not fingerprint or not entry_fingerprint or entry_fingerprint == fingerprint
+
+    def store(self, src, name, fingerprint=None, move=False):
+        """
+        Copy the file src into the cache as name and return its cache path.
+
+        The file is written under a temporary name and renamed, so that concurrent readers
+        never see a partially written file. With move, src is renamed into the cache if it
+        is on the same file system, and removed after it is copied otherwise.
+        """
+        size = self._write(src, name, move)
+        with timed('cache'), self.lock:
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                            (name, fingerprint, size, time.time()))
+            self.entries[name] = fingerprint
+            self.accessed.pop(name, None)
+            if name in self.failed:
+                del self.failed[name]
+                self.db.execute('DELETE FROM failures WHERE name = ?', (name,))
+        return self.path(name)
+
+    def _write(self, src, name, move=False):
+        """Put the file src into the cache directory as name, see store. Return its size."""
+        with timed('copy'):
+            size = os.path.getsize(src)
+            moved = move and self._move(src, name)
+            if not moved:
+                fd, temp_path = tempfile.mkstemp(dir=self.cache_path, prefix='.tmp-')
+                os.close(fd)
+                try:
+                    shutil.copyfile(src, temp_path)
+                    os.chmod(temp_path, 0o644)
+                    os.rename(temp_path, self.path(name))
+                except Exception:
+                    os.remove(temp_path)
+                    raise
+                if move:
+                    os.remove(src)
+        increment('bytes_moved' if moved else 'bytes_written', size)
+        return size
+
+    def _move(self, src, name):
+        """Rename src to the cache path of name, return False if it is on another device."""
+        try:
+            os.chmod(src, 0o644)
+        except OSError:
+            # owned by the user of the backend, which made it readable
+            pass
+        try:
+            os.rename(src, self.path(name))
+        except OSError as error:
+            if error.errno == errno.EXDEV:
+                return False
+            raise
+        return True
+
+    def lookup_failure(self, name, fingerprint=None):
+        """
+        Return the (kind, log) of the recorded failure to render name, or None.
+
+        A failure recorded with a different fingerprint or more than failure_ttl seconds
+        ago is ignored.
+        """
+        with timed('cache'), self.lock:
+            self._reload_changed()
+            if name not in self.failed:
+                return None
+            failed_fingerprint, failed_at = self.failed[name]
+            if fingerprint and failed_fingerprint != fingerprint or \
+                    failed_at + self.failure_ttl < time.time():
+                return None
+            return self.db.execute('SELECT kind, log FROM failures WHERE name = ?',
+                                   (name,)).fetchone()
+
+    def store_failure(self, name, fingerprint, kind, source, log):
+        """Record that rendering source to name failed with kind and the LaTeX log excerpt."""
+        if isinstance(source, str):
+            source = source.decode('utf-8', 'replace')
+        if isinstance(log, str):
+            log = log.decode('utf-8', 'replace')
+        now = time.time()
+        with timed('cache'), self.lock:
+            self.db.execute('INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?, ?)',
+                            (name, fingerprint, kind, source, log, now))
+            self.failed[name] = (fingerprint, now)
+
+    def failures(self):
+        """Return the recorded failures as dictionaries, the oldest first."""
+        with self.lock:
+            rows = self.db.execute('SELECT name, fingerprint, kind, source, log, failed_at '
+                                   'FROM failures ORDER BY failed_at').fetchall()
+        return [dict(zip(['name', 'fingerprint', 'kind', 'source', 'log', 'failed_at'], row))
+                for row in rows]
+
+    def clear_failures(self):
+        """Forget the recorded failures, so that they are rendered again."""
+        with self.lock:
+            self.db.execute('DELETE FROM failures')
+            self.failed = {}
+
+    def merge(self, other):
+        """
+        Copy the files and failures of the RenderCache other that this cache does not have.
+
+        Files are named by the hash of their source, so a file of the same name is the same
+        image unless the two caches rendered it with different fingerprints. Such a conflict
+        keeps the file of this cache. Settings this cache does not have are copied as well.
+        Returns a dictionary counting the files that were copied, skipped because they are
+        already here and skipped because of a conflict.
+        """
+        counts = {'copied': 0, 'present': 0, 'conflicts': 0}
+        with other.lock:
+            other._flush_accessed()
+            rows = other.db.execute('SELECT name, fingerprint, last_access '
+                                    'FROM entries').fetchall()
+            failures = other.db.execute('SELECT name, fingerprint, kind, source, log, '
+                                        'failed_at FROM failures').fetchall()
+            settings = other.db.execute('SELECT key, value FROM settings').fetchall()
+        copied = []
+        for name, fingerprint, last_access in rows:
+            if name in self.entries:
+                present = self.entries[name]
+                counts['present' if not present or not fingerprint or present == fingerprint
+                       else 'conflicts'] += 1
+                continue
+            try:
+                size = self._write(other.path(name), name)
+            except (IOError, OSError):
+                # indexed but removed from the other cache
+                continue
+            copied.append((name, fingerprint, size, last_access))
+        counts['copied'] = len(copied)
+        copied_names = set(name for name, _, _, _ in copied)
+        with timed('cache'), self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', copied)
+            # the failures of names that were rendered here, or failed here later, are dropped
+            failures = [row for row in failures if row[0] not in self.entries and
+                        row[0] not in copied_names and
+                        (row[0] not in self.failed or self.failed[row[0]][1] < row[5])]
+            self.db.executemany('INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?, ?)',
+                                failures)
+            self.db.executemany('INSERT OR IGNORE INTO settings VALUES (?, ?)', settings)
+            self.db.execute('COMMIT')
+            for name, fingerprint, _, _ in copied:
+                self.entries[name] = fingerprint
+            for row in failures:
+                self.failed[row[0]] = (row[1], row[5])
+            self.settings = None
+        return counts
+
+    def get_setting(self, key):
+        """Return the value of the setting key recorded in the index, or None."""
+        with self.lock:
+            self._reload_changed()
+            if self.settings is None:
+                self.settings = dict(self.db.execute('SELECT key, value FROM settings'))
+            return self.settings.get(key)
+
+    def set_setting(self, key, value):
+        """Record the value of the setting key in the index."""
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', (key, value))
+            if self.settings is not None:
+                self.settings[key] = value
+
+    def _flush_accessed(self):
+        """Write the remembered access times to the index. Hold the lock when calling."""
+        if self.accessed:
+            self.db.execute('BEGIN')
+            self.db.executemany('UPDATE entries SET last_access = ? WHERE name = ?',
+                                [(when, name) for name, when in self.accessed.items()])
+            self.db.execute('COMMIT')
+            self.accessed = {}
+
+    def flush(self):
+        """Write the remembered access times to the index."""
+        with self.lock:
+            self._flush_accessed()
+
+    def size(self):
+        """Return the total size of the cached files in bytes."""
+        with self.lock:
+            return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def evict(self, max_bytes):
+        """
+        Remove the least recently used files until the cache is at most max_bytes in size.
+
+        The files are chosen and their rows deleted in one write transaction, so that
+        processes evicting at the same time do not remove more than needed, and the files
+        are removed before it commits. Other processes load the index again on their next
+        lookup. Returns the names of the removed files.
+        """
+        removed = []
+        with self.lock:
+            self._flush_accessed()
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                total = self.db.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+                rows = self.db.execute(
+                    'SELECT name, size FROM entries ORDER BY last_access, rowid')
+                for name, size in rows.fetchall():
+                    if total <= max_bytes:
+                        break
+                    removed.append(name)
+                    total -= size
+                self.db.executemany('DELETE FROM entries WHERE name = ?',
+                                    [(name,) for name in removed])
+                for name in removed:
+                    try:
+                        os.remove(self.path(name))
+                    except OSError:
+                        pass
+                    self.entries.pop(name, None)
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+        return removed
@@ -0,0 +1,309 @@
+"""
+Render the equations of HTML documents and equation files into a cache.
+
+    latex2image --cache images --jobs 8 book/ extra-equations.txt
+    latex2image --cache images --output html --image-path /images book/
+    latex2image --cache images --dry-run book/
+
+The inputs are HTML files, directories searched for HTML files, and files of equations
+separated by ---- lines. Their equations are rendered under the same names as
+replace_latex_with_images would use, so that a later publishing step finds them all in the
+cache. With --output the HTML documents are written there with their equations replaced.
+--dry-run only counts the equations that are not cached. The inputs are read as UTF-8,
+unless another --encoding is given.
+
+The equations can be split between build nodes with --shard K/N: every node renders the
+equations whose image hash falls into its shard K of N into its own cache, and the caches
+are combined afterwards with --merge:
+
+    latex2image --cache shard-0 --shard 0/2 book/    # on one node
+    latex2image --cache shard-1 --shard 1/2 book/    # on another
+    latex2image --cache images --merge shard-0 shard-1
+
+The inputs are rendered in groups, and the inputs of every finished group are recorded in
+the cache directory, so that --resume skips them after an interruption. A summary of the
+rendered, cached and failed equations and the time spent in every stage is printed at the
+end.
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+from lxml import etree
+
+import metrics
+from backends import get_backend
+from cache import RenderCache, get_cache, render_fingerprint
+from htmlstream import stream_latex_with_images
+from imageutils import equation_images, render_equations_batch, run_latex_jobs, shard_of
+from preambles import equation_preamble
+
+HTML_EXTENSIONS = ('.html', '.htm', '.xhtml')
+
+# the file in the cache directory listing the inputs that are done, for --resume
+RESUME_NAME = '.latex2image-done'
+
+# the images rendered together, before the inputs are recorded as done
+GROUP_SIZE = 500
+
+
+def find_inputs(paths):
+    """Return the input files of paths, with the HTML files of directories in order."""
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                inputs.extend(os.path.join(root, name) for name in sorted(files)
+                              if name.lower().endswith(HTML_EXTENSIONS))
+        else:
+            inputs.append(path)
+    return inputs
+
+
+def is_html(path):
+    """Return whether path is an HTML file rather than a file of equations."""
+    return path.lower().endswith(HTML_EXTENSIONS)
+
+
+def read_equations(path, class_to_replace, encoding='utf-8'):
+    """Return the equation texts of an HTML file or a file of equations in encoding."""
+    if is_html(path):
+        tree = etree.parse(path, etree.HTMLParser(encoding=encoding))
+        return [''.join(element.itertext())
+                for element in tree.iterfind('.//*[@class="{}"]'.format(class_to_replace))]
+    with open(path) as fp:
+        return [equation.decode(encoding) for equation in fp.read().split('----')
+                if equation.strip()]
+
+
+def input_key(path):
+    """Return the line recording path, and its modification time, as done."""
+    return '%s\t%r' % (os.path.abspath(path), os.path.getmtime(path))
+
+
+def parse_shard(value):
+    """Return the (shard, shards) of a K/N --shard option."""
+    try:
+        shard, shards = [int(number) for number in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('%r is not of the form K/N' % value)
+    if not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError('the shard of %r is not from 0 to N - 1' % value)
+    return shard, shards
+
+
+class Summary(object):
+    """Count the inputs and equations of a run."""
+
+    def __init__(self):
+        self.inputs = 0
+        self.skipped = 0
+        self.equations = 0
+        self.unique = 0
+        self.cached = 0
+        self.rendered = 0
+        self.failed = 0
+        # the equations that are not cached, in a dry run
+        self.missing = 0
+        # the equations left to the other shards
+        self.elsewhere = 0
+        self.start = time.time()
+
+    def format(self):
+        lines = ['%i inputs (%i skipped), %i equations, %i unique: %i rendered, %i cached, '
+                 '%i failed, %i in other shards in %.1fs' % (
+                     self.inputs, self.skipped, self.equations, self.unique, self.rendered,
+                     self.cached, self.failed, self.elsewhere, time.time() - self.start)]
+        stages = metrics.stage_totals()
+        for stage in sorted(stages):
+            lines.append('    %-12s %8.3fs %8i runs' % (
+                stage, stages[stage]['seconds'], stages[stage]['count']))
+        return '\n'.join(lines)
+
+
+class Run(object):
+    """Render the equations of the inputs of a run in groups."""
+
+    def __init__(self, args):
+        self.args = args
+        self.densities = (1,) if args.format == 'svg' else args.densities
+        self.extension = '.' + args.format
+        self.cache = get_cache(args.cache)
+        self.fingerprint = render_fingerprint(equation_preamble(), get_backend(), self.cache,
+                                              verify=False)
+        self.summary = Summary()
+        self.seen = set()
+        self.group = []
+        self.jobs = []
+        self.done = None
+
+    def is_cached(self, images):
+        return all(self.cache.lookup(codehash + self.extension, self.fingerprint)
+                   for codehash, _ in images)
+
+    def add(self, path):
+        """Collect the equations of the input path that must be rendered."""
+        self.summary.inputs += 1
+        for text in read_equations(path, self.args.class_to_replace, self.args.encoding):
+            self.summary.equations += 1
+            latex, images = equation_images(text, self.densities, self.args.format)
+            if latex in self.seen:
+                continue
+            self.seen.add(latex)
+            if self.args.shard and shard_of(images[0][0], self.args.shard[1]) != \
+                    self.args.shard[0]:
+                self.summary.elsewhere += 1
+                continue
+            self.summary.unique += 1
+            if self.is_cached(images):
+                self.summary.cached += 1
+            else:
+                self.jobs.append(('equation', latex, images))
+        self.group.append(path)
+        if sum(len(images) for _, _, images in self.jobs) >= GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Render the collected equations and finish the inputs of the group."""
+        if self.args.dry_run:
+            for _, latex, _ in self.jobs:
+                print(latex)
+            self.summary.missing += len(self.jobs)
+        else:
+            failed = sum(self.render())
+            self.summary.failed += failed
+            self.summary.rendered += len(self.jobs) - failed
+            for path in self.group:
+                if self.args.output and is_html(path):
+                    self.write(path)
+                self.done.write(input_key(path) + '\n')
+            self.done.flush()
+        self.group = []
+        self.jobs = []
+
+    def render(self):
+        """Render the collected equations, yield 1 for every equation that failed."""
+        jobs = self.jobs
+        workers = self.args.jobs
+        if self.args.batch and self.args.format == 'png':
+            latexes = [latex for _, latex, _ in jobs]
+            dpis = [dpi for _, dpi in jobs[0][2]] if jobs else []
+            chunks = [latexes[index::workers] for index in range(workers)]
+            pool = ThreadPool(workers)
+            try:
+                for results in pool.imap_unordered(
+                        lambda chunk: render_equations_batch(chunk, dpis, self.args.cache),
+                        [chunk for chunk in chunks if chunk]):
+                    for result in results.values():
+                        yield 0 if isinstance(result, dict) else 1
+            finally:
+                pool.close()
+                pool.join()
+            return
+        for paths in run_latex_jobs(jobs, self.args.cache, workers,
+                                    output_format=self.args.format):
+            yield 0 if all(paths) else 1
+
+    def write(self, path):
+        """Write the HTML file path to the output directory with images for its equations."""
+        relative = os.path.relpath(os.path.abspath(path), self.args.root)
+        output_path = os.path.join(self.args.output, relative)
+        directory = os.path.dirname(output_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'rb') as source, open(output_path, 'wb') as output:
+            stream_latex_with_images(source, output, self.args.class_to_replace,
+                                     self.args.cache, self.args.image_path,
+                                     encoding=self.args.encoding, densities=self.densities,
+                                     output_format=self.args.format)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.strip().split('\n')[2:]))
+    parser.add_argument('inputs', nargs='+',
+                        help='HTML files, directories of them, or files of equations')
+    parser.add_argument('--cache', required=True, help='the directory of the image cache')
+    parser.add_argument('--jobs', type=int, default=1, help='images to render concurrently')
+    parser.add_argument('--batch', action='store_true',
+                        help='compile many PNG equations per pdflatex run')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only list the equations that are not cached')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the inputs finished by the previous run')
+    parser.add_argument('--output', help='write the HTML documents into this directory')
+    parser.add_argument('--image-path', default='', help='the URL of the cache in the HTML')
+    parser.add_argument('--class', dest='class_to_replace', default='latex-math',
+                        help='the class of the equation elements')
+    parser.add_argument('--format', choices=['png', 'svg'], default='png')
+    parser.add_argument('--encoding', default='utf-8', help='the encoding of the inputs')
+    parser.add_argument('--densities', type=lambda value: tuple(
+        float(density) for density in value.split(',')), default=(1, 2),
+        help='the pixel densities of the PNG images, e.g. 1,2')
+    parser.add_argument('--shard', type=parse_shard, metavar='K/N',
+                        help='only render shard K, from 0 to N - 1, of the equations')
+    parser.add_argument('--merge', action='store_true',
+                        help='merge the caches given as inputs into --cache')
+    parser.add_argument('--quiet', action='store_true', help='do not write progress dots')
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    if args.merge:
+        for source in args.inputs:
+            # RenderCache would create a mistyped cache
+            if not os.path.isdir(source):
+                parser.error('%s is not a cache directory' % source)
+        target = get_cache(args.cache)
+        for source in args.inputs:
+            counts = target.merge(RenderCache(os.path.abspath(source)))
+            print('%s: %i copied, %i present, %i conflicts' % (
+                source, counts['copied'], counts['present'], counts['conflicts']))
+        return 0
+
+    inputs = find_inputs(args.inputs)
+    # the output directory mirrors the inputs below their common directory
+    args.root = os.path.dirname(os.path.commonprefix(
+        [os.path.dirname(os.path.abspath(path)) + os.sep for path in inputs])) if inputs else ''
+    if args.quiet or args.dry_run:
+        metrics.remove_hook(metrics.progress)
+    metrics.reset()
+
+    run = Run(args)
+    done_path = os.path.join(args.cache, RESUME_NAME)
+    done = set()
+    if args.resume and os.path.exists(done_path):
+        with open(done_path) as fp:
+            done = set(fp.read().splitlines())
+    if not args.dry_run:
+        run.done = open(done_path, 'a' if args.resume else 'w')
+    try:
+        for path in inputs:
+            if input_key(path) in done:
+                run.summary.skipped += 1
+                continue
+            run.add(path)
+        run.flush()
+    finally:
+        if run.done is not None:
+            run.done.close()
+        if args.quiet or args.dry_run:
+            metrics.add_hook(metrics.progress)
+
+    print()
+    if args.dry_run:
+        print('%i of %i unique equations are not cached' % (
+            run.summary.missing, run.summary.unique))
+    else:
+        print(run.summary.format())
+    return 1 if run.summary.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
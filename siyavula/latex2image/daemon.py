@@ -0,0 +1,289 @@
+"""
+A render service shared by the processes of a host, and its client.
+
+The daemon listens on a Unix socket and renders into a single cache with the backend,
+preamble formats and TeX workers of its own process, which stay warm between requests.
+Every request is one line of JSON and gets one line of JSON back:
+
+    {"images": [{"type": "equation", "code": "\\\\(x^2\\\\)", "dpi": 300}], "data": false}
+    {"results": [{"path": "/cache/0123abcd.png"}]}
+
+An image can also give its "hash", of hexadecimal digits, and "format" (png or svg), and
+"timeout" sets the seconds after which the latex processes of a request are killed. The
+images of all the connections are rendered by one pool of workers. A failed image gets an
+"error" instead of a path, and with "data" true the results carry the base64 encoded
+image as well. The daemon is started with the latex2image-daemon console script, whose
+--warm option routes the PNG equations to TeX workers that stay running, see texworker.
+"""
+import argparse
+import base64
+import errno
+import json
+import logging
+import multiprocessing
+import os
+import Queue
+import re
+import shlex
+import socket
+import SocketServer
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import metrics
+from imageutils import LATEX_TIMEOUT, PIPELINES, equation_hash, figure_hash, run_latex_jobs
+from texworker import TexWorker, render_images_warm
+
+log = logging.getLogger(__name__)
+
+
+def default_socket():
+    """Return the socket path of the user's daemon, in XDG_RUNTIME_DIR if it is set."""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'latex2image.sock')
+    return os.path.join(tempfile.gettempdir(), 'latex2image-%i.sock' % os.getuid())
+
+
+DEFAULT_SOCKET = os.environ.get('LATEX2IMAGE_SOCKET') or default_socket()
+
+# the hashes clients may name images by, which must stay inside the cache directory
+_hash_regex = re.compile(r'^[0-9a-f]+$')
+
+
+class RenderRequestError(Exception):
+    """A request to the daemon was malformed or could not be rendered."""
+
+    pass
+
+
+def render_request(request, cache_path, workers=None, warm=None, pool=None):
+    """
+    Render the images of a decoded request into cache_path and return the response.
+
+    warm is a Queue of TexWorkers that render the PNG equations, which then keep the
+    timeout of the workers. The other images are rendered on pool, a ThreadPool shared by
+    the requests, or by workers of the request's own if it is not given.
+    """
+    images = request.get('images')
+    if not isinstance(images, list):
+        raise RenderRequestError('The request has no list of images.')
+    timeout = request.get('timeout', LATEX_TIMEOUT)
+
+    # the images of the same code and format are rendered by one job
+    jobs = {}
+    order = []
+    names = []
+    for image in images:
+        pictype = image.get('type', 'equation')
+        if pictype not in PIPELINES:
+            raise RenderRequestError('Unknown image type %r.' % pictype)
+        code = image.get('code')
+        if not code:
+            raise RenderRequestError('An image has no code.')
+        code = code.encode('utf-8')
+        dpi = image.get('dpi', 300)
+        output_format = image.get('format', 'png')
+        codehash = image.get('hash')
+        if codehash is None:
+            if pictype == 'equation':
+                codehash = equation_hash(code, dpi, output_format)
+            else:
+                codehash = figure_hash(pictype, code, dpi, output_format)
+        elif not isinstance(codehash, basestring) or not _hash_regex.match(codehash):
+            raise RenderRequestError('The hash %r is not hexadecimal.' % (codehash,))
+        key = (pictype, code, output_format)
+        if key not in jobs:
+            jobs[key] = []
+            order.append(key)
+        jobs[key].append((str(codehash), dpi))
+        names.append((key, len(jobs[key]) - 1))
+
+    paths = {}
+    if warm is not None:
+        for key in order:
+            if key[0] == 'equation' and key[2] == 'png':
+                worker = warm.get()
+                try:
+                    paths[key] = render_images_warm(worker, key[1], cache_path, jobs[key])
+                finally:
+                    warm.put(worker)
+    for output_format in set(key[2] for key in order if key not in paths):
+        keys = [key for key in order if key[2] == output_format and key not in paths]
+        results = run_latex_jobs([(key[0], key[1], jobs[key]) for key in keys], cache_path,
+                                 workers, output_format=output_format, timeout=timeout,
+                                 pool=pool)
+        paths.update(zip(keys, results))
+
+    response = []
+    for key, index in names:
+        path = paths[key][index]
+        if path is None:
+            response.append({'error': 'The image failed to render.'})
+            continue
+        result = {'path': path}
+        if request.get('data'):
+            with open(path, 'rb') as fp:
+                result['data'] = base64.b64encode(fp.read())
+        response.append(result)
+    return {'results': response}
+
+
+class RenderHandler(SocketServer.StreamRequestHandler):
+    """Answer every line of JSON read from the connection."""
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                response = render_request(json.loads(line), self.server.cache_path,
+                                          warm=self.server.warm, pool=self.server.pool)
+            except (ValueError, AttributeError, RenderRequestError) as error:
+                response = {'error': str(error)}
+            except Exception as error:
+                log.exception('Failed to render a request.')
+                response = {'error': str(error)}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class RenderServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Serve render requests on a Unix socket, one thread per connection.
+
+    The images of all the connections are rendered by workers threads, the number of CPUs
+    if it is not given. Raises socket.error with EADDRINUSE if a daemon is listening on
+    socket_path already. Only the user running the daemon may connect to the socket, as
+    pdflatex runs with -shell-escape.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, cache_path, workers=None, tex_workers=None):
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except socket.error:
+                # left behind by a daemon that is not running
+                os.remove(socket_path)
+            else:
+                raise socket.error(errno.EADDRINUSE,
+                                   'A daemon is listening on %s already.' % socket_path)
+            finally:
+                probe.close()
+        SocketServer.UnixStreamServer.__init__(self, socket_path, RenderHandler)
+        self.cache_path = os.path.abspath(cache_path)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = ThreadPool(self.workers)
+        metrics.adjust('workers', self.workers)
+        self.tex_workers = tex_workers or []
+        self.warm = None
+        if self.tex_workers:
+            self.warm = Queue.Queue()
+            for worker in self.tex_workers:
+                self.warm.put(worker)
+
+    def server_bind(self):
+        # no other user may connect between the bind and the chmod
+        umask = os.umask(0o177)
+        try:
+            SocketServer.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        self.pool.close()
+        self.pool.join()
+        metrics.adjust('workers', -self.workers)
+        for worker in self.tex_workers:
+            worker.close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class RenderClient(object):
+    """Send render requests to the daemon listening on socket_path."""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.socket = None
+        self.file = None
+
+    def _connect(self):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(self.timeout)
+        self.socket.connect(self.socket_path)
+        self.file = self.socket.makefile('rwb')
+
+    def render(self, images, data=False, timeout=LATEX_TIMEOUT):
+        """
+        Render a list of image dictionaries, see the module documentation.
+
+        Returns the list of results. Raises RenderRequestError if the daemon rejected the
+        request.
+        """
+        if self.socket is None:
+            self._connect()
+        request = {'images': images, 'data': data, 'timeout': timeout}
+        try:
+            self.file.write(json.dumps(request) + '\n')
+            self.file.flush()
+            line = self.file.readline()
+        except socket.error:
+            self.close()
+            raise
+        if not line:
+            self.close()
+            raise RenderRequestError('The daemon closed the connection.')
+        response = json.loads(line)
+        if 'error' in response:
+            raise RenderRequestError(response['error'])
+        return response['results']
+
+    def run_latex(self, pictype, codehash, codetext, dpi=300, timeout=LATEX_TIMEOUT,
+                  output_format='png'):
+        """Render like imageutils.run_latex, into the cache of the daemon."""
+        result = self.render([{'type': pictype, 'hash': codehash, 'code': codetext, 'dpi': dpi,
+                               'format': output_format}], timeout=timeout)[0]
+        return result.get('path')
+
+    def close(self):
+        """Close the connection to the daemon."""
+        if self.socket is not None:
+            self.file.close()
+            self.socket.close()
+            self.socket = None
+            self.file = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='the Unix socket to listen on')
+    parser.add_argument('--cache', required=True, help='the directory of the image cache')
+    parser.add_argument('--workers', type=int,
+                        help='images to render concurrently, the number of CPUs by default')
+    parser.add_argument('--warm', type=int, default=0,
+                        help='TeX workers that stay running to render PNG equations')
+    parser.add_argument('--warm-command', default='',
+                        help='the command that runs pdflatex for the TeX workers, e.g. '
+                             '"docker exec -i latex"')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    tex_workers = [TexWorker(command_prefix=shlex.split(args.warm_command))
+                   for _ in range(args.warm)]
+    server = RenderServer(args.socket, args.cache, args.workers, tex_workers)
+    log.info('Rendering into %s, listening on %s', server.cache_path, args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,14 @@
 """Code to handle preparing equation text for image transform."""
+from normalise import Normaliser
+
+# A % gets a backslash unless it is already escaped. This is the result of replacing % with
+# \% and then \\% with \%.
+_percentage_rules = [('\\%', '\\%'), ('%', '\\%')]
+_percentage_normaliser = Normaliser(_percentage_rules)
+
+# Remove the {# rule when EdTech has removed all hex colour codes. It escapes the # in the
+# colour code. Tabs are replaced with spaces and percentage symbols escaped.
+_equation_normaliser = Normaliser([(r'{#', r'{\#'), ('\t', ' ')] + _percentage_rules)
 
 
 def escape_percentage(equation):
@@ -11,7 +21,7 @@ def escape_percentage(equation):
     Returns string with percentage symbols escaped
     """
     if '%' in equation:
-        equation = equation.replace('%', '\\%').replace('\\\\%', '\\%')
+        equation = _percentage_normaliser(equation)
 
     return equation
 
@@ -22,11 +32,5 @@ def equation2png(equation_element):
     # This handles new lines and blank lines better
     equation_element = '\({}\)'.format(equation_element[2:-2])
 
-    # Remove the next line when EdTech has removed all hex colour codes
-    # This escapes the # in the colour code
-    equation_element = equation_element.replace(r'{#', r'{\#')
-
-    # remove tabs
-    equation_element = equation_element.replace('\t', ' ')
-    equation_element = escape_percentage(equation_element)
-    return equation_element
+    # escape the # in colour codes, remove tabs and escape percentage symbols in one pass
+    return _equation_normaliser(equation_element)
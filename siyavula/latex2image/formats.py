@@ -0,0 +1,125 @@
+"""
+Precompiled LaTeX format files for the picture and equation preambles.
+
+A format file can only be loaded by the TeX that dumped it, so the format files are named
+by the TeX version of the backend as well as the preamble.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+from utils import mkdir_p, unescape
+
+log = logging.getLogger(__name__)
+
+FORMAT_PATH = os.environ.get('LATEX2IMAGE_FORMAT_PATH',
+                             os.path.join(tempfile.gettempdir(), 'latex2image-formats'))
+# seconds a format build may take before pdflatex is killed
+FORMAT_TIMEOUT = 300
+
+# format keys that failed to build, so that they are not rebuilt for every image
+_failed_formats = set()
+
+
+def backend_name(backend):
+    """Return the name of backend used in fingerprints."""
+    return getattr(backend, 'name', None) or type(backend).__name__
+
+
+def tex_version(backend, cache=None, verify=True):
+    """
+    Return the first line of pdflatex --version on backend, remembered per backend.
+
+    The version is recorded in cache if given. If verify is False the version recorded in
+    cache is returned without running pdflatex.
+    """
+    version = getattr(backend, 'tex_version', None)
+    key = 'tex_version:' + backend_name(backend)
+    if version is None and not verify and cache is not None:
+        version = cache.get_setting(key)
+    if version is None:
+        exit_code, output = backend.exec_run(['pdflatex', '--version'])
+        version = (output or '').strip().split('\n')[0] if exit_code == 0 else ''
+        try:
+            backend.tex_version = version
+        except AttributeError:
+            pass
+        if cache is not None and cache.get_setting(key) != version:
+            cache.set_setting(key, version)
+    return version
+
+
+def preamble_head(preamble):
+    """Return the part of the preamble that is dumped into the format file."""
+    head, _, _ = preamble.partition('\\begin{document}')
+    return head
+
+
+def format_key(preamble, dvi=False, version=''):
+    """
+    Return the name of the format file for a preamble, derived from its hash.
+
+    version is the TeX version the format is built with, see tex_version.
+    """
+    head = preamble_head(preamble)
+    if isinstance(head, unicode):
+        head = head.encode('utf-8')
+    digest = hashlib.sha1(head)
+    if version:
+        digest.update('\n% ' + version)
+    return 'preamble-' + digest.hexdigest() + ('-dvi' if dvi else '')
+
+
+def get_format(preamble, backend, format_path=None, dvi=False):
+    """
+    Return the path of the format file for preamble, without the .fmt extension.
+
+    The format is built with mylatexformat the first time a preamble is used. When a
+    document is compiled with the format, pdflatex skips the preamble up to
+    \\begin{document} so the packages are not loaded again. A changed preamble or TeX
+    version gets a new key and therefore a new format file. Returns None if the format
+    could not be built, in which case documents must be compiled without it.
+
+    With dvi the packages are loaded for DVI output, for documents compiled with
+    -output-format=dvi.
+    """
+    if format_path is None:
+        format_path = FORMAT_PATH
+    key = format_key(preamble, dvi, tex_version(backend))
+    fmt = os.path.join(format_path, key)
+    if os.path.exists(fmt + '.fmt'):
+        return fmt
+    if key in _failed_formats:
+        return None
+
+    mkdir_p(format_path)
+    # build next to the final location so that the rename below stays on one filesystem
+    temp_dir = tempfile.mkdtemp(dir=format_path)
+    try:
+        latex_path = os.path.join(temp_dir, key + '.tex')
+        with open(latex_path, 'wt') as fp:
+            temp = unescape(preamble_head(preamble) + '\\begin{document}\n\\end{document}\n')
+            try:
+                fp.write(temp)
+            except UnicodeEncodeError:
+                fp.write(temp.encode('utf-8'))
+
+        command = ['timeout', str(FORMAT_TIMEOUT), 'pdflatex', '-ini', '-shell-escape',
+                   '-halt-on-error', '-jobname=' + key, '-output-directory=' + temp_dir]
+        if dvi:
+            command.append('-output-format=dvi')
+        command.extend(['&pdflatex', 'mylatexformat.ltx', latex_path])
+        exit_code, _ = backend.exec_run(command)
+        built = os.path.join(temp_dir, key + '.fmt')
+        if exit_code != 0 or not os.path.exists(built):
+            log.warning('Could not build the format file %s, compiling without it.', key)
+            _failed_formats.add(key)
+            return None
+        # rename so that concurrent builders never load a partially written format
+        os.rename(built, fmt + '.fmt')
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return fmt
@@ -0,0 +1,166 @@
+"""
+Replace the equations of HTML documents that are too large to parse into memory at once.
+
+The document is parsed incrementally. The elements at chunk_depth (by default the children
+of body) are collected until batch_size of them are complete, then their equations are
+replaced with images, they are written to the output and dropped from the tree before
+parsing continues. The elements above chunk_depth are written tag by tag, so only a batch
+of chunks and their ancestors are in memory at any time. An equation above chunk_depth is
+kept whole like a chunk.
+"""
+from lxml import etree
+
+from imageutils import replace_equations
+
+# the keyword arguments of replace_latex_with_images that apply to the equations alone,
+# figures are not replaced
+EQUATION_OPTIONS = ('workers', 'densities', 'output_format', 'report', 'timeout', 'atlas')
+
+
+def _start_tag(element):
+    """Return the HTML start tag of element."""
+    empty = etree.Element(element.tag, dict(element.attrib))
+    html = etree.tostring(empty, method='html', encoding='utf-8')
+    return html[:-len('</%s>' % element.tag)]
+
+
+def _text(text):
+    """Return text encoded for the output and escaped for HTML."""
+    if not text:
+        return ''
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').encode('utf-8')
+
+
+class _Writer(object):
+    """Write the elements of the document once they are complete and drop them."""
+
+    def __init__(self, output, class_to_replace, replace):
+        self.output = output
+        self.class_to_replace = class_to_replace
+        self.replace = replace
+        # chunks that are complete but whose equations have not been replaced yet
+        self.pending = []
+        # ancestors that have been written, only their tails are still to be written
+        self.closed = set()
+        # ancestors whose start tag and text have been written
+        self.opened = set()
+
+    def open(self, element):
+        """Write the start tag and text of element, once."""
+        if element not in self.opened:
+            self.opened.add(element)
+            self.output.write(_start_tag(element) + _text(element.text))
+
+    def flush_children(self, parent, until=None):
+        """
+        Write the children of parent before until, or all of them, and drop them.
+
+        Their tails are complete because a later sibling has started or parent has ended.
+        """
+        children = []
+        for child in parent:
+            if child is until:
+                break
+            children.append(child)
+        self.flush_pending()
+        for child in children:
+            if child in self.closed:
+                self.closed.discard(child)
+                self.output.write(_text(child.tail))
+            else:
+                # chunks, and comments that do not produce events
+                self.output.write(etree.tostring(child, method='html', encoding='utf-8'))
+            parent.remove(child)
+
+    def add(self, element):
+        """Remember a chunk whose end has been parsed."""
+        self.pending.append(element)
+
+    def flush_pending(self):
+        """Replace the equations of the pending chunks."""
+        if self.pending:
+            self.replace([equation for chunk in self.pending for equation in chunk.iter()
+                          if equation.get('class') == self.class_to_replace])
+            self.pending = []
+
+    def close(self, element):
+        """Write the rest of an ancestor whose end has been parsed."""
+        if element in self.opened:
+            self.flush_children(element)
+            self.output.write('</%s>' % element.tag)
+            self.opened.discard(element)
+        else:
+            # without children, which may also be a void element like br
+            self.output.write(etree.tostring(element, method='html', encoding='utf-8',
+                                             with_tail=False))
+        self.closed.add(element)
+
+
+def stream_latex_with_images(source, output, class_to_replace, cache_path, image_path,
+                             chunk_depth=2, batch_size=100, encoding=None, **kwargs):
+    """
+    Replace the equations of the HTML document source with images, writing it to output.
+
+    Parameters:
+    source:           A file name or a file opened for reading in binary mode
+    output:           A file opened for writing in binary mode, the HTML is written to it
+                      encoded as UTF-8
+    class_to_replace: This is the class to look out for, whose latex content will be replace
+                      by an image
+    cache_path:       This is the path where the images will be saved
+    image_path:       This is the host part of the url for the image
+    chunk_depth:      The depth of the elements that are kept whole, counting the html
+                      element as depth 0, so that the children of body are kept by default
+    batch_size:       The number of chunks whose equations are rendered together
+    encoding:         The encoding of source, if it is not declared in the document
+
+    The other keyword arguments are those of replace_latex_with_images for the equations,
+    workers, densities, output_format, report, timeout and atlas. Figures are not replaced,
+    so figures and page_width_px raise TypeError like any other argument.
+    """
+    unknown = sorted(set(kwargs).difference(EQUATION_OPTIONS))
+    if unknown:
+        raise TypeError('stream_latex_with_images() got unexpected keyword arguments %s, '
+                        'it only replaces equations.' % ', '.join(unknown))
+    if chunk_depth < 1:
+        raise ValueError('chunk_depth must be at least 1, not %r.' % chunk_depth)
+    report = kwargs.get('report')
+    if report is not None:
+        report.add_document()
+
+    def replace(equations):
+        replace_equations(equations, cache_path, image_path, **kwargs)
+
+    writer = _Writer(output, class_to_replace, replace)
+    depth = -1
+    # the depth of the chunk being parsed
+    chunk = None
+    for event, element in etree.iterparse(source, events=('start', 'end'), html=True,
+                                          encoding=encoding):
+        if event == 'start':
+            depth += 1
+            if chunk is not None:
+                continue
+            if depth == 0:
+                doctype = element.getroottree().docinfo.doctype
+                if doctype:
+                    output.write(doctype.encode('utf-8') + '\n')
+                continue
+            parent = element.getparent()
+            writer.open(parent)
+            if depth == chunk_depth or element.get('class') == class_to_replace:
+                # an equation above chunk_depth is kept whole as well
+                chunk = depth
+                if len(writer.pending) >= batch_size:
+                    writer.flush_children(parent, until=element)
+            else:
+                writer.flush_children(parent, until=element)
+        else:
+            if depth == chunk:
+                writer.add(element)
+                chunk = None
+            elif chunk is None:
+                writer.close(element)
+            depth -= 1
@@ -10,6 +10,8 @@ def repair_equations(html):
     Some images have nested math environments i.e. $\(\text{blah}\)$, remove the inner math
     delimiters.
     """
+    if '&#' not in html and '&amp;#' not in html:
+        return html
     htmlparser = HTMLParser.HTMLParser()
     html = html.replace('&amp;#', '&#')
     entities = re.findall('&#.*?;', html)
@@ -2,43 +2,140 @@
 
 from __future__ import print_function
 import logging
-import docker
 import errno
 import hashlib
 import lxml
 import os
+import re
 import shutil
-import sys
 import tempfile
-import time
-import subprocess
-
-from termcolor import colored
+import threading
+from multiprocessing.pool import ThreadPool
 
 from preambles import PsPicture_preamble, tikz_preamble, equation_preamble
 from pstikz2png import tikzpicture2png, pspicture2png
+from atlas import atlas_style, page_atlas
+from backends import WORKER_DIED_STATUS, execute, get_backend
 from equation2png import equation2png
+from cache import get_cache, render_fingerprint
+from formats import get_format
+from inflight import in_flight
+import metrics
+from metrics import timed
+from normalise import Normaliser
+from postprocess import active_steps, postprocess_png, trim_boxes
+from rasterisers import COMMAND_RASTERISERS, IN_PROCESS_RASTERISERS, rasteriser_order
+from scratch import scratch_dir
 from utils import copy_if_newer, unescape, cleanup_code, unicode_replacements
 
 log = logging.getLogger(__name__)
 
+# The result of replacing &amp; then &gt; then &lt;, where &amp;gt; becomes > because the
+# & left by the first replacement forms &gt; with the text after it.
+_entity_normaliser = Normaliser([('&amp;gt;', '>'), ('&amp;lt;', '<'), ('&amp;', '&'),
+                                 ('&gt;', '>'), ('&lt;', '<')])
+
+# the function preparing the code and the preamble function for every picture type
+PIPELINES = {
+    'pspicture': (pspicture2png, PsPicture_preamble),
+    'tikzpicture': (tikzpicture2png, tikz_preamble),
+    'equation': (equation2png, equation_preamble),
+}
+
+
+# seconds a single latex or convert process may run for before it is killed
+LATEX_TIMEOUT = 30
+# exit status of processes killed by timeout
+TIMEOUT_STATUS = 124
+# exit status of commands that are not installed
+COMMAND_NOT_FOUND_STATUS = 127
+# exit status of commands that are installed but cannot be run
+COMMAND_NOT_EXECUTABLE_STATUS = 126
+# the kinds of failure that depend on the source alone, which are recorded in the cache,
+# timeouts, dead workers and broken environments are not as the host may cause them
+CACHED_FAILURES = ('compile', 'preprocess')
+
+# the resolution of the 1x images of equations, 150 dpi at the CSS font-size of 1.25em
+EQUATION_DPI = 150 * 1.25
+
+# the points in a unit of the width and height of an SVG image, user units are CSS pixels
+SVG_UNIT_POINTS = {'pt': 1.0, 'bp': 1.0, 'px': 0.75, '': 0.75, 'in': 72.0, 'cm': 72 / 2.54,
+                   'mm': 72 / 25.4, 'pc': 12.0}
+_svg_length_regex = re.compile(r'^\s*([0-9]*\.?[0-9]+)\s*(pt|bp|px|in|cm|mm|pc|)\s*$')
+
+# the rendering of the figures of documents: the resolution of their 1x images if the page
+# width does not decide it, and the figures of the type rendered at the same time
+FIGURE_POLICIES = {
+    'tikzpicture': {'dpi': 150, 'workers': 2},
+    'pspicture': {'dpi': 150, 'workers': 2},
+}
 
-def execute(args, cwd=None, shell=False):
-    p = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell)
-    stdout, stderr = p.communicate()
-    return stdout, stderr
+# the class or tag of figure elements to their picture type, for replace_latex_with_images
+FIGURE_TYPES = {
+    'tikzpicture': 'tikzpicture',
+    'pspicture': 'pspicture',
+}
+
+# the CSS width of a figure element as a percentage of the page
+_style_width_regex = re.compile(r'(?:^|;)\s*width\s*:\s*([0-9.]+)%')
 
 
 class LatexPictureError(Exception):
-    """Special Error around generating a Latex image."""
+    """
+    Special Error around generating a Latex image.
+
+    kind is the kind of failure counted by metrics.failure: compile, timeout, worker,
+    environment, rasterise or preprocess. log is the excerpt of the LaTeX log with the errors.
+    """
+
+    def __init__(self, message, kind='compile', log=''):
+        Exception.__init__(self, message)
+        self.kind = kind
+        self.log = log
+
+
+def prepare_code(picture_element):
+    """
+    Return the latex code to be inserted into a preamble.
+
+    picture_element can be the raw string code or a <pre> element with a <code> child.
+    """
+    if isinstance(picture_element, (str, unicode)):
+        code = picture_element
+        code = cleanup_code(code)
+    else:
+        code = picture_element.find('.//code').text.encode('utf-8')
+    code = _entity_normaliser(code)
+
+    if not code:
+        raise ValueError("Code cannot be empty.")
+
+    return code.strip()
+
+
+def write_latex(latex_path, preamble, code):
+    """Write the preamble with code substituted for __CODE__ to latex_path."""
+    with open(latex_path, 'wt') as fp:
+        temp = unescape(preamble.replace('__CODE__', code))
+        try:
+            fp.write(temp)
+        except UnicodeEncodeError:
+            fp.write(temp.encode('utf-8'))
+
 
-    pass
+def pdflatex_command(latex_path, output_dir, fmt=None):
+    """Return the pdflatex command line, using the precompiled format fmt if given."""
+    command = ['pdflatex', '-shell-escape', '-halt-on-error', '-output-directory=' + output_dir]
+    if fmt is not None:
+        command.append('-fmt=' + fmt)
+    command.append(latex_path)
+    return command
 
 
 def latex2png(picture_element, preamble, container, return_eps=False, page_width_px=None, dpi=150,
-              included_files={}, pdflatexpath=None):
+              included_files={}, pdflatexpath=None, timeout=LATEX_TIMEOUT, output_format='png'):
     """
-    Create a PNG image from latex.
+    Create a PNG or SVG image from latex.
 
     Inputs:
 
@@ -47,6 +144,8 @@ def latex2png(picture_element, preamble, container, return_eps=False, page_width
       preamble - which preamble to use, one of PsPicture_preamble, tikzpicture_preamble
       or equation_preamble
 
+      container - the backend, or docker container, that runs latex and convert
+
       return_eps - whether to also return the intermediate EPS file
 
       page_width_px - page width in pixels, used to scale the
@@ -56,32 +155,94 @@ def latex2png(picture_element, preamble, container, return_eps=False, page_width
         the page width was not set (or the page width in pixels was not
         passed as an argument).
 
+      timeout - seconds after which the latex and convert processes are killed.
+
+      output_format - png, or svg for a vector image sized as the PNG at dpi is shown.
+
     Outputs:
 
-    One or two paths, the first to the PNG, the second to the EPS.
+    One or two paths, the first to the PNG or SVG, the second to the EPS.
     """
-    temp_dir = tempfile.mkdtemp()
-    latex_path = os.path.join(temp_dir, 'figure.tex')
-    png_path = os.path.join(temp_dir, 'figure.png')
+    pdf_path = latex2pdf(picture_element, preamble, container, included_files, timeout)
+    if output_format == 'svg':
+        return pdf2svg(pdf_path, container, timeout=timeout, dpi=dpi)
+    fraction = None if isinstance(picture_element, basestring) else \
+        style_width(picture_element.get('style'))
+    if page_width_px and fraction:
+        dpi = PageWidthDpi(fraction, page_width_px, dpi).resolve(pdf_path, container, timeout)
+    # crop the pdf image too
+    # execute(['pdfcrop', '--margins', '1', pdfPath, pdfPath])
+    png_path, = pdf2png(pdf_path, [dpi], container, timeout=timeout)[0]
+    return png_path
+
+
+def latex2pdf(picture_element, preamble, container, included_files={}, timeout=LATEX_TIMEOUT,
+              temp_dir=None):
+    """
+    Compile latex to figure.pdf in temp_dir, or a new temporary directory, and return its path.
+
+    The other inputs are those of latex2png. fontspec needs XeTeX or LuaTeX and is left out of
+    the preamble.
+    """
+    if temp_dir is None:
+        temp_dir = tempfile.mkdtemp()
+    preamble = without_fontspec(preamble)
+    latex_path, code = _write_sources(picture_element, preamble, temp_dir, included_files)
     pdf_path = os.path.join(temp_dir, 'figure.pdf')
 
-    # can send the raw string code or a <pre> element with <code> child
-    if isinstance(picture_element, (str, unicode)):
-        code = picture_element
-        code = cleanup_code(code)
-    else:
-        code = picture_element.find('.//code').text.encode('utf-8')
-    code = code.replace(r'&amp;', '&').replace(r'&gt;', '>').replace(r'&lt;', '<')
+    command = pdflatex_command(latex_path, temp_dir, get_format(preamble, container))
+    with timed('compile'):
+        exit_code = run_with_timeout(container, command, timeout)
+    if exit_code != 0 or not os.path.exists(pdf_path):
+        raise compile_error(latex_path, preamble.replace('__CODE__', code), exit_code, timeout)
 
-    if not code:
-        raise ValueError("Code cannot be empty.")
+    return pdf_path
 
-    with open(latex_path, 'wt') as fp:
-        temp = unescape(preamble.replace('__CODE__', code.strip()))
-        try:
-            fp.write(temp)
-        except UnicodeEncodeError:
-            fp.write(temp.encode('utf-8'))
+
+def latex2pdf_dvips(picture_element, preamble, container, included_files={},
+                    timeout=LATEX_TIMEOUT, temp_dir=None):
+    """
+    Compile latex to figure.pdf through DVI and PostScript, like latex2pdf.
+
+    PSTricks draws with PostScript specials that pdflatex cannot run, so the figure is
+    compiled to DVI against a DVI format of the preamble, turned into EPS by dvips and into
+    PDF by ps2pdf. fontspec needs XeTeX or LuaTeX and is left out of the preamble.
+    """
+    if temp_dir is None:
+        temp_dir = tempfile.mkdtemp()
+    preamble = without_fontspec(preamble)
+    latex_path, code = _write_sources(picture_element, preamble, temp_dir, included_files)
+    dvi_path = os.path.join(temp_dir, 'figure.dvi')
+    eps_path = os.path.join(temp_dir, 'figure.eps')
+    pdf_path = os.path.join(temp_dir, 'figure.pdf')
+
+    command = pdflatex_command(latex_path, temp_dir, get_format(preamble, container, dvi=True))
+    command.insert(1, '-output-format=dvi')
+    with timed('compile'):
+        exit_code = run_with_timeout(container, command, timeout)
+        if exit_code != 0 or not os.path.exists(dvi_path):
+            raise compile_error(latex_path, preamble.replace('__CODE__', code), exit_code,
+                                timeout)
+        for command in [['dvips', '-q', '-E', '-o', eps_path, dvi_path],
+                        ['ps2pdf', '-dEPSCrop', eps_path, pdf_path]]:
+            exit_code = run_with_timeout(container, command, timeout)
+            if exit_code != 0:
+                raise LatexPictureError('%s failed with status %i for %s' % (
+                    command[0], exit_code, latex_path), failure_kind(exit_code))
+    return pdf_path
+
+
+def without_fontspec(preamble):
+    """Return preamble without fontspec, which pdflatex cannot load."""
+    return preamble.replace(r'\usepackage{fontspec}', '')
+
+
+def _write_sources(picture_element, preamble, temp_dir, included_files):
+    """Write figure.tex and the included files to temp_dir, return its path and the code."""
+    latex_path = os.path.join(temp_dir, 'figure.tex')
+    with timed('preprocess'):
+        code = prepare_code(picture_element)
+        write_latex(latex_path, preamble, code)
 
     for path, path_file in included_files.iteritems():
         try:
@@ -91,38 +252,239 @@ def latex2png(picture_element, preamble, container, return_eps=False, page_width
             pass
         with open(os.path.join(temp_dir, path), 'wb') as fp:
             fp.write(path_file.read())
+    return latex_path, code
+
+
+# the function compiling every picture type to PDF, if it is not latex2pdf
+COMPILERS = {
+    'pspicture': latex2pdf_dvips,
+}
+
+
+class PageWidthDpi(object):
+    """
+    The resolution that renders a figure at a fraction of the width of the page.
+
+    It depends on the natural width of the figure, so it is resolved once the PDF exists.
+    Figures whose width cannot be found are rendered at fallback_dpi.
+    """
+
+    def __init__(self, fraction, page_width_px, fallback_dpi):
+        self.fraction = fraction
+        self.page_width_px = page_width_px
+        self.fallback_dpi = fallback_dpi
+
+    def __str__(self):
+        # part of the names of the images
+        return 'width=%r;page=%r;fallback=%r' % (self.fraction, self.page_width_px,
+                                                 self.fallback_dpi)
+
+    def resolve(self, pdf_path, container, timeout=LATEX_TIMEOUT):
+        """Return the resolution of the figure compiled to pdf_path."""
+        width = pdf_width(pdf_path, container, timeout)
+        if not width:
+            return self.fallback_dpi
+        return self.page_width_px * self.fraction * 72.0 / width
+
+
+def pdf_width(pdf_path, container, timeout=LATEX_TIMEOUT):
+    """Return the width of the first page of pdf_path in points, or None if it is unknown."""
+    if timeout:
+        command = ['timeout', str(timeout), 'pdfinfo', pdf_path]
+    else:
+        command = ['pdfinfo', pdf_path]
+    exit_code, output = container.exec_run(command, stdout=True, stderr=False)
+    match = re.search(r'Page size:\s*([0-9.]+) x', output or '') if exit_code == 0 else None
+    return float(match.group(1)) if match else None
+
+
+def style_width(style):
+    """Return the CSS width percentage of a style attribute as a fraction, or None."""
+    match = _style_width_regex.search(style or '')
+    return float(match.group(1)) / 100 if match else None
 
-    command = ['pdflatex', '-shell-escape', '-halt-on-error', '-output-directory=' + temp_dir,
-               latex_path]
-    container.exec_run(command, stdout=False, stderr=False)
-    wait_for_file(pdf_path)
 
+def pdf2png(pdf_path, dpis, container, pages=1, timeout=LATEX_TIMEOUT):
+    """
+    Rasterise every page of pdf_path at every dpi.
+
+    The PNG files are written next to the PDF by the first of the rasterisers that is
+    installed on the backend, and post-processed if that is enabled, trimming the images of
+    a page at every dpi to the same box. Returns a list with, for every dpi, the list of the
+    paths of the PNG files of the pages.
+    """
+    with timed('rasterise'):
+        outputs = _pdf2png(pdf_path, dpis, container, pages, timeout)
+    trim = 'trim' in active_steps()
+    for paths in zip(*outputs):
+        boxes = trim_boxes(paths, dpis) if trim else [None] * len(paths)
+        for path, box in zip(paths, boxes):
+            postprocess_png(path, box=box)
+    return outputs
+
+
+def _pdf2png(pdf_path, dpis, container, pages, timeout):
+    base = os.path.splitext(pdf_path)[0]
+    # remember the rasterisers that are not installed, per backend
+    unavailable = getattr(container, 'unavailable_rasterisers', set())
+    for name in rasteriser_order():
+        if name in unavailable:
+            continue
+        if name in IN_PROCESS_RASTERISERS:
+            try:
+                return IN_PROCESS_RASTERISERS[name](pdf_path, dpis, pages, base)
+            except (RuntimeError, EnvironmentError, ValueError) as error:
+                raise LatexPictureError("Could not convert %s to png, %s failed: %s" % (
+                    pdf_path, name, error), 'rasterise')
+
+        commands, outputs = COMMAND_RASTERISERS[name](pdf_path, dpis, pages, base)
+        for command in commands:
+            exit_code = run_with_timeout(container, command, timeout * pages)
+            if exit_code != 0:
+                break
+        if exit_code == COMMAND_NOT_FOUND_STATUS and name != 'convert':
+            unavailable.add(name)
+            try:
+                container.unavailable_rasterisers = unavailable
+            except AttributeError:
+                pass
+            continue
+        if exit_code != 0:
+            raise LatexPictureError("Could not convert %s to png, %s exited with status %i" % (
+                pdf_path, name, exit_code), 'rasterise')
+        return outputs
+
+
+def pdf2svg(pdf_path, container, timeout=LATEX_TIMEOUT, dpi=None):
+    """
+    Convert pdf_path to an SVG file next to it and return its path.
+
+    pdf2svg is used if it is installed, otherwise dvisvgm. If dpi is given the SVG is sized
+    as the PNG at dpi is shown, see size_svg.
+    """
+    svg_path = os.path.splitext(pdf_path)[0] + '.svg'
+    with timed('rasterise'):
+        exit_code = run_with_timeout(container, ['pdf2svg', pdf_path, svg_path], timeout)
+        if exit_code == COMMAND_NOT_FOUND_STATUS:
+            exit_code = run_with_timeout(
+                container, ['dvisvgm', '--pdf', '--no-fonts', '--output=' + svg_path, pdf_path],
+                timeout)
+    if exit_code != 0:
+        raise LatexPictureError("Could not convert %s to svg, exit status %i" % (
+            pdf_path, exit_code), 'rasterise')
+    if dpi is not None:
+        size_svg(svg_path, dpi)
+    return svg_path
+
+
+def size_svg(svg_path, dpi):
+    """
+    Set the width and height of the SVG at svg_path to the CSS pixels of the PNG at dpi.
+
+    pdf2svg and dvisvgm give the size in points, which browsers show at 96 dpi, about half
+    the size of the PNG images of equations, shown at a pixel per CSS pixel. The drawing
+    is scaled by its viewBox, which is added if it is missing.
+    """
+    tree = lxml.etree.parse(svg_path)
+    root = tree.getroot()
+    points = []
+    for name in ('width', 'height'):
+        match = _svg_length_regex.match(root.get(name, ''))
+        if match is None:
+            log.warning('Not sizing %s, its %s is %r.', svg_path, name, root.get(name))
+            return
+        points.append(float(match.group(1)) * SVG_UNIT_POINTS[match.group(2)])
+    if root.get('viewBox') is None:
+        root.set('viewBox', '0 0 %g %g' % tuple(point / 0.75 for point in points))
+    root.set('width', '%gpx' % (points[0] * dpi / 72.0))
+    root.set('height', '%gpx' % (points[1] * dpi / 72.0))
+    tree.write(svg_path, xml_declaration=True, encoding='utf-8')
+
+
+def display_dpi(pictype):
+    """Return the resolution of the 1x PNG images of pictype, shown a pixel per CSS pixel."""
+    if pictype == 'equation':
+        return EQUATION_DPI
+    return FIGURE_POLICIES[pictype]['dpi']
+
+
+def run_with_timeout(backend, command, timeout=LATEX_TIMEOUT):
+    """
+    Run command on the backend, wait for it to finish and return its exit status.
+
+    The command is killed after timeout seconds, in which case the status is 124.
+    """
+    if timeout:
+        command = ['timeout', str(timeout)] + command
+    exit_code, _ = backend.exec_run(command, stdout=False, stderr=False)
+    return exit_code
+
+
+def log_excerpt(log_path, context=2):
+    """Return the error lines, with context lines after each, from a LaTeX log file."""
     try:
-        open(pdf_path, "rb")
+        with open(log_path) as fp:
+            lines = fp.read().splitlines()
     except IOError:
-        raise LatexPictureError(
-            "LaTeX failed to compile the image. %s \n%s" % (
-                latex_path, preamble.replace('__CODE__', code.strip())))
+        return ''
 
-    # crop the pdf image too
-    # execute(['pdfcrop', '--margins', '1', pdfPath, pdfPath])
-    container.exec_run(['convert', '-density', '%i' % dpi, pdf_path, png_path])
+    excerpt = []
+    for index, line in enumerate(lines):
+        if line.startswith('!'):
+            excerpt.extend(lines[index:index + context + 1])
+    return '\n'.join(excerpt)
 
-    return png_path
+
+def failure_kind(exit_code, excerpt=''):
+    """
+    Return the kind of failure of a compile command that exited with exit_code.
+
+    excerpt is the log_excerpt of the compile. Only a failure with TeX errors in its log is a
+    compile failure, one without them is caused by the environment, such as a missing
+    pdflatex or format file.
+    """
+    if exit_code == TIMEOUT_STATUS:
+        return 'timeout'
+    if exit_code == WORKER_DIED_STATUS:
+        return 'worker'
+    if exit_code in (COMMAND_NOT_FOUND_STATUS, COMMAND_NOT_EXECUTABLE_STATUS) or not excerpt:
+        return 'environment'
+    return 'compile'
+
+
+def compile_error(latex_path, latex, exit_code, timeout=LATEX_TIMEOUT):
+    """Return the LatexPictureError for a failed compile of latex_path."""
+    excerpt = log_excerpt(os.path.splitext(latex_path)[0] + '.log')
+    kind = failure_kind(exit_code, excerpt)
+    if kind == 'timeout':
+        reason = "LaTeX timed out after %s seconds." % timeout
+    elif kind == 'worker':
+        reason = "The render worker died while LaTeX was compiling the image."
+    elif kind == 'environment':
+        reason = "LaTeX could not be run (exit code %s) or logged no errors." % exit_code
+    else:
+        reason = "LaTeX failed to compile the image."
+    return LatexPictureError("%s %s \n%s\n%s" % (reason, latex_path, excerpt, latex), kind,
+                             excerpt or reason)
 
 
-def wait_for_file(file_path, timeout=3, interval=0.1):
-    '''
-    Wait for file to be generated, up to the max timeout and checking every interval.
-    Note: used for docker exec_run, because binding to stdout and stderr creates too much
-    overhead compared to running the latex conversion locally.
-    '''
-    time_counter = 0
-    while not os.path.exists(file_path):
-        time.sleep(interval)
-        time_counter += interval
-        if time_counter > timeout:
-            break
+def cached_failure(cache, name, fingerprint):
+    """Return the LatexPictureError of the failure recorded in cache for name, or None."""
+    failure = cache.lookup_failure(name, fingerprint)
+    if failure is None:
+        return None
+    kind, log = failure
+    metrics.increment('cached_failures')
+    return LatexPictureError("The render failed before and is not attempted again.\n%s" % log,
+                             kind, log)
+
+
+def store_failure(cache, name, fingerprint, source, error):
+    """Count the failure error to render source to name and record it in cache if it lasts."""
+    metrics.failure(error.kind, unicode(error))
+    if error.kind in CACHED_FAILURES:
+        cache.store_failure(name, fingerprint, error.kind, source,
+                            error.log or unicode(error).split('\n')[0])
 
 
 def cleanup_after_latex(figpath):
@@ -135,67 +497,419 @@ def cleanup_after_latex(figpath):
             raise  # re-raise exception
 
 
-def run_latex(pictype, codehash, codetext, cachepath, dpi=300, pdflatexpath=None):
-    """Run the image generation for pstricks and tikz images."""
-    # try and find pdflatex
-    if pdflatexpath is None:
-        path = os.environ.get('LATEX_PATH', os.environ.get('PATH'))
-        texpath = [p for p in path.split(':') if 'tex' in p]
-        if texpath:
-            pdflatexpath = texpath[0] + '/pdflatex'
-        else:
-            # no custom latex installed. Try /usr/local/bin and /usr/local
-            for path in ['/usr/local/bin/', '/usr/bin/']:
-                texpath = os.path.join(path, 'pdflatex')
-                if os.path.exists(texpath):
-                    pdflatexpath = texpath
-                    break
+def run_latex(pictype, codehash, codetext, cachepath, dpi=300, pdflatexpath=None,
+              timeout=LATEX_TIMEOUT, backend=None, output_format='png'):
+    """
+    Run the image generation for pstricks and tikz images.
+
+    The render runs on backend, or the backend of the process if it is not given. The
+    location of pdflatex is decided by the local backend, pdflatexpath is ignored. With
+    output_format svg the image is saved as codehash.svg and dpi is not used, it is sized
+    as the 1x PNG images of pictype are shown, see display_dpi.
+    """
+    return render_images(pictype, codetext, cachepath, [(codehash, dpi)], timeout=timeout,
+                         backend=backend, output_format=output_format)[0]
+
 
+def render_images(pictype, codetext, cachepath, images, timeout=LATEX_TIMEOUT, backend=None,
+                  output_format='png'):
+    """
+    Render codetext once and rasterise it at several resolutions.
+
+    The PDF is cached under source_hash(pictype, codetext), which does not depend on the
+    resolution, and every missing image is rasterised from it with pdf2png. An image of a
+    new resolution therefore does not compile the latex again. Threads rendering the same
+    codetext into the same cache at the same time share a single render.
+
+    Parameters:
+    pictype:   One of pspicture, tikzpicture or equation
+    codetext:  The latex code
+    cachepath: This is the path where the images will be saved
+    images:    A list of (codehash, dpi) pairs, the image at dpi is saved as codehash.png
+    timeout:   Seconds after which the latex and convert processes are killed
+    backend:   The backend to render with, the backend of the process if not given
+    output_format: png, or svg to save the images as codehash.svg. SVG images do not
+                   depend on the dpi, they are sized as the 1x PNG images of pictype
+                   are shown, see display_dpi.
+
+    Returns the list of the image cache paths, with None for images that failed.
+    """
+    convert, preamble_function = PIPELINES[pictype]
+    compile_pdf = COMPILERS.get(pictype, latex2pdf)
+    preamble = preamble_function()
+    if backend is None:
+        backend = get_backend()
+    cache = get_cache(cachepath)
+    # the TeX version recorded in the cache is only checked if something must be rendered
+    fingerprint = render_fingerprint(preamble, backend, cache, verify=False)
+
+    extension = '.' + output_format
     # copy to local image cache in .bookbuilder/images
-    image_cache_path = os.path.join(cachepath, codehash + '.png')
-    rendered = False
+    image_cache_paths = [os.path.join(cachepath, codehash + extension) for codehash, _ in images]
+
+    def find_missing(fingerprint):
+        return [(codehash, dpi) for codehash, dpi in images
+                if not cache.lookup(codehash + extension, fingerprint)]
+
     # skip image generation if it exists
-    if os.path.exists(image_cache_path):
-        rendered = True
-        sys.stdout.write('s')
-
-    client = docker.from_env()
-    container = client.containers.get('latex')
-
-    if not rendered:
-        sys.stdout.write('.')
-        if pictype == 'pspicture':
-            latex_code = pspicture2png(codetext)
-            preamble = PsPicture_preamble()
-        elif pictype == 'tikzpicture':
-            latex_code = tikzpicture2png(codetext)
-            preamble = tikz_preamble()
-        elif pictype == 'equation':
-            latex_code = equation2png(codetext)
-            preamble = equation_preamble()
+    if not find_missing(fingerprint):
+        metrics.increment('cache_hits', len(images))
+        return image_cache_paths
+
+    pdf_name = source_hash(pictype, codetext) + '.pdf'
+    with in_flight(cache.path(pdf_name)):
+        # a thread rendering the same code may have stored the images in the meantime
+        fingerprint = render_fingerprint(preamble, backend, cache)
+        missing = find_missing(fingerprint)
+        metrics.increment('cache_hits', len(images) - len(missing))
+        if missing:
+            metrics.increment('cache_misses', len(missing))
+            if not _render_missing(convert, compile_pdf, preamble, codetext, cache, pdf_name,
+                                   fingerprint, missing, extension, backend, timeout,
+                                   output_format, display_dpi(pictype)):
+                image_cache_paths = [None] * len(images)
+    return image_cache_paths
+
+
+def _render_missing(convert, compile_pdf, preamble, codetext, cache, pdf_name, fingerprint,
+                    missing, extension, backend, timeout, output_format, svg_dpi):
+    """Render the missing (codehash, dpi) images of render_images, return False on failure."""
+    cached_pdf = cache.lookup(pdf_name, fingerprint)
+    if not cached_pdf and cached_failure(cache, pdf_name, fingerprint):
+        return False
+    with scratch_dir(backend) as temp_dir:
+        pdf_path = os.path.join(temp_dir, 'figure.pdf')
+        # whether pdf_path was compiled completely, a failed compile may leave part of it
+        compiled = False
         try:
-            figpath = latex2png(latex_code, preamble, container, dpi=dpi, pdflatexpath=pdflatexpath)
+            if cached_pdf:
+                # rasterise in the scratch directory, the cache may not be visible to the
+                # backend
+                link_or_copy(cached_pdf, pdf_path)
+            else:
+                with timed('preprocess'):
+                    latex_code = convert(codetext)
+                try:
+                    compile_pdf(latex_code, preamble, backend, timeout=timeout,
+                                temp_dir=temp_dir)
+                except ValueError as error:
+                    # prepare_code rejects empty code
+                    raise LatexPictureError(unicode(error), 'preprocess')
+                compiled = True
+            if output_format == 'svg':
+                outputs = [[pdf2svg(pdf_path, backend, timeout=timeout, dpi=svg_dpi)]] * \
+                    len(missing)
+            else:
+                dpis = [dpi.resolve(pdf_path, backend, timeout)
+                        if isinstance(dpi, PageWidthDpi) else dpi for _, dpi in missing]
+                outputs = pdf2png(pdf_path, dpis, backend, timeout=timeout)
         except LatexPictureError as lpe:
-            sys.stdout.write(colored("\nLaTeX failure", "red"))
-            sys.stdout.write(unicode(lpe))
-            return None
-
-        if figpath:
-            # done. copy to image cache
-            copy_if_newer(figpath, image_cache_path)
-            # copy the pdf also but run pdfcrop first
-            copy_if_newer(figpath.replace('.png', '.pdf'),
-                          image_cache_path.replace('.png', '.pdf'))
-
-            cleanup_after_latex(figpath)
+            if compiled:
+                # the images can be rasterised from it again
+                cache.store(pdf_path, pdf_name, fingerprint, move=True)
+            store_failure(cache, pdf_name, fingerprint, codetext, lpe)
+            return False
+
+        # done. move to image cache
+        for (codehash, _), (output_path,) in zip(missing, outputs):
+            cache.store(output_path, codehash + extension, fingerprint, move=True)
+        if not cached_pdf:
+            cache.store(pdf_path, pdf_name, fingerprint, move=True)
+    return True
+
+
+def link_or_copy(src, dst):
+    """Link dst to the file src, or copy it if src is on another file system."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def source_hash(pictype, codetext):
+    """Return the md5 hash used to name the cached PDF of codetext, for any resolution."""
+    return hashlib.md5('type=' + pictype + ';' + codetext).hexdigest()
+
+
+def equation_hash(latex, dpi, output_format='png'):
+    """Return the md5 hash used to name the cached image of an equation at dpi."""
+    if output_format != 'png':
+        return hashlib.md5('format=' + output_format + ';' + latex).hexdigest()
+    return hashlib.md5('dpi=' + str(dpi) + ';' + latex).hexdigest()
+
+
+def figure_hash(pictype, code, dpi, output_format='png'):
+    """Return the md5 hash used to name the cached image of a figure at dpi."""
+    if output_format != 'png':
+        dpi = 'format=' + output_format
+    return hashlib.md5('type=%s;dpi=%s;%s' % (pictype, dpi, code)).hexdigest()
+
+
+def shard_of(codehash, shards):
+    """Return the shard, from 0 to shards - 1, that renders the image named codehash."""
+    return int(codehash, 16) % shards
+
+
+def batch_preamble():
+    """Return the equation preamble with every standalone environment on its own page."""
+    return equation_preamble().replace('border=1bp]', 'border=1bp, multi]', 1)
+
+
+def render_equations_batch(equations, dpis, cache_path, batch_size=100, timeout=LATEX_TIMEOUT,
+                           backend=None):
+    """
+    Render many equations with a single pdflatex run per batch.
+
+    The uncached equations are put into one multi-page standalone document, compiled once
+    and the pages are split into the same md5-named PNG and PDF files in cache_path that
+    render_images creates. If a batch fails to compile it is bisected until the equations that
+    cause the failure are isolated.
+
+    Parameters:
+    equations:  Equation latex, as passed to run_latex.
+    dpis:       The resolutions at which every equation must be rendered.
+    cache_path: This is the path where the images will be saved
+    batch_size: The maximum number of equations to compile in one pdflatex run.
+    timeout:    Seconds allowed per equation in a batch before pdflatex is killed.
+    backend:    The backend to render with, the backend of the process if not given.
+
+    Returns a dictionary mapping every equation to a dictionary of dpi to image cache path,
+    or to the LatexPictureError raised for that equation if it failed to compile.
+    """
+    if backend is None:
+        backend = get_backend()
+    cache = get_cache(cache_path)
+    preamble = equation_preamble()
+    fingerprint = render_fingerprint(preamble, backend, cache, verify=False)
+
+    def find_pending(fingerprint):
+        return [latex for latex in distinct
+                if not all(cache.lookup(equation_hash(latex, dpi) + '.png', fingerprint)
+                           for dpi in dpis)]
+
+    results = {}
+    distinct = []
+    for latex in equations:
+        if latex in results:
+            continue
+        distinct.append(latex)
+        results[latex] = dict(
+            (dpi, os.path.join(cache_path, equation_hash(latex, dpi) + '.png')) for dpi in dpis)
+    pending = find_pending(fingerprint)
+    if pending:
+        verified_fingerprint = render_fingerprint(preamble, backend, cache)
+        if verified_fingerprint != fingerprint:
+            fingerprint = verified_fingerprint
+            pending = find_pending(fingerprint)
+    metrics.increment('cache_hits', (len(results) - len(pending)) * len(dpis))
+
+    if pending:
+        pages = []
+        for latex in pending:
+            pdf_name = source_hash('equation', latex) + '.pdf'
+            error = cached_failure(cache, pdf_name, fingerprint)
+            if error is not None:
+                results[latex] = error
+                continue
+            try:
+                code = prepare_code(equation2png(latex))
+            except ValueError as error:
+                results[latex] = LatexPictureError(unicode(error), 'preprocess')
+                store_failure(cache, pdf_name, fingerprint, latex, results[latex])
+            else:
+                pages.append((latex, r'\begin{standalone}%s\end{standalone}' % code))
+        for start in range(0, len(pages), batch_size):
+            _render_batch(pages[start:start + batch_size], dpis, backend, cache, fingerprint,
+                          results, timeout)
+
+    return results
+
+
+def _render_batch(pages, dpis, backend, cache, fingerprint, results, timeout):
+    """
+    Render (equation, page code) pairs into cache.
+
+    The batch is bisected when it fails to compile so that only the failing equations get
+    a LatexPictureError. If the compiled batch cannot be split into pages all its equations
+    get the same 'rasterise' error, which is not cached.
+    """
+    preamble = batch_preamble()
+    with scratch_dir(backend) as temp_dir:
+        latex_path = os.path.join(temp_dir, 'figure.tex')
+        pdf_path = os.path.join(temp_dir, 'figure.pdf')
+        write_latex(latex_path, preamble, '\n'.join(code for _, code in pages))
+
+        command = pdflatex_command(latex_path, temp_dir, get_format(preamble, backend))
+        exit_code = run_with_timeout(backend, command, timeout * len(pages))
+        page_count = 0
+        if exit_code == 0 and os.path.exists(pdf_path):
+            split_code = run_with_timeout(backend, ['pdfseparate', pdf_path,
+                                                    os.path.join(temp_dir, 'page-%d.pdf')],
+                                          timeout)
+            if split_code != 0:
+                # the batch compiled, splitting it again will not help and the equations
+                # are not at fault
+                error = LatexPictureError("pdfseparate failed to split %s (exit code %s)." % (
+                    pdf_path, split_code), 'rasterise')
+                metrics.failure(error.kind, unicode(error))
+                for latex, _ in pages:
+                    results[latex] = error
+                return
+            while os.path.exists(os.path.join(temp_dir, 'page-%d.pdf' % (page_count + 1))):
+                page_count += 1
+
+        if page_count == len(pages):
+            _store_batch(pages, dpis, backend, cache, fingerprint, results, timeout, temp_dir)
+            return
+        # LaTeX failed or an equation did not produce exactly one page
+        if len(pages) == 1:
+            latex, code = pages[0]
+            results[latex] = compile_error(
+                latex_path, preamble.replace('__CODE__', code), exit_code, timeout)
+            store_failure(cache, source_hash('equation', latex) + '.pdf', fingerprint, latex,
+                          results[latex])
+            return
+    middle = len(pages) // 2
+    _render_batch(pages[:middle], dpis, backend, cache, fingerprint, results, timeout)
+    _render_batch(pages[middle:], dpis, backend, cache, fingerprint, results, timeout)
+
+
+def _store_batch(pages, dpis, backend, cache, fingerprint, results, timeout, temp_dir):
+    """Move the pages compiled by _render_batch into cache and rasterise them."""
+    for page, (latex, _) in enumerate(pages):
+        cache.store(os.path.join(temp_dir, 'page-%d.pdf' % (page + 1)),
+                    source_hash('equation', latex) + '.pdf', fingerprint, move=True)
+    try:
+        pngs = pdf2png(os.path.join(temp_dir, 'figure.pdf'), dpis, backend, pages=len(pages),
+                       timeout=timeout)
+    except LatexPictureError as lpe:
+        metrics.failure(lpe.kind, unicode(lpe))
+        for latex, _ in pages:
+            results[latex] = lpe
     else:
-        figpath = image_cache_path
+        for dpi, page_pngs in zip(dpis, pngs):
+            for (latex, _), png_path in zip(pages, page_pngs):
+                cache.store(png_path, equation_hash(latex, dpi) + '.png', fingerprint,
+                            move=True)
+        metrics.increment('cache_misses', len(pages) * len(dpis))
+
+
+def run_latex_jobs(jobs, cache_path, workers=None, backend=None, output_format='png',
+                   timeout=LATEX_TIMEOUT, pool=None):
+    """
+    Run render_images for every (pictype, codetext, images) job.
+
+    With more than one worker the jobs are run on a thread pool. Every render compiles in
+    its own temporary directory and the heavy lifting happens in the latex processes, so
+    threads are enough to keep all the cores busy. The jobs run on pool instead if it is
+    given, a ThreadPool shared with other callers that limits the renders of all of them,
+    whose workers are counted by its owner.
+    """
+    def run(job):
+        pictype, codetext, images = job
+        metrics.adjust('queue_depth', -1)
+        metrics.adjust('busy_workers', 1)
+        try:
+            return render_images(pictype, codetext, cache_path, images, timeout=timeout,
+                                 backend=backend, output_format=output_format)
+        finally:
+            metrics.adjust('busy_workers', -1)
+
+    if not jobs:
+        return []
+    if pool is not None:
+        metrics.adjust('queue_depth', len(jobs))
+        return pool.map(run, jobs, chunksize=1)
+    workers = min(workers or 1, len(jobs))
+    metrics.adjust('queue_depth', len(jobs))
+    metrics.adjust('workers', workers)
+    try:
+        if workers <= 1:
+            return [run(job) for job in jobs]
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(run, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        metrics.adjust('workers', -workers)
+
+
+# the equation text of an element and the densities and format mapped to the latex and images
+_equation_images = {}
+
+# the most equations remembered by equation_images before it starts over
+EQUATION_MEMO_SIZE = 100000
+
+
+def equation_images(text, densities, output_format):
+    """
+    Return the latex of the text of an equation element and its (codehash, dpi) images.
 
-    sys.stdout.flush()
-    return image_cache_path
+    The result is remembered, so that an equation seen before is not preprocessed again.
+    """
+    key = (text, densities, output_format)
+    try:
+        return _equation_images[key]
+    except KeyError:
+        pass
+    with timed('preprocess'):
+        latex = text.strip().encode('utf-8')
+        latex = unicode_replacements(latex)
+
+        images = [(equation_hash(latex, EQUATION_DPI * density, output_format),
+                   EQUATION_DPI * density) for density in densities]
+    if len(_equation_images) >= EQUATION_MEMO_SIZE:
+        _equation_images.clear()
+    result = _equation_images[key] = latex, images
+    return result
 
 
-def replace_latex_with_images(xml_dom, class_to_replace, cache_path, image_path):
+def figure_images(element, pictype, densities, output_format, page_width_px=None):
+    """
+    Return the code of a figure element and its (codehash, dpi) images.
+
+    The code is the text of the code element inside the figure, or of the figure itself.
+    The resolution is the one of FIGURE_POLICIES, unless page_width_px is given and the
+    figure has a CSS width in percent, in which case the image is as wide on the page.
+    """
+    with timed('preprocess'):
+        code_element = element.find('.//code')
+        if code_element is None:
+            code_element = element
+        code = ''.join(code_element.itertext()).strip()
+        if isinstance(code, unicode):
+            code = code.encode('utf-8')
+        fraction = style_width(element.get('style'))
+        base_dpi = FIGURE_POLICIES[pictype]['dpi']
+        images = []
+        for density in densities:
+            if page_width_px and fraction:
+                dpi = PageWidthDpi(fraction, page_width_px * density, base_dpi * density)
+            else:
+                dpi = base_dpi * density
+            images.append((figure_hash(pictype, code, dpi, output_format), dpi))
+    return code, images
+
+
+_lanes_lock = threading.Lock()
+# the picture type to the thread pool rendering its figures
+_lanes = {}
+
+
+def figure_lane(pictype):
+    """Return the thread pool rendering the figures of pictype, beside the equations."""
+    with _lanes_lock:
+        if pictype not in _lanes:
+            _lanes[pictype] = ThreadPool(FIGURE_POLICIES[pictype]['workers'])
+        return _lanes[pictype]
+
+
+def replace_latex_with_images(xml_dom, class_to_replace, cache_path, image_path, workers=None,
+                              densities=(1, 2), output_format='png', report=None,
+                              timeout=LATEX_TIMEOUT, figures=None, page_width_px=None,
+                              atlas=False):
     """
     Replace images in latex with actual image data rather than the source latex.
 
@@ -203,6 +917,11 @@ def replace_latex_with_images(xml_dom, class_to_replace, cache_path, image_path)
     then be modified to have a rendered image in place instead of a mathjax equation (which
     can't render on devices without javascript).
 
+    The work happens in three passes: the distinct images needed by the document are
+    collected, the ones that are not cached yet are rendered, and then the DOM is rewritten.
+    Every equation is compiled once and rasterised at all the densities. If all the images
+    are cached the backend is not used at all.
+
     Parameters:
     xml_dom:          This is an xml structure that, when rendered as a string, should produce an
                       HTML page
@@ -210,38 +929,149 @@ def replace_latex_with_images(xml_dom, class_to_replace, cache_path, image_path)
                       by an image
     cache_path:       This is the path where the images will be saved
     image_path:       This is the host part of the url for the image
+    workers:          The number of images to render concurrently, rendering serially if
+                      this is not given
+    densities:        The pixel densities of the images, the first is used for src and the
+                      others are listed in srcset
+    output_format:    png, or svg for a single vector image per equation, in which case
+                      densities is not used
+    report:           A BuildReport that counts the equations of the document, pass the same
+                      report for every document of a build
+    timeout:          Seconds after which the latex and convert processes are killed
+    figures:          A dictionary of the class or tag of figure elements to their picture
+                      type, tikzpicture or pspicture, e.g. FIGURE_TYPES. The figures are
+                      rendered on the lanes of their types while the equations render, and
+                      are replaced by images unless they fail
+    page_width_px:    The width of the page in pixels, figures with a CSS width in percent
+                      are rendered as wide on the page
+    atlas:            Pack the small PNG images of the equations of the document into an
+                      atlas per density, and show every equation as an inline block with
+                      its region of the atlas as its background, see atlas.py
     """
-    for equation in xml_dom.findall('.//*[@class="{}"]'.format(class_to_replace)):
+    if report is not None:
+        report.add_document()
+    pending = submit_figures(xml_dom, figures or {}, cache_path, densities, output_format,
+                             timeout, page_width_px)
+    replace_equations(xml_dom.findall('.//*[@class="{}"]'.format(class_to_replace)),
+                      cache_path, image_path, workers, densities, output_format, report,
+                      timeout, atlas)
+    insert_figures(pending, image_path, densities, output_format)
+    return xml_dom
+
+
+def submit_figures(xml_dom, figures, cache_path, densities=(1, 2), output_format='png',
+                   timeout=LATEX_TIMEOUT, page_width_px=None):
+    """
+    Start rendering the figures of xml_dom on their lanes.
+
+    Returns a list of (element, codehashes, result) for insert_figures, where result is
+    the asynchronous result of render_images.
+    """
+    if output_format == 'svg':
+        densities = (1,)
+    pending = []
+    seen = set()
+    for key, pictype in sorted(figures.items()):
+        elements = xml_dom.findall('.//*[@class="{}"]'.format(key)) + \
+            xml_dom.findall('.//{}'.format(key))
+        for element in elements:
+            if element in seen:
+                continue
+            seen.add(element)
+            code, images = figure_images(element, pictype, tuple(densities), output_format,
+                                         page_width_px)
+            result = figure_lane(pictype).apply_async(
+                render_images, (pictype, code, cache_path, images),
+                {'timeout': timeout, 'output_format': output_format})
+            pending.append((element, [codehash for codehash, _ in images], result))
+    return pending
+
+
+def insert_figures(pending, image_path, densities=(1, 2), output_format='png'):
+    """
+    Replace the figures started by submit_figures with their images once they are rendered.
+
+    The DOM is only changed here, in the calling thread, as lxml trees are not thread safe.
+    """
+    if output_format == 'svg':
+        densities = (1,)
+    extension = '.' + output_format
+    for element, codehashes, result in pending:
+        if not all(result.get()):
+            continue
+        for child in list(element):
+            element.remove(child)
+        element.text = ''
+        img = lxml.etree.SubElement(element, 'img')
+        img.attrib['src'] = '{}/{}{}'.format(image_path, codehashes[0], extension)
+        if len(densities) > 1:
+            img.attrib['srcset'] = ', '.join(
+                '{}/{}{} {:g}x'.format(image_path, codehash, extension, density)
+                for codehash, density in zip(codehashes[1:], densities[1:]))
+
+
+def replace_equations(elements, cache_path, image_path, workers=None, densities=(1, 2),
+                      output_format='png', report=None, timeout=LATEX_TIMEOUT, atlas=False):
+    """
+    Replace the latex of the equation elements with images.
+
+    See replace_latex_with_images for the parameters.
+    """
+    if output_format == 'svg':
+        densities = (1,)
+    densities = tuple(densities)
+    extension = '.' + output_format
+    cache = get_cache(cache_path)
+    fingerprint = render_fingerprint(equation_preamble(), get_backend(), cache, verify=False)
+    equations = []
+    latexes = []
+    jobs = []
+    members = []
+    seen = set()
+    for equation in elements:
         # strip any tags found inside this element
         while len(equation) > 0:
             child = equation[0]
             lxml.etree.strip_tags(equation, child.tag)
 
-        latex = equation.text.strip().encode('utf-8')
-        latex = unicode_replacements(latex)
-
-        # CSS font-size
-        font_size = 1.25
-        dpi = 150 * font_size
-        codehash_1x = hashlib.md5('dpi=' + str(dpi) + ';' + latex).hexdigest()
-        run_latex('equation', codehash_1x, latex, cache_path, dpi)
+        latex, images = equation_images(equation.text, densities, output_format)
+        latexes.append(latex)
+        if latex not in seen:
+            seen.add(latex)
+            members.append([codehash for codehash, _ in images])
+            if all(cache.lookup(codehash + extension, fingerprint) for codehash, _ in images):
+                metrics.increment('cache_hits', len(images))
+            else:
+                jobs.append(('equation', latex, images))
+        equations.append((equation, [codehash for codehash, _ in images]))
 
-        dpi *= 2
-        codehash_2x = hashlib.md5('dpi=' + str(dpi) + ';' + latex).hexdigest()
-        run_latex('equation', codehash_2x, latex, cache_path, dpi)
+    if report is not None:
+        report.add_equations(latexes, [latex for _, latex, _ in jobs])
+    run_latex_jobs(jobs, cache_path, workers, output_format=output_format, timeout=timeout)
+    layout = {'regions': {}}
+    if atlas and output_format == 'png' and members:
+        layout = page_atlas(cache, fingerprint, members, densities)
 
+    for equation, codehashes in equations:
         # imagepath contains contains the path the created image
         # put a new img element inside the parent element
         equation.text = ''
-        img = lxml.etree.Element('img')
-        img.attrib['src'] = '{}/{}.png'.format(image_path, codehash_1x)
-        img.attrib['srcset'] = '{}/{}.png 2x'.format(image_path, codehash_2x)
+        if codehashes[0] in layout['regions']:
+            img = lxml.etree.Element('span', {
+                'class': 'latex-atlas',
+                'style': atlas_style(layout, codehashes[0], image_path, densities)})
+        else:
+            img = lxml.etree.Element('img')
+            img.attrib['src'] = '{}/{}{}'.format(image_path, codehashes[0], extension)
+        if img.tag == 'img' and len(densities) > 1:
+            img.attrib['srcset'] = ', '.join(
+                '{}/{}{} {:g}x'.format(image_path, codehash, extension, density)
+                for codehash, density in zip(codehashes[1:], densities[1:]))
         if equation.tag == 'div' and not equation.xpath(
                 'ancestor::div[@class="response-query-body"]'):
             # images in the query must not be clickable
-            isolated_image_path = '{}/{}.png'.format(image_path, codehash_1x)
+            isolated_image_path = '{}/{}{}'.format(image_path, codehashes[0], extension)
             a_tag = lxml.etree.SubElement(equation, 'a', {'href': isolated_image_path})
             a_tag.append(img)
         else:
             equation.append(img)
-    return xml_dom
@@ -0,0 +1,38 @@
+"""
+Renders in progress, shared by the threads that ask for the same one.
+
+The first thread to ask for a key renders it while the others wait for it to finish, after
+which they find the result in the cache instead of rendering it again.
+"""
+import threading
+from contextlib import contextmanager
+
+from metrics import timed
+
+_lock = threading.Lock()
+# key -> [lock held by the rendering thread, number of threads holding or waiting for it]
+_renders = {}
+
+
+@contextmanager
+def in_flight(key):
+    """Run the body of the with statement for key in one thread at a time."""
+    with _lock:
+        entry = _renders.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+        busy = entry[1] > 1
+    try:
+        if busy:
+            with timed('wait'):
+                entry[0].acquire()
+        else:
+            entry[0].acquire()
+        try:
+            yield busy
+        finally:
+            entry[0].release()
+    finally:
+        with _lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _renders[key]
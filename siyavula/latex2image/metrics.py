@@ -0,0 +1,175 @@
+"""
+Instrumentation of rendering: stage timings, counters, gauges and hooks.
+
+The stages are preprocess, compile, rasterise, postprocess (of the PNG images), atlas
+(building the atlases of pages), copy (into the cache), cache (index lookups and updates)
+and wait (for a render of the same code in another thread). The counters are cache_hits
+and cache_misses, in images, bytes_written (copied) and bytes_moved (renamed) into the
+cache, bytes_saved by post-processing, failures by kind: compile, timeout, worker (a
+backend worker died), environment (LaTeX could not run), rasterise and preprocess, and
+cached_failures, the renders skipped because they failed before. The gauges are
+queue_depth, the render jobs waiting for a worker, and workers and busy_workers, whose
+ratio is the utilisation.
+
+Every event is passed to the hooks, callables taking (event, name, value) where event is
+stage, counter, gauge or failure, with the seconds, amount, delta or message as value. A
+failure also counts as a counter event of its kind. The progress hook, installed by
+default, writes an 's' per cache hit, a '.' per rendered image, an 'x' per render skipped
+because it failed before and the failures to stdout; remove it with remove_hook(progress)
+to render quietly. snapshot, dump_json and prometheus_text export the totals recorded so
+far.
+"""
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from termcolor import colored
+
+_lock = threading.Lock()
+_stages = {}
+# (name, kind) to the total, kind is None for counters without kinds
+_counters = {}
+_gauges = {}
+
+
+def progress(event, name, value):
+    """Write the progress of rendering to stdout."""
+    if event == 'counter' and name == 'cache_hits':
+        sys.stdout.write('s' * value)
+    elif event == 'counter' and name == 'cache_misses':
+        sys.stdout.write('.' * value)
+    elif event == 'counter' and name == 'cached_failures':
+        sys.stdout.write('x' * value)
+    elif event == 'failure':
+        sys.stdout.write(colored("\nLaTeX failure", "red"))
+        sys.stdout.write(value)
+    else:
+        return
+    sys.stdout.flush()
+
+
+_hooks = [progress]
+
+
+def add_hook(hook):
+    """Call hook(event, name, value) for every event."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Stop calling hook, which must have been added."""
+    _hooks.remove(hook)
+
+
+def _notify(event, name, value):
+    for hook in list(_hooks):
+        hook(event, name, value)
+
+
+def record(stage, seconds):
+    """Add seconds spent in stage."""
+    with _lock:
+        count, total = _stages.get(stage, (0, 0.0))
+        _stages[stage] = (count + 1, total + seconds)
+    if _hooks:
+        _notify('stage', stage, seconds)
+
+
+@contextmanager
+def timed(stage):
+    """Time the body of the with statement as a run of stage."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(stage, time.time() - start)
+
+
+def increment(counter, amount=1, kind=None):
+    """Add amount to counter, or to its kind if given."""
+    if not amount:
+        return
+    key = (counter, kind)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+    if _hooks:
+        _notify('counter', counter if kind is None else '%s.%s' % (counter, kind), amount)
+
+
+def adjust(gauge, delta):
+    """Add delta, which may be negative, to the current value of gauge."""
+    with _lock:
+        _gauges[gauge] = _gauges.get(gauge, 0) + delta
+    if _hooks:
+        _notify('gauge', gauge, delta)
+
+
+def failure(kind, message):
+    """Count a failed render of kind, with the message of its error."""
+    increment('failures', kind=kind)
+    if _hooks:
+        _notify('failure', kind, message)
+
+
+def stage_totals():
+    """Return a dictionary of stage to the number of runs and total seconds spent in it."""
+    with _lock:
+        return dict((stage, {'count': count, 'seconds': total})
+                    for stage, (count, total) in _stages.items())
+
+
+def snapshot():
+    """
+    Return the stage totals, counters and gauges as a dictionary.
+
+    A counter with kinds is a dictionary of kind to its total.
+    """
+    with _lock:
+        counters = {}
+        for (counter, kind), total in _counters.items():
+            if kind is None:
+                counters[counter] = total
+            else:
+                counters.setdefault(counter, {})[kind] = total
+        gauges = dict(_gauges)
+    return {'stages': stage_totals(), 'counters': counters, 'gauges': gauges}
+
+
+def dump_json():
+    """Return the snapshot as JSON."""
+    return json.dumps(snapshot(), sort_keys=True)
+
+
+def prometheus_text(prefix='latex2image'):
+    """Return the snapshot in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        stages = sorted(_stages.items())
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+    if stages:
+        for metric, kind, index in [('stage_seconds_total', 'counter', 1),
+                                    ('stage_runs_total', 'counter', 0)]:
+            lines.append('# TYPE %s_%s %s' % (prefix, metric, kind))
+            for stage, totals in stages:
+                lines.append('%s_%s{stage="%s"} %r' % (prefix, metric, stage, totals[index]))
+    typed = set()
+    for (counter, kind), total in counters:
+        if counter not in typed:
+            typed.add(counter)
+            lines.append('# TYPE %s_%s_total counter' % (prefix, counter))
+        labels = '' if kind is None else '{kind="%s"}' % kind
+        lines.append('%s_%s_total%s %r' % (prefix, counter, labels, total))
+    for gauge, value in gauges:
+        lines.append('# TYPE %s_%s gauge' % (prefix, gauge))
+        lines.append('%s_%s %r' % (prefix, gauge, value))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Forget the recorded timings and counters, the gauges are kept."""
+    with _lock:
+        _stages.clear()
+        _counters.clear()
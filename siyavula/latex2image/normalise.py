@@ -0,0 +1,65 @@
+"""
+Literal text replacements applied in a single pass.
+
+A Normaliser compiles its rules into one regular expression and replaces all the matches
+after a single split of the text, instead of scanning the whole text once per rule. At
+every position the longest matching pattern wins.
+
+Most texts contain none of the patterns of a Normaliser with few rules, and for short
+texts a regular expression costs more than a few substring tests, so such a Normaliser
+tests for its patterns first and returns texts without them as they are.
+"""
+import re
+
+# the most patterns that are tested for before a text is split
+PROBE_LIMIT = 4
+
+
+class Normaliser(object):
+    """Replace the literal patterns of (pattern, replacement) rules in one pass."""
+
+    def __init__(self, rules):
+        self.replacements = dict(rules)
+        patterns = sorted(self.replacements, key=len, reverse=True)
+        # the group makes split return the matches at the odd indices
+        self.regex = re.compile('(%s)' % '|'.join(re.escape(pattern) for pattern in patterns))
+        # a text without the patterns that contain no other pattern has no matches at all
+        probes = [pattern for pattern in patterns
+                  if not any(other in pattern for other in patterns if other != pattern)]
+        self.probes = probes if len(probes) <= PROBE_LIMIT else None
+
+    def __call__(self, text):
+        if self.probes is not None:
+            for probe in self.probes:
+                if probe in text:
+                    break
+            else:
+                return text
+        parts = self.regex.split(text)
+        if len(parts) == 1:
+            return text
+        replacements = self.replacements
+        parts[1::2] = [replacements[match] for match in parts[1::2]]
+        return ''.join(parts)
+
+    @classmethod
+    def from_chain(cls, rules):
+        """
+        Return the Normaliser with the result of applying the rules with str.replace in order.
+
+        A rule whose pattern contains the pattern of an earlier rule can never match, because
+        the earlier rule has already replaced it, so it is dropped. The replacements must not
+        create matches for later rules. Rules that could match overlapping text in a different
+        order than the chain would raise a ValueError.
+        """
+        effective = []
+        for pattern, replacement in rules:
+            if any(earlier in pattern for earlier, _ in effective):
+                continue
+            for earlier, _ in effective:
+                # pattern starting before an earlier pattern it overlaps would win the scan
+                for size in range(1, min(len(pattern), len(earlier))):
+                    if pattern[-size:] == earlier[:size]:
+                        raise ValueError('%r overlaps the earlier rule %r' % (pattern, earlier))
+            effective.append((pattern, replacement))
+        return cls(effective)
@@ -0,0 +1,187 @@
+"""
+Post-processing of the PNG images after they are rasterised and before they are cached.
+
+The steps are trim, which crops the transparent margin around the image, quantise, which
+maps the anti-aliased pixels onto a palette of at most COLOURS colours with their alpha,
+and optimise, which compresses the PNG again with the smallest settings of zlib. A
+processed image is only kept if it is smaller than the original, or if it was trimmed.
+
+The images of an equation at several densities are trimmed to the same box in points, see
+trim_boxes, so that they keep the same size in CSS pixels, to within a pixel, in srcset
+and the atlases. An image rendered at a new density later is trimmed to a box of its own,
+which may differ by a pixel too.
+
+Post-processing needs Pillow and is off unless the steps are named in the
+LATEX2IMAGE_POSTPROCESS environment variable, e.g. trim,quantise,optimise, or set with
+set_steps. The steps in use are part of the render fingerprint, so changing them renders
+the images again.
+"""
+import logging
+import math
+import os
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import metrics
+from metrics import timed
+
+log = logging.getLogger(__name__)
+
+STEPS = ('trim', 'quantise', 'optimise')
+
+# the colours of a quantised image, 16 fit in 4 bits per pixel and Ghostscript renders text
+# with about as many levels of alpha
+COLOURS = 16
+
+
+def parse_steps(value):
+    """Return the steps in the comma separated value, in the order they run."""
+    steps = set(step.strip() for step in value.split(',') if step.strip())
+    unknown = steps.difference(STEPS)
+    if unknown:
+        raise ValueError('Unknown post-processing steps %s, expected some of %s.' % (
+            ', '.join(sorted(unknown)), ', '.join(STEPS)))
+    return tuple(step for step in STEPS if step in steps)
+
+
+_steps = parse_steps(os.environ.get('LATEX2IMAGE_POSTPROCESS', ''))
+
+
+def set_steps(steps):
+    """Post-process with steps, a sequence or a comma separated string, return the old steps."""
+    global _steps
+    previous = _steps
+    if isinstance(steps, basestring):
+        steps = parse_steps(steps)
+    else:
+        steps = parse_steps(','.join(steps))
+    _steps = steps
+    return previous
+
+
+def active_steps():
+    """Return the steps that are applied, none if Pillow is not installed."""
+    return _steps if Image is not None else ()
+
+
+def postprocess_key():
+    """Return the part of the render fingerprint for the steps, empty if there are none."""
+    steps = active_steps()
+    if not steps:
+        return ''
+    return 'postprocess=%s;colours=%i' % (','.join(steps), COLOURS)
+
+
+def quantise(image):
+    """
+    Return the RGBA image as a palette image of at most COLOURS colours.
+
+    Equations are drawn in a single colour, so their palette holds that colour at COLOURS
+    levels of alpha, evenly spaced. Images of several colours are quantised by Pillow.
+    """
+    alpha = image.split()[-1]
+    # the visible pixels made opaque and the others (0, 0, 0, 0) have at most two colours
+    opaque = image.copy()
+    opaque.putalpha(255)
+    visible = alpha.point([255 if value else 0 for value in range(256)])
+    colours = Image.composite(opaque, Image.new('RGBA', image.size), visible).getcolors(2)
+    if colours is None:
+        return image.quantize(COLOURS, method=Image.FASTOCTREE)
+    inks = [colour[:3] for _, colour in colours if colour[3]]
+    ink = inks[0] if inks else (0, 0, 0)
+    step = 255.0 / (COLOURS - 1)
+    levels = alpha.point([int(round(value / step)) for value in range(256)])
+    palette = Image.frombytes('P', image.size, levels.tobytes())
+    palette.putpalette(list(ink) * COLOURS)
+    palette.info['transparency'] = ''.join(chr(int(round(level * step)))
+                                           for level in range(COLOURS))
+    return palette
+
+
+def trim_boxes(paths, dpis):
+    """
+    Return the boxes trimming the PNG files at paths, the images of a page at dpis.
+
+    Every box is the union of the visible parts of all the images in points, in the pixels
+    of its image. The box of an image that cannot be read, or of images with nothing
+    visible, is None.
+    """
+    with timed('postprocess'):
+        sizes = []
+        union = None
+        for path, dpi in zip(paths, dpis):
+            try:
+                image = Image.open(path)
+                image.load()
+            except IOError:
+                sizes.append(None)
+                continue
+            sizes.append(image.size)
+            box = image.convert('RGBA').split()[-1].getbbox()
+            if box is not None:
+                box = [edge * 72.0 / dpi for edge in box]
+                if union is not None:
+                    box = [min(box[0], union[0]), min(box[1], union[1]),
+                           max(box[2], union[2]), max(box[3], union[3])]
+                union = box
+        if union is None:
+            return [None] * len(paths)
+        boxes = []
+        for size, dpi in zip(sizes, dpis):
+            if size is None:
+                boxes.append(None)
+                continue
+            # rounded outwards, past the rounding errors of the conversion to points and back
+            edges = [round(edge * dpi / 72.0, 6) for edge in union]
+            boxes.append((int(math.floor(edges[0])), int(math.floor(edges[1])),
+                          min(int(math.ceil(edges[2])), size[0]),
+                          min(int(math.ceil(edges[3])), size[1])))
+        return boxes
+
+
+def postprocess_png(path, steps=None, box=None):
+    """
+    Apply steps, the active steps if not given, to the PNG file at path.
+
+    box is the box trim crops the image to, from trim_boxes, the visible part of the
+    image if it is not given. Returns the number of bytes saved.
+    """
+    steps = active_steps() if steps is None else steps
+    if not steps:
+        return 0
+    with timed('postprocess'):
+        try:
+            image = Image.open(path)
+            image.load()
+        except IOError as error:
+            log.warning('Not post-processing %s: %s', path, error)
+            return 0
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        trimmed = False
+        if 'trim' in steps:
+            if box is None:
+                box = image.split()[-1].getbbox()
+            if box is not None and tuple(box) != (0, 0) + image.size:
+                image = image.crop(box)
+                trimmed = True
+        options = {'optimize': 'optimise' in steps}
+        if 'quantise' in steps:
+            image = quantise(image)
+            used = max(index for _, index in image.getcolors(256)) + 1
+            options['bits'] = next(bits for bits in (1, 2, 4, 8) if used <= 1 << bits)
+
+        processed_path = path + '.processed'
+        image.save(processed_path, 'PNG', **options)
+        saved = os.path.getsize(path) - os.path.getsize(processed_path)
+        if saved > 0 or trimmed:
+            # the images of the other densities are trimmed to the same box
+            os.rename(processed_path, path)
+        else:
+            os.remove(processed_path)
+        saved = max(saved, 0)
+    metrics.increment('bytes_saved', saved)
+    return saved
@@ -1,9 +1,26 @@
 """Code to handle preparing pspicture and tikzpicture text for png transform."""
+import re
+
+
+def _environment_body(code, environment):
+    """
+    Return code without the begin and end of environment if it is enclosed in them.
+
+    The preambles open the environment before the code, so that the code is its options and
+    body. Code copied with the environment around it keeps its options.
+    """
+    match = re.match(r'\s*\\begin\{%s\}(.*)\\end\{%s\}\s*$' % (environment, environment),
+                     code, re.DOTALL)
+    return match.group(1) if match else code
 
 
 def tikzpicture2png(tikzpicture_element):
+    if isinstance(tikzpicture_element, basestring):
+        return _environment_body(tikzpicture_element, 'tikzpicture')
     return tikzpicture_element
 
 
 def pspicture2png(pspicture_element):
+    if isinstance(pspicture_element, basestring):
+        return _environment_body(pspicture_element, 'pspicture')
     return pspicture_element
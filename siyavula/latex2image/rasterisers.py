@@ -0,0 +1,108 @@
+"""
+Rasterisers that turn the compiled PDF into PNG images.
+
+Every rasteriser takes the PDF path, the resolutions, the number of pages and the base
+path of the PNG files. The command rasterisers return the commands to run on the backend
+and, for every dpi, the list of the PNG paths of the pages. The rasterisers are tried in
+the order given by the LATEX2IMAGE_RASTERISERS environment variable, skipping the ones
+that are not installed, with convert as the last resort.
+"""
+import os
+
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+DEFAULT_ORDER = 'gs,convert'
+
+
+def ghostscript_commands(pdf_path, dpis, pages, base):
+    """
+    Rasterise with Ghostscript directly.
+
+    These are the options convert passes to Ghostscript for PDF files, so the images match
+    those of convert without starting ImageMagick.
+    """
+    commands = []
+    outputs = []
+    for index, dpi in enumerate(dpis):
+        pattern = '%s-%i-%%d.png' % (base, index)
+        commands.append(['gs', '-q', '-dQUIET', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-dNOPROMPT',
+                         '-dAlignToPixels=0', '-dGridFitTT=2', '-sDEVICE=pngalpha',
+                         '-dTextAlphaBits=4', '-dGraphicsAlphaBits=4', '-r%i' % dpi,
+                         '-sOutputFile=' + pattern, pdf_path])
+        outputs.append([pattern % (page + 1) for page in range(pages)])
+    return commands, outputs
+
+
+def mutool_commands(pdf_path, dpis, pages, base):
+    """Rasterise with MuPDF, with an alpha channel for the transparent background."""
+    commands = []
+    outputs = []
+    for index, dpi in enumerate(dpis):
+        pattern = '%s-%i-%%d.png' % (base, index)
+        commands.append(['mutool', 'draw', '-q', '-r', '%i' % dpi, '-c', 'rgba', '-o', pattern,
+                         pdf_path])
+        outputs.append([pattern % (page + 1) for page in range(pages)])
+    return commands, outputs
+
+
+def convert_commands(pdf_path, dpis, pages, base):
+    """Rasterise with ImageMagick convert, reading the PDF once per dpi in a single run."""
+    if len(dpis) == 1 and pages == 1:
+        return ([['convert', '-density', '%i' % dpis[0], pdf_path, base + '.png']],
+                [[base + '.png']])
+    # the density applies to the following read, so every dpi reads the pdf again and
+    # the images of all the dpis are written as one numbered sequence
+    command = ['convert']
+    for dpi in dpis:
+        command.extend(['-density', '%i' % dpi, pdf_path])
+    command.append(base + '-%d.png')
+    outputs = [[base + '-%d.png' % (index * pages + page) for page in range(pages)]
+               for index in range(len(dpis))]
+    return [command], outputs
+
+
+def rasterise_in_process(pdf_path, dpis, pages, base):
+    """
+    Rasterise with PyMuPDF in this process, the PDF must be readable locally.
+
+    PyMuPDF raises RuntimeError for a PDF that is empty or corrupt.
+    """
+    document = fitz.open(pdf_path)
+    try:
+        outputs = []
+        for index, dpi in enumerate(dpis):
+            matrix = fitz.Matrix(dpi / 72.0, dpi / 72.0)
+            paths = []
+            for page in range(pages):
+                path = '%s-%i-%i.png' % (base, index, page + 1)
+                document.loadPage(page).getPixmap(matrix=matrix, alpha=True).writePNG(path)
+                paths.append(path)
+            outputs.append(paths)
+    finally:
+        document.close()
+    return outputs
+
+
+COMMAND_RASTERISERS = {
+    'gs': ghostscript_commands,
+    'mutool': mutool_commands,
+    'convert': convert_commands,
+}
+
+IN_PROCESS_RASTERISERS = {
+    'fitz': rasterise_in_process,
+}
+
+
+def rasteriser_order():
+    """Return the names of the rasterisers to try, always ending with convert."""
+    order = [name.strip() for name in
+             os.environ.get('LATEX2IMAGE_RASTERISERS', DEFAULT_ORDER).split(',')]
+    order = [name for name in order if name in COMMAND_RASTERISERS or
+             (name in IN_PROCESS_RASTERISERS and fitz is not None)]
+    if 'convert' not in order:
+        order.append('convert')
+    return order
@@ -0,0 +1,68 @@
+"""Reports of a build: how much of the rendering was shared, and the renders that failed."""
+import threading
+import time
+
+
+class BuildReport(object):
+    """
+    Count the equations of every document rendered in a build.
+
+    Pass the same report to replace_latex_with_images for all the documents of the build.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.documents = 0
+        self.total = 0
+        self.unique = set()
+        self.cached = 0
+        self.rendered = 0
+
+    def add_document(self):
+        """Count a document of the build."""
+        with self.lock:
+            self.documents += 1
+
+    def add_equations(self, latexes, rendered):
+        """Add the latex of every equation of a document and of the ones rendered for it."""
+        with self.lock:
+            self.total += len(latexes)
+            new = set(latexes) - self.unique
+            self.unique.update(new)
+            self.rendered += len(rendered)
+            self.cached += len(new - set(rendered))
+
+    def summary(self):
+        """Return the counts as a dictionary."""
+        with self.lock:
+            return {
+                'documents': self.documents,
+                'equations': self.total,
+                'unique': len(self.unique),
+                'rendered': self.rendered,
+                'cached': self.cached,
+            }
+
+    def format(self):
+        """Return the counts as a line of text."""
+        summary = self.summary()
+        duplicates = summary['equations'] - summary['unique']
+        return '%i documents, %i equations, %i unique (%i rendered, %i cached), %.1f%% ' \
+            'duplicates' % (summary['documents'], summary['equations'], summary['unique'],
+                            summary['rendered'], summary['cached'],
+                            100.0 * duplicates / summary['equations']
+                            if summary['equations'] else 0.0)
+
+
+def format_failures(cache):
+    """Return the failures recorded in the RenderCache cache as text, the oldest first."""
+    failures = cache.failures()
+    lines = ['%i failed renders' % len(failures)]
+    for failure in failures:
+        lines.append('')
+        lines.append('%s %s %s' % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(failure['failed_at'])),
+            failure['kind'], failure['name']))
+        lines.extend('    ' + line for line in failure['source'].splitlines())
+        lines.extend('  ' + line for line in failure['log'].splitlines())
+    return '\n'.join(lines)
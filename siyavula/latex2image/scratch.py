@@ -0,0 +1,77 @@
+"""
+Scratch directories in which renders compile, reused from one render to the next.
+
+A render takes a directory from the pool for as long as it runs and empties it afterwards,
+instead of creating a temporary directory and removing it again. The directories are
+created in LATEX2IMAGE_SCRATCH if it is set, otherwise in /dev/shm for backends that run
+on this machine, so that the many small files of a compile stay in memory, and in the
+temporary directory of the system otherwise. Outputs on the same file system as the cache
+are moved into it with a rename.
+"""
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+SCRATCH_ROOT = os.environ.get('LATEX2IMAGE_SCRATCH')
+
+# a file system in memory, if the system has one
+TMPFS = '/dev/shm'
+
+_lock = threading.Lock()
+# the root of the scratch directories to the directories that are not in use
+_free = {}
+
+
+def scratch_root(backend):
+    """Return the directory in which the scratch directories of backend are created."""
+    if SCRATCH_ROOT:
+        return SCRATCH_ROOT
+    if getattr(backend, 'local', False) and os.path.isdir(TMPFS) and \
+            os.access(TMPFS, os.W_OK):
+        return TMPFS
+    return tempfile.gettempdir()
+
+
+@contextmanager
+def scratch_dir(backend):
+    """Return an empty directory for a render on backend, for the body of the with statement."""
+    root = scratch_root(backend)
+    with _lock:
+        free = _free.setdefault(root, [])
+        path = free.pop() if free else None
+    if path is None:
+        path = tempfile.mkdtemp(prefix='latex2image-', dir=root)
+    try:
+        yield path
+    finally:
+        if _empty(path):
+            with _lock:
+                _free[root].append(path)
+
+
+def _empty(path):
+    """Remove the contents of path, return False if path was removed instead."""
+    try:
+        for name in os.listdir(path):
+            child = os.path.join(path, name)
+            if os.path.isdir(child) and not os.path.islink(child):
+                shutil.rmtree(child)
+            else:
+                os.remove(child)
+    except OSError:
+        shutil.rmtree(path, ignore_errors=True)
+        return False
+    return True
+
+
+@atexit.register
+def remove_scratch_dirs():
+    """Remove the scratch directories that are not in use."""
+    with _lock:
+        for paths in _free.values():
+            for path in paths:
+                shutil.rmtree(path, ignore_errors=True)
+            del paths[:]
@@ -1,8 +1,16 @@
 # coding=utf-8
+import os
+import re
 from unittest import TestCase
 
+from lxml import etree
+
+from siyavula.latex2image.benchmark import read_corpus
 from siyavula.latex2image.equation2png import equation2png
-from siyavula.latex2image.utils import unescape, unicode_replacements
+from siyavula.latex2image.imageutils import prepare_code
+from siyavula.latex2image.normalise import Normaliser
+from siyavula.latex2image.utils import (UNICODE_OPERATIONS, cleanup_code, unescape,
+                                        unicode_replacements)
 
 
 class TestBaseEquationConversion(TestCase):
@@ -87,3 +95,88 @@ class TestUnicodeEquations(TestCase):
         output_string = '\\text{\ensuremath{\mu}N \ensuremath{\mu}N}'
         self.assertEqual(unescape(input_string), u'\\text{\u03bcN \xb5N}')
         self.assertEqual(unicode_replacements(middle_string), output_string)
+
+
+def legacy_unicode_replacements(latex):
+    """The replacements of unicode_replacements, applied one after the other."""
+    for old_string, new_string in UNICODE_OPERATIONS:
+        latex = latex.replace(old_string, new_string)
+    return latex
+
+
+def legacy_equation2png(equation_element):
+    """The replacements of equation2png, applied one after the other."""
+    equation_element = '\\({}\\)'.format(equation_element[2:-2])
+    equation_element = equation_element.replace(r'{#', r'{\#').replace('\t', ' ')
+    if '%' in equation_element:
+        equation_element = equation_element.replace('%', '\\%').replace('\\\\%', '\\%')
+    return equation_element
+
+
+def legacy_entities(code):
+    """The entity replacements of prepare_code, applied one after the other."""
+    return code.replace(r'&amp;', '&').replace(r'&gt;', '>').replace(r'&lt;', '<')
+
+
+def legacy_math_snippets(code):
+    """The delimiter replacements of cleanup_code, applied one snippet after the other."""
+    for snippet in re.findall(r'\$(.*?)\$', code):
+        code = code.replace(snippet, snippet.replace(r'\(', ' ').replace(r'\)', ' '))
+    return code
+
+
+class TestSinglePassNormalisation(TestCase):
+    """Test that the single pass replacements match the replacements applied in order."""
+
+    edge_cases = [
+        '', 'x', '\xc2\xb5', '\xc2\xb5\xc2\xb7\xb7', '\xe2\x81\xbb\xc2\xb9\xc2\xb9', '\\u03bc',
+        '&amp;gt;', '&amp;amp;gt;', '&amp;lt;&lt;&gt;', '&&amp;&',
+        '\\(50%\\)', '\\(50\\%\\)', '\\(50\\\\%\\)', '\\(%%\\%\\)', '\\(\\color{#fff}\t\\)',
+        '\\({#%\t{{##\\)', '$\\(a\\)$ and $b\\)$', '\\(a$\\(b\\)$$$\\)',
+    ]
+
+    def corpus(self):
+        path = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'test-equations.txt')
+        return read_corpus(path) + self.edge_cases
+
+    def test_unicode_replacements(self):
+        for equation in self.corpus():
+            self.assertEqual(unicode_replacements(equation),
+                             legacy_unicode_replacements(equation))
+
+    def test_equation2png(self):
+        for equation in self.corpus():
+            self.assertEqual(equation2png(equation), legacy_equation2png(equation))
+
+    def test_cleanup_code(self):
+        for code in self.corpus():
+            self.assertEqual(cleanup_code(code), cleanup_code(legacy_math_snippets(code)))
+        # only the delimiters inside $ $ pairs are removed
+        self.assertEqual(cleanup_code(r'\(a\) $\(a\)$'), r'\(a\) $ a $')
+
+    def test_entities(self):
+        element = etree.fromstring('<pre><code/></pre>')
+        for code in self.corpus():
+            try:
+                element.find('code').text = code.decode('utf-8')
+            except UnicodeDecodeError:
+                continue
+            if not code.strip():
+                continue
+            self.assertEqual(prepare_code(element), legacy_entities(code).strip())
+
+    def test_dead_rule_is_dropped(self):
+        normaliser = Normaliser.from_chain([('b', 'x'), ('abc', 'y'), ('a', 'z')])
+        self.assertEqual(sorted(normaliser.replacements), ['a', 'b'])
+        self.assertEqual(normaliser('abc'), 'zxc')
+
+    def test_texts_without_patterns_are_not_split(self):
+        normaliser = Normaliser([('\\%', '\\%'), ('%', '\\%'), ('\t', ' ')])
+        self.assertEqual(sorted(normaliser.probes), ['\t', '%'])
+        text = 'a + b'
+        self.assertIs(normaliser(text), text)
+        self.assertEqual(normaliser('5%\t\\%'), '5\\% \\%')
+
+    def test_overlapping_rules_are_rejected(self):
+        with self.assertRaises(ValueError):
+            Normaliser.from_chain([('bc', 'x'), ('ab', 'y')])
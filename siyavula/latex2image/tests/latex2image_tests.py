@@ -1,8 +1,26 @@
 # coding=utf-8
-from unittest import TestCase
+import base64
+import errno
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from unittest import TestCase, skipIf
 from lxml import etree, html
 
+from siyavula.latex2image import (asyncrender, atlas, backends, benchmark, cache, cli, daemon,
+                                  formats, htmlstream, imageutils, metrics, postprocess,
+                                  pstikz2png, rasterisers, report, scratch, texworker)
 from siyavula.latex2image.imageutils import replace_latex_with_images
+from siyavula.latex2image.preambles import PsPicture_preamble, equation_preamble, tikz_preamble
 
 
 class TestBaseEquationToImageConversion(TestCase):
@@ -20,3 +38,1423 @@ class TestBaseEquationToImageConversion(TestCase):
         xml = html.tostring(replace_latex_with_images(self.element_input, 'latex-math', '', ''))
         self.assertEqual(xml, '<xml><div class="latex-math"><a href="/8996d7eee5c41cdf08aa8c0e9fe42e93.png"><img src="/8996d7eee5c41cdf08aa8c0e9fe42e93.png" srcset="/b0791f40d3207d55907aa0b7df78ca1e.png 2x"></a></div></xml>')
     '''
+
+
+# the SVG of pdf2svg, sized in points
+FAKE_SVG = ('<svg xmlns="http://www.w3.org/2000/svg" width="144pt" height="72pt" '
+            'viewBox="0 0 144 72"/>')
+
+# the PDF of a single page written by StubBackend
+STUB_PDF = 'stub pages=1\n'
+
+
+class FakeLatexContainer(benchmark.StubBackend):
+    """
+    StubBackend that fails to compile documents containing BAD, HANG or DIE.
+
+    It records the commands it runs and the compiles, and its images contain their dpi.
+    """
+
+    # compile in the temporary directory, as on docker, not on tmpfs
+    local = False
+
+    def __init__(self):
+        benchmark.StubBackend.__init__(self)
+        self.compiles = 0
+        self.commands = []
+        # commands that are not installed
+        self.missing = set()
+
+    def exec_run(self, command, **kwargs):
+        if command[0] == 'timeout':
+            command = command[2:]
+        self.commands.append(command)
+        if command[0] in self.missing:
+            return 127, ''
+        if command[0] == 'pdflatex' and command[1] == '--version':
+            return 0, 'pdfTeX 3.14159265-2.6-1.40.20 (TeX Live 2019)\nkpathsea version 6.3.1\n'
+        elif command[0] == 'pdflatex' and '-ini' not in command:
+            self.compiles += 1
+            latex_path = command[-1]
+            with open(latex_path) as fp:
+                tex = fp.read()
+            if 'BAD' in tex:
+                with open(latex_path.replace('.tex', '.log'), 'w') as fp:
+                    fp.write('This is pdfTeX\n! Undefined control sequence.\nl.25 \\(\\BAD\n\n')
+                return 1, ''
+            if 'HANG' in tex:
+                # killed while writing the PDF
+                with open(latex_path.replace('.tex', '.pdf'), 'w') as fp:
+                    fp.write('%PDF-1.5')
+                return imageutils.TIMEOUT_STATUS, ''
+            if 'DIE' in tex:
+                return backends.WORKER_DIED_STATUS, ''
+        elif command[0] == 'gs':
+            options = dict(arg[2:].split('=', 1) for arg in command if arg.startswith('-s'))
+            for page in range(self._pages(command[-1])):
+                with open(options['OutputFile'] % (page + 1), 'w') as fp:
+                    fp.write([arg[2:] for arg in command if arg.startswith('-r')][0])
+            return 0, ''
+        elif command[0] == 'dvipng':
+            with open(command[command.index('-o') + 1], 'w') as fp:
+                fp.write(command[command.index('-D') + 1])
+            return 0, ''
+        elif command[0] == 'pdf2svg':
+            with open(command[-1], 'w') as fp:
+                fp.write(FAKE_SVG)
+            return 0, ''
+        elif command[0] == 'convert':
+            # every -density is followed by a read of the pdf, write its pages in sequence
+            densities = [command[i + 1] for i, arg in enumerate(command) if arg == '-density']
+            pages = self._pages(command[3])
+            for index, density in enumerate(densities):
+                for page in range(pages):
+                    output = command[-1]
+                    if '%d' in output:
+                        output = output % (index * pages + page)
+                    with open(output, 'w') as fp:
+                        fp.write(density)
+            return 0, ''
+        return benchmark.StubBackend.exec_run(self, command, **kwargs)
+
+
+class FakeLatexContainerTestCase(TestCase):
+    """Render into a temporary cache using FakeLatexContainer as the backend."""
+
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        self.format_path = formats.FORMAT_PATH
+        formats.FORMAT_PATH = tempfile.mkdtemp()
+        self.container = FakeLatexContainer()
+        self.backend = backends.set_backend(self.container)
+
+    def tearDown(self):
+        backends.set_backend(self.backend)
+        shutil.rmtree(self.cache_path)
+        shutil.rmtree(formats.FORMAT_PATH)
+        formats.FORMAT_PATH = self.format_path
+        formats._failed_formats.clear()
+
+
+class TestBatchEquationRendering(FakeLatexContainerTestCase):
+    """Test rendering many equations per pdflatex run."""
+    def test_batch_writes_run_latex_cache_files(self):
+        equations = [r'\(a\)', r'\(b\)', r'\(a\)']
+        results = imageutils.render_equations_batch(equations, [150, 300], self.cache_path)
+        self.assertEqual(self.container.compiles, 1)
+        compile_command = [c for c in self.container.commands
+                           if c[0] == 'pdflatex' and c[-1].endswith('figure.tex')][0]
+        self.assertIn('-fmt=' + os.path.join(
+            formats.FORMAT_PATH, formats.format_key(imageutils.batch_preamble(),
+                                                    version=self.container.tex_version)),
+            compile_command)
+        self.assertEqual(sorted(results), [r'\(a\)', r'\(b\)'])
+        for latex in results:
+            for dpi in [150, 300]:
+                path = os.path.join(self.cache_path,
+                                    imageutils.equation_hash(latex, dpi) + '.png')
+                self.assertEqual(results[latex][dpi], path)
+                self.assertEqual(open(path).read(), str(dpi))
+            self.assertTrue(os.path.exists(os.path.join(
+                self.cache_path, imageutils.source_hash('equation', latex) + '.pdf')))
+
+    def test_failing_equation_is_isolated(self):
+        equations = [r'\(a\)', r'\(b\)', r'\(BAD\)', r'\(c\)']
+        results = imageutils.render_equations_batch(equations, [150], self.cache_path)
+        self.assertIsInstance(results[r'\(BAD\)'], imageutils.LatexPictureError)
+        for latex in [r'\(a\)', r'\(b\)', r'\(c\)']:
+            self.assertTrue(os.path.exists(results[latex][150]))
+
+    def test_failure_reports_log_excerpt(self):
+        results = imageutils.render_equations_batch([r'\(BAD\)'], [150], self.cache_path)
+        self.assertIn('! Undefined control sequence.\nl.25', unicode(results[r'\(BAD\)']))
+
+    def test_cached_equations_are_skipped(self):
+        imageutils.render_equations_batch([r'\(a\)'], [150], self.cache_path)
+        imageutils.render_equations_batch([r'\(a\)'], [150], self.cache_path)
+        self.assertEqual(self.container.compiles, 1)
+
+    def test_split_failure_is_not_bisected_or_remembered(self):
+        self.container.missing.add('pdfseparate')
+        equations = [r'\(a\)', r'\(b\)', r'\(c\)']
+        results = imageutils.render_equations_batch(equations, [150], self.cache_path)
+        self.assertEqual(self.container.compiles, 1)
+        for latex in equations:
+            self.assertEqual(results[latex].kind, 'rasterise')
+        self.container.missing.clear()
+        results = imageutils.render_equations_batch(equations, [150], self.cache_path)
+        self.assertEqual(self.container.compiles, 2)
+        for latex in equations:
+            self.assertTrue(os.path.exists(results[latex][150]))
+
+
+class TestPreambleFormats(TestCase):
+    """Test the precompiled preamble format files."""
+
+    def setUp(self):
+        self.format_path = tempfile.mkdtemp()
+        self.container = FakeLatexContainer()
+
+    def tearDown(self):
+        shutil.rmtree(self.format_path)
+
+    def test_format_is_built_once(self):
+        preamble = equation_preamble()
+        fmt = formats.get_format(preamble, self.container, self.format_path)
+        self.assertEqual(fmt, os.path.join(self.format_path, formats.format_key(
+            preamble, version=formats.tex_version(self.container))))
+        self.assertTrue(os.path.exists(fmt + '.fmt'))
+        self.assertEqual(formats.get_format(preamble, self.container, self.format_path), fmt)
+        self.assertEqual([c[1] for c in self.container.commands], ['--version', '-ini'])
+
+    def test_new_tex_version_builds_a_new_format(self):
+        preamble = equation_preamble()
+        fmt = formats.get_format(preamble, self.container, self.format_path)
+        self.container.tex_version = 'pdfTeX 3.141592653-2.6-1.40.22 (TeX Live 2021)'
+        self.assertNotEqual(formats.get_format(preamble, self.container, self.format_path),
+                            fmt)
+        self.assertEqual(len([c for c in self.container.commands if '-ini' in c]), 2)
+
+    def test_key_changes_with_preamble_head(self):
+        preamble = equation_preamble()
+        self.assertEqual(formats.format_key(preamble),
+                         formats.format_key(preamble.replace('__CODE__', 'x')))
+        self.assertNotEqual(formats.format_key(preamble),
+                            formats.format_key(preamble.replace('{cancel}', '{bm}')))
+
+
+class TestParallelReplacement(FakeLatexContainerTestCase):
+    """Test rendering the images of a document on a worker pool."""
+
+    def make_dom(self):
+        dom = etree.Element('xml')
+        for latex in [r'\(a\)', r'\(b\)', r'\(a\)', r'\(x^2\)', r'\(\frac{1}{2}\)']:
+            for tag in ['div', 'span']:
+                element = etree.SubElement(dom, tag)
+                element.set('class', 'latex-math')
+                element.text = latex
+        return dom
+
+    def test_parallel_output_matches_serial(self):
+        serial = html.tostring(replace_latex_with_images(
+            self.make_dom(), 'latex-math', self.cache_path, '/images'))
+        parallel_cache_path = tempfile.mkdtemp()
+        try:
+            parallel = html.tostring(replace_latex_with_images(
+                self.make_dom(), 'latex-math', parallel_cache_path, '/images', workers=4))
+            self.assertEqual(sorted(os.listdir(parallel_cache_path)),
+                             sorted(os.listdir(self.cache_path)))
+        finally:
+            shutil.rmtree(parallel_cache_path)
+        self.assertEqual(parallel, serial)
+        # four distinct equations at two resolutions each, their pdfs and the index
+        self.assertEqual(len(os.listdir(self.cache_path)), 13)
+        # one compile per distinct equation for each of the two caches
+        self.assertEqual(self.container.compiles, 8)
+
+
+class TestCacheHits(FakeLatexContainerTestCase):
+    """Test that a fully cached document does not use the backend."""
+
+    def make_dom(self, latexes):
+        dom = etree.Element('xml')
+        for latex in latexes:
+            element = etree.SubElement(dom, 'span')
+            element.set('class', 'latex-math')
+            element.text = latex
+        return dom
+
+    def test_warm_render_does_not_use_backend(self):
+        cold = html.tostring(replace_latex_with_images(
+            self.make_dom([r'\(a\)', r'\(b\)']), 'latex-math', self.cache_path, '/images'))
+        # a new backend, as in a new process, that has not run pdflatex --version yet
+        container = FakeLatexContainer()
+        backends.set_backend(container)
+        warm = html.tostring(replace_latex_with_images(
+            self.make_dom([r'\(a\)', r'\(b\)']), 'latex-math', self.cache_path, '/images'))
+        self.assertEqual(warm, cold)
+        self.assertEqual(container.commands, [])
+
+    def test_only_missing_equations_use_backend(self):
+        replace_latex_with_images(self.make_dom([r'\(a\)']), 'latex-math', self.cache_path,
+                                  '/images')
+        container = FakeLatexContainer()
+        backends.set_backend(container)
+        replace_latex_with_images(self.make_dom([r'\(a\)', r'\(b\)']), 'latex-math',
+                                  self.cache_path, '/images')
+        self.assertEqual(container.compiles, 1)
+
+    def test_new_tex_version_renders_again(self):
+        replace_latex_with_images(self.make_dom([r'\(a\)']), 'latex-math', self.cache_path,
+                                  '/images')
+        container = FakeLatexContainer()
+        container.tex_version = 'pdfTeX 3.141592653-2.6-1.40.22 (TeX Live 2021)'
+        backends.set_backend(container)
+        replace_latex_with_images(self.make_dom([r'\(a\)', r'\(b\)']), 'latex-math',
+                                  self.cache_path, '/images')
+        self.assertEqual(container.compiles, 2)
+
+    def test_equation_images_are_remembered(self):
+        first = imageutils.equation_images(u'\\(a \xd7 b\\)', (1, 2), 'png')
+        self.assertEqual(first[0], r'\(a \times b\)')
+        self.assertIs(imageutils.equation_images(u'\\(a \xd7 b\\)', (1, 2), 'png'), first)
+
+
+class SlowLatexContainer(FakeLatexContainer):
+    """FakeLatexContainer whose compiles take a while, to overlap concurrent renders."""
+
+    def exec_run(self, command, **kwargs):
+        if command[-1].endswith('figure.tex'):
+            time.sleep(0.2)
+        return FakeLatexContainer.exec_run(self, command, **kwargs)
+
+
+class TestDeduplication(FakeLatexContainerTestCase):
+    """Test that identical equations are rendered once."""
+
+    def test_concurrent_renders_are_shared(self):
+        self.container = SlowLatexContainer()
+        backends.set_backend(self.container)
+        images = [(imageutils.equation_hash(r'\(a\)', 150), 150)]
+        results = []
+
+        def render():
+            results.append(imageutils.render_images('equation', r'\(a\)', self.cache_path,
+                                                    images))
+
+        threads = [threading.Thread(target=render) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.container.compiles, 1)
+        self.assertEqual(len(set(path for paths in results for path in paths)), 1)
+
+    def test_build_report(self):
+        build_report = report.BuildReport()
+        for latexes in [[r'\(a\)', r'\(b\)', r'\(a\)'], [r'\(b\)', r'\(c\)']]:
+            dom = etree.Element('xml')
+            for latex in latexes:
+                etree.SubElement(dom, 'span', {'class': 'latex-math'}).text = latex
+            replace_latex_with_images(dom, 'latex-math', self.cache_path, '/images',
+                                      report=build_report)
+        self.assertEqual(build_report.summary(), {
+            'documents': 2, 'equations': 5, 'unique': 3, 'rendered': 3, 'cached': 0})
+        self.assertEqual(self.container.compiles, 3)
+        self.assertEqual(build_report.format(),
+                         '2 documents, 5 equations, 3 unique (3 rendered, 0 cached), '
+                         '40.0% duplicates')
+
+
+class TestStreaming(FakeLatexContainerTestCase):
+    """Test rewriting a document while it is parsed."""
+
+    document = (
+        '<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>a &amp; b</title></head>\n'
+        '<body class="book">text &lt; <!-- note --><div>a <span class="latex-math">\\(a\\)'
+        '</span></div> tail\n<p>\xc3\xa9 <span class="latex-math">\\(\xc3\x97\\)</span></p>'
+        'end<br>\n<div class="latex-math">\\(b\\)</div>\n'
+        '<div class="section"><p><span class="latex-math">\\(a\\)</span></p></div>'
+        '</body></html>')
+
+    def expected(self, **kwargs):
+        dom = html.document_fromstring(self.document.decode('utf-8'))
+        replace_latex_with_images(dom, 'latex-math', self.cache_path, '/images', **kwargs)
+        return etree.tostring(dom.getroottree(), method='html', encoding='utf-8')
+
+    def stream(self, **kwargs):
+        output = io.BytesIO()
+        htmlstream.stream_latex_with_images(io.BytesIO(self.document), output, 'latex-math',
+                                            self.cache_path, '/images', **kwargs)
+        return output.getvalue()
+
+    def test_output_matches_replace_latex_with_images(self):
+        expected = self.expected()
+        for chunk_depth in [1, 2, 3]:
+            for batch_size in [1, 100]:
+                self.assertEqual(self.stream(chunk_depth=chunk_depth, batch_size=batch_size),
+                                 expected)
+
+    def test_batches_are_rendered_together(self):
+        build_report = report.BuildReport()
+        self.stream(batch_size=100, report=build_report)
+        self.assertEqual(build_report.summary()['documents'], 1)
+        self.assertEqual(build_report.summary()['equations'], 4)
+        self.assertEqual(self.container.compiles, 3)
+
+    @skipIf(postprocess.Image is None, 'Pillow is not installed')
+    def test_atlas(self):
+        backends.set_backend(PngLatexContainer())
+        expected = self.expected(atlas=True)
+        self.assertIn('latex-atlas', expected)
+        self.assertEqual(self.stream(atlas=True), expected)
+
+    def test_figures_are_rejected(self):
+        output = io.BytesIO()
+        with self.assertRaises(TypeError) as context:
+            htmlstream.stream_latex_with_images(
+                io.BytesIO(self.document), output, 'latex-math', self.cache_path, '/images',
+                figures=imageutils.FIGURE_TYPES, page_width_px=800)
+        self.assertIn('figures, page_width_px', unicode(context.exception))
+        self.assertEqual(output.getvalue(), '')
+        self.assertEqual(self.container.compiles, 0)
+
+
+class TestAsyncRenderer(FakeLatexContainerTestCase):
+    """Test rendering on the pool of an AsyncRenderer."""
+
+    def setUp(self):
+        FakeLatexContainerTestCase.setUp(self)
+        self.renderer = asyncrender.AsyncRenderer(self.cache_path, concurrency=2)
+
+    def tearDown(self):
+        self.renderer.close()
+        FakeLatexContainerTestCase.tearDown(self)
+
+    def test_equation_shares_cache_with_documents(self):
+        paths = []
+        result = self.renderer.render_equation(u'\\(a \xd7 b\\)', callback=paths.append)
+        path = result.get(5)
+        self.assertEqual(paths, [path])
+        dom = etree.Element('xml')
+        etree.SubElement(dom, 'span', {'class': 'latex-math'}).text = u'\\(a \xd7 b\\)'
+        self.renderer.replace_latex_with_images(dom, 'latex-math', '', densities=(1,)).get(5)
+        self.assertEqual(dom[0][0].get('src'), '/' + os.path.basename(path))
+        self.assertEqual(self.container.compiles, 1)
+
+    def test_timeout(self):
+        backends.set_backend(SlowLatexContainer())
+        result = self.renderer.render_equation(r'\(a\)')
+        with self.assertRaises(multiprocessing.TimeoutError):
+            result.get(0.01)
+        self.assertTrue(result.get(5))
+
+
+class TestDaemon(FakeLatexContainerTestCase):
+    """Test rendering through the daemon."""
+
+    def setUp(self):
+        FakeLatexContainerTestCase.setUp(self)
+        self.socket_path = os.path.join(tempfile.mkdtemp(), 'latex2image.sock')
+        self.server = daemon.RenderServer(self.socket_path, self.cache_path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.client = daemon.RenderClient(self.socket_path)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(os.path.dirname(self.socket_path))
+        FakeLatexContainerTestCase.tearDown(self)
+
+    def test_batch_is_rendered_into_the_cache(self):
+        results = self.client.render([
+            {'type': 'equation', 'code': r'\(a\)', 'dpi': 150},
+            {'type': 'equation', 'code': r'\(a\)', 'dpi': 300},
+            {'type': 'equation', 'code': r'\(\BAD\)', 'dpi': 150},
+        ], data=True)
+        self.assertEqual(results[0]['path'], os.path.join(
+            self.cache_path, imageutils.equation_hash(r'\(a\)', 150) + '.png'))
+        self.assertEqual(base64.b64decode(results[1]['data']), '300')
+        self.assertIn('error', results[2])
+        self.assertEqual(self.container.compiles, 2)
+
+    def test_run_latex(self):
+        path = self.client.run_latex('equation', 'abc', r'\(a\)', dpi=150)
+        self.assertEqual(path, os.path.join(self.cache_path, 'abc.png'))
+        self.assertTrue(os.path.exists(path))
+
+    def test_bad_request(self):
+        with self.assertRaises(daemon.RenderRequestError):
+            self.client.render([{'type': 'table', 'code': 'x'}])
+        # the connection can still be used
+        self.assertTrue(self.client.run_latex('equation', 'abc', r'\(a\)'))
+
+    def test_hash_must_be_hexadecimal(self):
+        for codehash in ['../abc', 'ABC', '', 12]:
+            with self.assertRaises(daemon.RenderRequestError):
+                self.client.render([{'type': 'equation', 'code': r'\(a\)', 'hash': codehash}])
+        self.assertEqual(self.container.compiles, 0)
+
+    def test_figures_are_named_by_figure_hash(self):
+        code = r'\begin{tikzpicture}\draw (0,0) -- (1,1);\end{tikzpicture}'
+        result, = self.client.render([{'type': 'tikzpicture', 'code': code, 'dpi': 150}])
+        self.assertEqual(result['path'], os.path.join(
+            self.cache_path, imageutils.figure_hash('tikzpicture', code, 150) + '.png'))
+
+    def test_socket_is_private(self):
+        self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o600)
+
+    def test_default_socket_is_per_user(self):
+        environ = dict(os.environ)
+        try:
+            os.environ['XDG_RUNTIME_DIR'] = '/run/user/1000'
+            self.assertEqual(daemon.default_socket(), '/run/user/1000/latex2image.sock')
+            del os.environ['XDG_RUNTIME_DIR']
+            self.assertIn(str(os.getuid()), os.path.basename(daemon.default_socket()))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+    def test_live_socket_is_kept(self):
+        with self.assertRaises(socket.error) as context:
+            daemon.RenderServer(self.socket_path, self.cache_path)
+        self.assertEqual(context.exception.errno, errno.EADDRINUSE)
+        # the running daemon still answers
+        self.assertTrue(self.client.run_latex('equation', 'abc', r'\(a\)'))
+
+    def test_stale_socket_is_replaced(self):
+        stale_path = os.path.join(os.path.dirname(self.socket_path), 'stale.sock')
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(stale_path)
+        stale.close()
+        server = daemon.RenderServer(stale_path, self.cache_path)
+        server.server_close()
+
+
+# a pdflatex reading the lines of the warm document, recording every start next to it
+FAKE_WARM_PDFLATEX = r'''
+import os, re, sys, time
+open(os.path.join(os.path.dirname(sys.argv[0]), 'starts'), 'a').write('x')
+sys.stdout.write('This is pdfTeX, Version 3.14159265\n')
+sys.stdout.flush()
+for line in iter(sys.stdin.readline, ''):
+    if 'HANG' in line:
+        time.sleep(10)
+    if 'BAD' in line:
+        sys.stdout.write('! Undefined control sequence.\n')
+    job = re.search(r'\[warm\\space (\d+)\]', line).group(1)
+    sys.stdout.write('[warm %s]\n' % job)
+    sys.stdout.flush()
+'''
+
+
+class TestTexWorker(FakeLatexContainerTestCase):
+    """Test rendering equations in a pdflatex process that keeps running."""
+
+    def setUp(self):
+        FakeLatexContainerTestCase.setUp(self)
+        self.script_path = tempfile.mkdtemp()
+        script = os.path.join(self.script_path, 'pdflatex.py')
+        with open(script, 'w') as fp:
+            fp.write(FAKE_WARM_PDFLATEX)
+        self.worker = texworker.TexWorker(command_prefix=[sys.executable, script], max_jobs=3,
+                                          timeout=1)
+
+    def tearDown(self):
+        self.worker.close()
+        shutil.rmtree(self.script_path)
+        FakeLatexContainerTestCase.tearDown(self)
+
+    def starts(self):
+        with open(os.path.join(self.script_path, 'starts')) as fp:
+            return len(fp.read())
+
+    def test_equations_share_one_process(self):
+        for latex in [r'\(a\)', r'\(b\)', r'\(c\)']:
+            paths = self.worker.render(latex, [150, 300])
+            self.assertEqual([open(path).read() for path in paths], ['150', '300'])
+        self.assertEqual(self.starts(), 1)
+        self.assertEqual(self.container.compiles, 0)
+        pages = [c[c.index('-p') + 1] for c in self.container.commands if c[0] == 'dvipng']
+        self.assertEqual(pages, ['=1', '=1', '=3', '=3', '=5', '=5'])
+        # restarted after max_jobs
+        self.worker.render(r'\(d\)', [150])
+        self.assertEqual(self.starts(), 2)
+
+    def test_failures_restart_the_process(self):
+        with self.assertRaises(imageutils.LatexPictureError):
+            self.worker.render(r'\(\BAD\)', [150])
+        with self.assertRaises(imageutils.LatexPictureError):
+            self.worker.render(r'\(HANG\)', [150])
+        self.assertTrue(self.worker.render(r'\(a\)', [150]))
+        self.assertEqual(self.starts(), 3)
+
+    def test_images_are_cached_apart(self):
+        images = [(imageutils.equation_hash(r'\(a\)', 150), 150)]
+        paths = texworker.render_images_warm(self.worker, r'\(a\)', self.cache_path, images)
+        path = os.path.join(self.cache_path, images[0][0] + '.png')
+        self.assertEqual(paths, [path])
+        self.assertEqual(texworker.render_images_warm(self.worker, r'\(a\)', self.cache_path,
+                                                      images), [path])
+        self.assertEqual(self.worker.jobs, 1)
+        # not served to the PDF route, which replaces it under the same name
+        self.assertEqual(imageutils.run_latex('equation', images[0][0], r'\(a\)',
+                                              self.cache_path, dpi=150), path)
+        self.assertEqual(self.container.compiles, 1)
+        # and the workers use its image from then on
+        texworker.render_images_warm(self.worker, r'\(a\)', self.cache_path, images)
+        self.assertEqual(self.worker.jobs, 1)
+        self.assertEqual(imageutils.run_latex('equation', images[0][0], r'\(a\)',
+                                              self.cache_path, dpi=150), path)
+        self.assertEqual(self.container.compiles, 1)
+        self.assertEqual(texworker.render_images_warm(self.worker, r'\(\BAD\)',
+                                                      self.cache_path, [('bad', 150)]), [None])
+
+    def test_pdf_route_images_are_used(self):
+        images = [(imageutils.equation_hash(r'\(a\)', 150), 150)]
+        path, = imageutils.render_images('equation', r'\(a\)', self.cache_path, images)
+        self.assertEqual(texworker.render_images_warm(self.worker, r'\(a\)', self.cache_path,
+                                                      images), [path])
+        self.assertEqual(imageutils.render_images('equation', r'\(a\)', self.cache_path,
+                                                  images), [path])
+        # rendered once, by the PDF route
+        self.assertEqual(self.container.compiles, 1)
+        self.assertEqual(self.worker.jobs, 0)
+        self.assertEqual(open(path).read(), '150')
+
+    def test_daemon_routes_equations_to_workers(self):
+        socket_path = os.path.join(self.script_path, 'latex2image.sock')
+        server = daemon.RenderServer(socket_path, self.cache_path, tex_workers=[self.worker])
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        client = daemon.RenderClient(socket_path)
+        try:
+            results = client.render([{'code': r'\(a\)', 'dpi': 150},
+                                     {'code': r'\(a\)', 'format': 'svg'}])
+        finally:
+            client.close()
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        self.assertTrue(all('path' in result for result in results))
+        self.assertEqual(self.starts(), 1)
+        # only the svg is compiled to a PDF
+        self.assertEqual(self.container.compiles, 1)
+
+
+class TestSingleCompile(FakeLatexContainerTestCase):
+    """Test that every resolution of an image is rasterised from one compile."""
+
+    def test_densities_share_one_compile(self):
+        dom = etree.Element('xml')
+        span = etree.SubElement(dom, 'span')
+        span.set('class', 'latex-math')
+        span.text = r'\(a\)'
+        replace_latex_with_images(dom, 'latex-math', self.cache_path, '', densities=(1, 1.5, 3))
+        self.assertEqual(self.container.compiles, 1)
+        rasterised = [c[-3] for c in self.container.commands if c[0] == 'gs']
+        self.assertEqual(rasterised[-3:], ['-r187', '-r281', '-r562'])
+        hashes = [imageutils.equation_hash(r'\(a\)', 187.5 * d) for d in (1, 1.5, 3)]
+        self.assertEqual(html.tostring(dom), (
+            '<xml><span class="latex-math"><img src="/{}.png" '
+            'srcset="/{}.png 1.5x, /{}.png 3x"></span></xml>'.format(*hashes)))
+
+    def test_new_density_uses_cached_pdf(self):
+        imageutils.run_latex('equation', 'a1', r'\(a\)', self.cache_path, 150)
+        imageutils.run_latex('equation', 'a2', r'\(a\)', self.cache_path, 300)
+        self.assertEqual(self.container.compiles, 1)
+        self.assertEqual(open(os.path.join(self.cache_path, 'a2.png')).read(), '300')
+
+
+class TestSvgOutput(FakeLatexContainerTestCase):
+    """Test rendering equations as SVG images."""
+
+    def test_svg_replaces_both_pngs(self):
+        dom = etree.Element('xml')
+        div = etree.SubElement(dom, 'div')
+        div.set('class', 'latex-math')
+        div.text = r'\(a\)'
+        replace_latex_with_images(dom, 'latex-math', self.cache_path, '/images',
+                                  output_format='svg')
+        codehash = imageutils.equation_hash(r'\(a\)', None, 'svg')
+        self.assertEqual(html.tostring(dom), (
+            '<xml><div class="latex-math"><a href="/images/{0}.svg">'
+            '<img src="/images/{0}.svg"></a></div></xml>'.format(codehash)))
+        svg = etree.parse(os.path.join(self.cache_path, codehash + '.svg')).getroot()
+        # shown as large as the 1x PNG, 144pt at 187.5 dpi
+        self.assertEqual((svg.get('width'), svg.get('height')), ('375px', '187.5px'))
+        self.assertEqual(svg.get('viewBox'), '0 0 144 72')
+        self.assertEqual([c for c in self.container.commands if c[0] == 'convert'], [])
+
+    def test_svg_without_view_box_is_scaled(self):
+        svg_path = os.path.join(self.cache_path, 'figure.svg')
+        with open(svg_path, 'w') as fp:
+            fp.write('<svg xmlns="http://www.w3.org/2000/svg" width="1in" height="0.5in"/>')
+        imageutils.size_svg(svg_path, 150)
+        svg = etree.parse(svg_path).getroot()
+        self.assertEqual((svg.get('width'), svg.get('height')), ('150px', '75px'))
+        self.assertEqual(svg.get('viewBox'), '0 0 96 48')
+
+
+class TestFigures(FakeLatexContainerTestCase):
+    """Test rendering the TikZ and PSTricks figures of documents."""
+
+    def figure_dom(self):
+        dom = etree.Element('xml')
+        div = etree.SubElement(dom, 'div')
+        div.set('class', 'tikzpicture')
+        div.set('style', 'width: 50%')
+        code = etree.SubElement(div, 'code')
+        code.text = r'\begin{tikzpicture}\draw (0,0) -- (1,1);\end{tikzpicture}'
+        pspicture = etree.SubElement(dom, 'pspicture')
+        pspicture.text = r'(0,0)(2,1)\psline(0,0)(2,1)'
+        span = etree.SubElement(dom, 'span')
+        span.set('class', 'latex-math')
+        span.text = r'\(a\)'
+        return dom
+
+    def test_figures_are_routed_by_class_and_tag(self):
+        dom = self.figure_dom()
+        replace_latex_with_images(dom, 'latex-math', self.cache_path, '', densities=(1,),
+                                  figures=imageutils.FIGURE_TYPES, page_width_px=800)
+        tikz = imageutils.figure_hash('tikzpicture', r'\begin{tikzpicture}\draw (0,0) -- '
+                                      r'(1,1);\end{tikzpicture}',
+                                      imageutils.PageWidthDpi(0.5, 800, 150))
+        pst = imageutils.figure_hash('pspicture', r'(0,0)(2,1)\psline(0,0)(2,1)', 150)
+        equation = imageutils.equation_hash(r'\(a\)', 187.5)
+        self.assertEqual(html.tostring(dom), (
+            '<xml><div class="tikzpicture" style="width: 50%"><img src="/{}.png"></div>'
+            '<pspicture><img src="/{}.png"></pspicture><span class="latex-math">'
+            '<img src="/{}.png"></span></xml>'.format(tikz, pst, equation)))
+        # 800 pixels * 50% across the 144pt, or 2in, of the figure
+        self.assertEqual(open(os.path.join(self.cache_path, tikz + '.png')).read(), '200')
+        self.assertEqual(open(os.path.join(self.cache_path, pst + '.png')).read(), '150')
+
+    def test_figures_are_left_without_option(self):
+        dom = self.figure_dom()
+        replace_latex_with_images(dom, 'latex-math', self.cache_path, '', densities=(1,))
+        self.assertEqual(len(dom.findall('.//img')), 1)
+        self.assertEqual(self.container.compiles, 1)
+
+    def test_failed_figure_keeps_its_code(self):
+        dom = etree.Element('xml')
+        pspicture = etree.SubElement(dom, 'pspicture')
+        pspicture.text = r'\BAD'
+        replace_latex_with_images(dom, 'latex-math', self.cache_path, '',
+                                  figures=imageutils.FIGURE_TYPES)
+        self.assertEqual(html.tostring(dom), r'<xml><pspicture>\BAD</pspicture></xml>')
+
+    def test_empty_figure_keeps_its_code(self):
+        dom = etree.fromstring('<xml><pre class="tikzpicture"><code> </code></pre></xml>')
+        replace_latex_with_images(dom, 'latex-math', self.cache_path, '',
+                                  figures=imageutils.FIGURE_TYPES)
+        self.assertEqual(html.tostring(dom),
+                         '<xml><pre class="tikzpicture"><code> </code></pre></xml>')
+        self.assertEqual(self.container.compiles, 0)
+        self.assertEqual([failure['kind'] for failure in
+                          cache.get_cache(self.cache_path).failures()], ['preprocess'])
+
+    def test_pspicture_compiles_through_dvips(self):
+        path = imageutils.run_latex('pspicture', 'p', r'\psline(0,0)(1,1)', self.cache_path)
+        self.assertTrue(os.path.exists(path))
+        commands = [c for c in self.container.commands if c[0] != 'gs']
+        self.assertEqual([c[0] for c in commands[-3:]], ['pdflatex', 'dvips', 'ps2pdf'])
+        compile_command = commands[-3]
+        self.assertIn('-output-format=dvi', compile_command)
+        preamble = imageutils.without_fontspec(PsPicture_preamble())
+        self.assertIn('-fmt=' + os.path.join(
+            formats.FORMAT_PATH, formats.format_key(preamble, dvi=True,
+                                                    version=self.container.tex_version)),
+            compile_command)
+
+    def test_tikzpicture_is_compiled_without_fontspec(self):
+        path = imageutils.run_latex('tikzpicture', 't', r'\draw (0,0) -- (1,1);',
+                                    self.cache_path)
+        self.assertTrue(os.path.exists(path))
+        compile_command = [c for c in self.container.commands
+                           if c[0] == 'pdflatex' and c[-1].endswith('figure.tex')][-1]
+        preamble = imageutils.without_fontspec(tikz_preamble())
+        self.assertIn('-fmt=' + os.path.join(
+            formats.FORMAT_PATH, formats.format_key(preamble,
+                                                    version=self.container.tex_version)),
+            compile_command)
+
+    def test_environment_is_stripped(self):
+        self.assertEqual(pstikz2png.tikzpicture2png(
+            '\n\\begin{tikzpicture}[scale=2]\\draw;\\end{tikzpicture}\n'), '[scale=2]\\draw;')
+        self.assertEqual(pstikz2png.pspicture2png(r'(0,0)(1,1)\psline'),
+                         r'(0,0)(1,1)\psline')
+
+
+class TestRasterisers(FakeLatexContainerTestCase):
+    """Test the choice of rasteriser."""
+
+    def test_ghostscript_is_used_directly(self):
+        path = imageutils.run_latex('equation', 'a', r'\(a\)', self.cache_path, 150)
+        self.assertEqual(open(path).read(), '150')
+        self.assertEqual([c for c in self.container.commands if c[0] == 'convert'], [])
+
+    def test_convert_is_the_fallback(self):
+        self.container.missing.add('gs')
+        path = imageutils.run_latex('equation', 'a', r'\(a\)', self.cache_path, 150)
+        self.assertEqual(open(path).read(), '150')
+        path = imageutils.run_latex('equation', 'b', r'\(b\)', self.cache_path, 150)
+        # gs is only tried once
+        self.assertEqual(len([c for c in self.container.commands if c[0] == 'gs']), 1)
+        self.assertEqual(len([c for c in self.container.commands if c[0] == 'convert']), 2)
+
+    def test_in_process_failure_is_a_render_failure(self):
+        class BrokenFitz(object):
+            @staticmethod
+            def open(path):
+                raise RuntimeError('cannot open document')
+
+        fitz = rasterisers.fitz
+        environ = os.environ.get('LATEX2IMAGE_RASTERISERS')
+        rasterisers.fitz = BrokenFitz
+        os.environ['LATEX2IMAGE_RASTERISERS'] = 'fitz'
+        try:
+            with self.assertRaises(imageutils.LatexPictureError) as context:
+                imageutils.pdf2png(os.path.join(self.cache_path, 'figure.pdf'), [150],
+                                   self.container)
+        finally:
+            rasterisers.fitz = fitz
+            if environ is None:
+                del os.environ['LATEX2IMAGE_RASTERISERS']
+            else:
+                os.environ['LATEX2IMAGE_RASTERISERS'] = environ
+        self.assertEqual(context.exception.kind, 'rasterise')
+        self.assertIn('cannot open document', unicode(context.exception))
+
+
+class TestCompletion(FakeLatexContainerTestCase):
+    """Test that latex2png reports how the latex process ended."""
+
+    def test_timeout_is_reported(self):
+        self.container.exec_run = lambda command, **kwargs: (imageutils.TIMEOUT_STATUS, None)
+        with self.assertRaises(imageutils.LatexPictureError) as context:
+            imageutils.latex2png(r'\(x\)', equation_preamble(), self.container, timeout=5)
+        self.assertIn('timed out after 5 seconds', unicode(context.exception))
+
+    def test_failure_includes_log_excerpt(self):
+        with self.assertRaises(imageutils.LatexPictureError) as context:
+            imageutils.latex2png(r'\(BAD\)', equation_preamble(), self.container)
+        self.assertIn('! Undefined control sequence.', unicode(context.exception))
+
+
+class TestBackends(TestCase):
+    """Test the backends that run the rendering commands."""
+
+    def test_local_backend_returns_status_and_output(self):
+        backend = backends.LocalBackend()
+        self.assertEqual(backend.exec_run(['sh', '-c', 'echo out; exit 3']), (3, 'out\n'))
+        self.assertEqual(backend.exec_run(['no-such-command-l2i'])[0], 127)
+
+    def test_worker_backend_reuses_one_process(self):
+        backend = backends.WorkerBackend()
+        try:
+            self.assertEqual(backend.exec_run(['sh', '-c', 'echo one']), (0, 'one\n'))
+            # the shell is a child of the worker
+            pid = backend.exec_run(['sh', '-c', 'echo $PPID'])[1]
+            self.assertEqual(backend.exec_run(['sh', '-c', 'exit 2'])[0], 2)
+            self.assertEqual(backend.exec_run(['sh', '-c', 'echo $PPID'])[1], pid)
+        finally:
+            backend.close()
+
+    def test_worker_backend_runs_commands_in_parallel(self):
+        backend = backends.WorkerBackend()
+        rendezvous = tempfile.mkdtemp()
+        # every command waits, for up to 5 seconds, until all three have started
+        command = ['sh', '-c', 'touch "$0/$$"; i=0; while [ $(ls "$0" | wc -l) -lt 3 ] && '
+                   '[ $i -lt 500 ]; do sleep 0.01; i=$((i+1)); done; '
+                   'echo $(ls "$0" | wc -l) $PPID', rendezvous]
+        outputs = []
+        try:
+            threads = [threading.Thread(target=lambda: outputs.append(
+                backend.exec_run(command)[1].split())) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual([count for count, _ in outputs], ['3'] * 3)
+            pids = set(pid for _, pid in outputs)
+            self.assertEqual(len(pids), 3)
+            self.assertIn(backend.exec_run(['sh', '-c', 'echo $PPID'])[1].strip(), pids)
+        finally:
+            backend.close()
+            shutil.rmtree(rendezvous)
+
+    def test_worker_death_is_not_a_missing_command(self):
+        backend = backends.WorkerBackend()
+        try:
+            status, _ = backend.exec_run(['sh', '-c', 'kill -9 $PPID; sleep 1'])
+            self.assertEqual(status, backends.WORKER_DIED_STATUS)
+            self.assertNotEqual(status, imageutils.COMMAND_NOT_FOUND_STATUS)
+            # the next command starts a new worker
+            self.assertEqual(backend.exec_run(['sh', '-c', 'echo two']), (0, 'two\n'))
+        finally:
+            backend.close()
+
+    def test_backend_is_chosen_once(self):
+        previous = backends.set_backend(None)
+        environ = os.environ.get('LATEX2IMAGE_BACKEND')
+        os.environ['LATEX2IMAGE_BACKEND'] = 'local'
+        try:
+            backend = backends.get_backend()
+            self.assertIsInstance(backend, backends.LocalBackend)
+            self.assertIs(backends.get_backend(), backend)
+        finally:
+            if environ is None:
+                del os.environ['LATEX2IMAGE_BACKEND']
+            else:
+                os.environ['LATEX2IMAGE_BACKEND'] = environ
+            backends.set_backend(previous)
+
+    def test_stub_is_not_a_backend_of_the_environment(self):
+        previous = backends.set_backend(None)
+        environ = os.environ.get('LATEX2IMAGE_BACKEND')
+        os.environ['LATEX2IMAGE_BACKEND'] = 'stub'
+        try:
+            self.assertRaises(ValueError, backends.get_backend)
+        finally:
+            if environ is None:
+                del os.environ['LATEX2IMAGE_BACKEND']
+            else:
+                os.environ['LATEX2IMAGE_BACKEND'] = environ
+            backends.set_backend(previous)
+
+
+class TestRenderCache(TestCase):
+    """Test the index, eviction and atomic writes of the render cache."""
+
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        self.source_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path)
+        shutil.rmtree(self.source_path)
+
+    def make_file(self, name, size):
+        path = os.path.join(self.source_path, name)
+        with open(path, 'wb') as fp:
+            fp.write('x' * size)
+        return path
+
+    def test_store_and_lookup(self):
+        render_cache = cache.RenderCache(self.cache_path)
+        self.assertIsNone(render_cache.lookup('a.png'))
+        path = render_cache.store(self.make_file('figure.png', 10), 'a.png', 'fp1')
+        self.assertEqual(path, os.path.join(self.cache_path, 'a.png'))
+        self.assertEqual(render_cache.lookup('a.png', 'fp1'), path)
+        self.assertIsNone(render_cache.lookup('a.png', 'fp2'))
+        self.assertEqual(render_cache.size(), 10)
+        self.assertEqual([name for name in os.listdir(self.cache_path)
+                          if name.startswith('.tmp-')], [])
+
+    def test_existing_files_are_indexed(self):
+        shutil.copy(self.make_file('old.png', 5), self.cache_path)
+        render_cache = cache.RenderCache(self.cache_path)
+        self.assertEqual(render_cache.lookup('old.png', 'fp1'),
+                         os.path.join(self.cache_path, 'old.png'))
+
+    def test_index_is_loaded_once(self):
+        render_cache = cache.RenderCache(self.cache_path)
+        render_cache.store(self.make_file('figure.png', 10), 'a.png', 'fp1')
+        render_cache.db.execute('DELETE FROM entries')
+        self.assertTrue(render_cache.lookup('a.png', 'fp1'))
+        self.assertFalse(cache.RenderCache(self.cache_path).lookup('a.png'))
+
+    def test_other_processes_are_seen(self):
+        render_cache = cache.RenderCache(self.cache_path)
+        other = cache.RenderCache(self.cache_path)
+        path = other.store(self.make_file('figure.png', 10), 'a.png', 'fp1')
+        self.assertEqual(render_cache.lookup('a.png', 'fp1'), path)
+        other.store(self.make_file('figure.png', 10), 'a.png', 'fp2')
+        self.assertEqual(render_cache.lookup('a.png', 'fp2'), path)
+        self.assertIsNone(render_cache.lookup('a.png', 'fp1'))
+        other.evict(0)
+        self.assertIsNone(render_cache.lookup('a.png', 'fp2'))
+
+    def test_unchanged_index_is_not_loaded_again(self):
+        render_cache = cache.RenderCache(self.cache_path)
+        path = render_cache.store(self.make_file('figure.png', 10), 'a.png', 'fp1')
+        entries = render_cache.entries
+        self.assertEqual(render_cache.lookup('a.png', 'fp1'), path)
+        self.assertIs(render_cache.entries, entries)
+        cache.RenderCache(self.cache_path).store(self.make_file('figure.png', 10), 'b.png')
+        self.assertTrue(render_cache.lookup('b.png'))
+        self.assertIsNot(render_cache.entries, entries)
+
+    def test_evict_least_recently_used(self):
+        render_cache = cache.RenderCache(self.cache_path)
+        for name in ['a.png', 'b.png', 'c.png']:
+            render_cache.store(self.make_file(name, 10), name)
+        render_cache.lookup('a.png')
+        render_cache.accessed['a.png'] += 1
+        self.assertEqual(render_cache.evict(15), ['b.png', 'c.png'])
+        self.assertEqual(render_cache.size(), 10)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_path, 'b.png')))
+        self.assertIsNotNone(render_cache.lookup('a.png'))
+
+    def test_evict_in_another_process(self):
+        render_cache = cache.RenderCache(self.cache_path)
+        path = render_cache.store(self.make_file('figure.png', 10), 'a.png', 'fp1')
+        self.assertEqual(render_cache.lookup('a.png', 'fp1'), path)
+        self.assertEqual(cache.RenderCache(self.cache_path).evict(0), ['a.png'])
+        self.assertIsNone(render_cache.lookup('a.png', 'fp1'))
+        self.assertEqual(render_cache.size(), 0)
+
+    def test_copy_if_newer_is_deprecated(self):
+        src = self.make_file('figure.png', 10)
+        dest = os.path.join(self.cache_path, 'copy', 'figure.png')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertTrue(imageutils.copy_if_newer(src, dest))
+        self.assertEqual([w.category for w in caught], [DeprecationWarning])
+        self.assertEqual(open(dest).read(), open(src).read())
+
+
+class TestFailureCache(FakeLatexContainerTestCase):
+    """Test that failed renders are recorded and not attempted again."""
+
+    def render(self):
+        return imageutils.run_latex('equation', 'bad', r'\(\BAD\)', self.cache_path)
+
+    def test_failure_is_not_compiled_again(self):
+        self.assertIsNone(self.render())
+        self.assertIsNone(self.render())
+        self.assertEqual(self.container.compiles, 1)
+        results = imageutils.render_equations_batch([r'\(\BAD\)'], [150], self.cache_path)
+        self.assertIn('Undefined control sequence', results[r'\(\BAD\)'].log)
+        self.assertEqual(self.container.compiles, 1)
+        text = report.format_failures(cache.get_cache(self.cache_path))
+        self.assertTrue(text.startswith('1 failed renders\n'))
+        self.assertIn(' compile %s.pdf\n    \\(\\BAD\\)\n  ! Undefined control sequence.' %
+                      imageutils.source_hash('equation', r'\(\BAD\)'), text)
+
+    def test_timeout_is_not_remembered(self):
+        for _ in range(2):
+            self.assertIsNone(imageutils.run_latex('equation', 'hang', r'\(HANG\)',
+                                                   self.cache_path))
+        self.assertEqual(self.container.compiles, 2)
+        self.assertEqual(cache.get_cache(self.cache_path).failures(), [])
+        # nor is the partial PDF
+        self.assertFalse(cache.get_cache(self.cache_path).lookup(
+            imageutils.source_hash('equation', r'\(HANG\)') + '.pdf'))
+
+    def test_dead_worker_is_not_remembered(self):
+        for _ in range(2):
+            self.assertIsNone(imageutils.run_latex('equation', 'die', r'\(DIE\)',
+                                                   self.cache_path))
+        self.assertEqual(self.container.compiles, 2)
+        self.assertEqual(cache.get_cache(self.cache_path).failures(), [])
+
+    def test_missing_latex_is_not_remembered(self):
+        self.container.missing.add('pdflatex')
+        for _ in range(2):
+            self.assertIsNone(self.render())
+        results = imageutils.render_equations_batch([r'\(a\)'], [150], self.cache_path)
+        self.assertEqual(results[r'\(a\)'].kind, 'environment')
+        self.assertEqual(cache.get_cache(self.cache_path).failures(), [])
+        self.container.missing.clear()
+        self.assertTrue(self.render() is None)
+        self.assertEqual(len(cache.get_cache(self.cache_path).failures()), 1)
+
+    def test_only_tex_errors_are_compile_failures(self):
+        error = '! Undefined control sequence.'
+        self.assertEqual(imageutils.failure_kind(1, error), 'compile')
+        self.assertEqual(imageutils.failure_kind(1, ''), 'environment')
+        self.assertEqual(imageutils.failure_kind(126, error), 'environment')
+        self.assertEqual(imageutils.failure_kind(imageutils.TIMEOUT_STATUS, error), 'timeout')
+
+    def test_failure_expires(self):
+        self.render()
+        cache.get_cache(self.cache_path).failure_ttl = 0
+        time.sleep(0.01)
+        self.render()
+        self.assertEqual(self.container.compiles, 2)
+
+    def test_new_tex_version_renders_again(self):
+        self.render()
+        self.container.tex_version = 'pdfTeX 3.141592653-2.6-1.40.22'
+        self.render()
+        self.assertEqual(self.container.compiles, 2)
+
+    def test_clear_failures(self):
+        self.render()
+        render_cache = cache.get_cache(self.cache_path)
+        render_cache.clear_failures()
+        self.assertEqual(render_cache.failures(), [])
+        self.render()
+        self.assertEqual(self.container.compiles, 2)
+
+
+class TestScratch(FakeLatexContainerTestCase):
+    """Test that renders reuse scratch directories and move their outputs into the cache."""
+
+    def test_scratch_dir_is_reused_empty(self):
+        with scratch.scratch_dir(self.container) as first:
+            os.mkdir(os.path.join(first, 'figures'))
+            open(os.path.join(first, 'figure.tex'), 'w').close()
+        with scratch.scratch_dir(self.container) as second:
+            self.assertEqual(second, first)
+            self.assertEqual(os.listdir(second), [])
+            with scratch.scratch_dir(self.container) as third:
+                self.assertNotEqual(third, second)
+
+    def test_outputs_are_moved(self):
+        metrics.reset()
+        path = imageutils.run_latex('equation', 'abc', r'\(a\)', self.cache_path, dpi=150)
+        self.assertEqual(open(path).read(), '150')
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['bytes_moved'], len(STUB_PDF) + len('150'))
+        self.assertNotIn('bytes_written', counters)
+        # a new resolution is rasterised from the cached PDF, which stays in the cache
+        imageutils.run_latex('equation', 'def', r'\(a\)', self.cache_path, dpi=300)
+        self.assertEqual(self.container.compiles, 1)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.cache_path, imageutils.source_hash('equation', r'\(a\)') + '.pdf')))
+
+    def test_other_devices_are_copied(self):
+        render_cache = cache.get_cache(self.cache_path)
+        render_cache._move = lambda src, name: False
+        src = os.path.join(tempfile.mkdtemp(), 'a.png')
+        with open(src, 'w') as fp:
+            fp.write('png')
+        render_cache.store(src, 'a.png', move=True)
+        self.assertFalse(os.path.exists(src))
+        self.assertEqual(open(render_cache.lookup('a.png')).read(), 'png')
+        os.rmdir(os.path.dirname(src))
+
+
+class TestCli(FakeLatexContainerTestCase):
+    """Test the latex2image command."""
+
+    def setUp(self):
+        FakeLatexContainerTestCase.setUp(self)
+        self.input_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.input_path, 'book', 'chapter'))
+        for name, latexes in [('book/a.html', [r'\(a\)', r'\(b\)']),
+                              ('book/chapter/b.html', [r'\(b\)', r'\(c\)'])]:
+            with open(os.path.join(self.input_path, name), 'w') as fp:
+                fp.write('<html><body><p>%s</p></body></html>' % ''.join(
+                    '<span class="latex-math">%s</span>' % latex for latex in latexes))
+        self.equations = os.path.join(self.input_path, 'equations.txt')
+        with open(self.equations, 'w') as fp:
+            fp.write('\\(c\\)\n----\n\\(d\\)\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.input_path)
+        FakeLatexContainerTestCase.tearDown(self)
+
+    def main(self, *args):
+        return cli.main(['--cache', self.cache_path, '--quiet'] + list(args) +
+                        [os.path.join(self.input_path, 'book'), self.equations])
+
+    def test_render_and_resume(self):
+        self.assertEqual(self.main('--dry-run'), 0)
+        self.assertEqual(self.container.compiles, 0)
+        output = os.path.join(self.input_path, 'output')
+        self.assertEqual(self.main('--jobs', '2', '--output', output), 0)
+        self.assertEqual(self.container.compiles, 4)
+        with open(os.path.join(output, 'book', 'chapter', 'b.html')) as fp:
+            self.assertIn('<img src="/%s.png"' % imageutils.equation_hash(r'\(c\)', 187.5),
+                          fp.read())
+        # a new input is the only one read again
+        with open(os.path.join(self.input_path, 'book', 'new.html'), 'w') as fp:
+            fp.write('<p><span class="latex-math">\\(BAD\\)</span></p>')
+        self.assertEqual(self.main('--resume'), 1)
+        self.assertEqual(self.container.compiles, 5)
+        with open(os.path.join(self.cache_path, cli.RESUME_NAME)) as fp:
+            self.assertEqual(len(fp.read().splitlines()), 4)
+
+    def test_shards_are_merged(self):
+        equations = [r'\(a\)', r'\(b\)', r'\(c\)', r'\(d\)']
+        shard_paths = [os.path.join(self.input_path, 'shard-%i' % shard) for shard in range(2)]
+        processes = [multiprocessing.Process(target=cli.main, args=(
+            ['--cache', path, '--shard', '%i/2' % shard, '--quiet', self.equations,
+             os.path.join(self.input_path, 'book')],)) for shard, path in enumerate(shard_paths)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        names = [set(name for name in os.listdir(path) if name.endswith('.png'))
+                 for path in shard_paths]
+        self.assertEqual(len(names[0]) + len(names[1]), 2 * len(equations))
+        for latex in equations:
+            shard = imageutils.shard_of(imageutils.equation_hash(latex, 187.5), 2)
+            for dpi in (187.5, 375.0):
+                self.assertIn(imageutils.equation_hash(latex, dpi) + '.png', names[shard])
+
+        self.assertEqual(cli.main(['--cache', self.cache_path, '--merge'] + shard_paths), 0)
+        merged = cache.get_cache(self.cache_path)
+        for latex in equations:
+            for dpi in (187.5, 375.0):
+                self.assertTrue(merged.lookup(imageutils.equation_hash(latex, dpi) + '.png'))
+        # merging again copies nothing
+        self.assertEqual(merged.merge(cache.RenderCache(shard_paths[0]))['copied'], 0)
+        # nothing is left to render
+        self.assertEqual(self.main(), 0)
+        self.assertEqual(self.container.compiles, 0)
+
+    def test_missing_cache_is_not_merged(self):
+        missing = os.path.join(self.input_path, 'shard-9')
+        with self.assertRaises(SystemExit):
+            cli.main(['--cache', self.cache_path, '--merge', missing])
+        self.assertFalse(os.path.exists(missing))
+
+    def test_inputs_are_read_as_utf8(self):
+        path = os.path.join(self.input_path, 'times.html')
+        # without a declared charset
+        with open(path, 'w') as fp:
+            fp.write('<p><span class="latex-math">\\(\xc3\x97\\)</span></p>')
+        output = os.path.join(self.input_path, 'output')
+        self.assertEqual(cli.main(['--cache', self.cache_path, '--quiet', '--output', output,
+                                   path]), 0)
+        self.assertEqual(self.container.compiles, 1)
+        with open(os.path.join(output, 'times.html')) as fp:
+            self.assertIn('<img src="/%s.png"' % imageutils.equation_hash(r'\(\times\)', 187.5),
+                          fp.read())
+
+    def test_batch(self):
+        self.assertEqual(self.main('--batch'), 0)
+        self.assertEqual(self.container.compiles, 1)
+        self.assertTrue(imageutils.run_latex(
+            'equation', imageutils.equation_hash(r'\(d\)', 375.0), r'\(d\)',
+            self.cache_path))
+        self.assertEqual(self.container.compiles, 1)
+
+
+@skipIf(postprocess.Image is None, 'Pillow is not installed')
+class TestPostprocess(FakeLatexContainerTestCase):
+    """Test the post-processing of the PNG images."""
+
+    def setUp(self):
+        super(TestPostprocess, self).setUp()
+        self.steps = postprocess.set_steps('trim,quantise,optimise')
+
+    def tearDown(self):
+        postprocess.set_steps(self.steps)
+        super(TestPostprocess, self).tearDown()
+
+    def equation_png(self):
+        """Write an image of anti-aliased ink in a transparent margin, return its path."""
+        image = postprocess.Image.new('RGBA', (60, 30))
+        alphas = random.Random(0)
+        for x in range(10, 50):
+            for y in range(10, 20):
+                image.putpixel((x, y), (0, 0, 0, alphas.randint(0, 255)))
+        path = os.path.join(self.cache_path, 'equation.png')
+        image.save(path)
+        return path
+
+    def test_png_is_trimmed_and_quantised(self):
+        path = self.equation_png()
+        before = os.path.getsize(path)
+        original = postprocess.Image.open(path).crop((10, 10, 50, 20))
+        saved = postprocess.postprocess_png(path)
+        self.assertEqual(saved, before - os.path.getsize(path))
+        self.assertGreater(saved, 0)
+        image = postprocess.Image.open(path)
+        self.assertEqual((image.mode, image.size), ('P', (40, 10)))
+        self.assertLessEqual(len(image.getcolors()), postprocess.COLOURS)
+        # the alpha levels are at most half a level off
+        alphas = zip(original.split()[-1].getdata(), image.convert('RGBA').split()[-1].getdata())
+        self.assertLessEqual(max(abs(a - b) for a, b in alphas), 255 / 30.0)
+        self.assertEqual(metrics.snapshot()['counters']['bytes_saved'], saved)
+
+    def test_densities_are_trimmed_alike(self):
+        paths = []
+        for dpi, box in [(150, (10, 10, 50, 20)), (300, (19, 20, 101, 40))]:
+            image = postprocess.Image.new('RGBA', (dpi * 2 / 5, dpi / 5))
+            image.paste((0, 0, 0, 255), box)
+            paths.append(os.path.join(self.cache_path, '%i.png' % dpi))
+            image.save(paths[-1])
+        boxes = postprocess.trim_boxes(paths, [150, 300])
+        self.assertEqual(boxes, [(9, 10, 51, 20), (19, 20, 101, 40)])
+        for path, box in zip(paths, boxes):
+            postprocess.postprocess_png(path, box=box)
+        self.assertEqual([postprocess.Image.open(path).size for path in paths],
+                         [(42, 10), (82, 20)])
+
+    def test_colours_are_quantised_by_pillow(self):
+        image = postprocess.Image.new('RGBA', (30, 10))
+        for x in range(30):
+            for y in range(10):
+                image.putpixel((x, y), (255 * (x < 10), 255 * (10 <= x < 20), 255 * (x >= 20),
+                                        25 * y))
+        quantised = postprocess.quantise(image)
+        self.assertEqual(quantised.mode, 'P')
+        self.assertLessEqual(len(quantised.getcolors()), postprocess.COLOURS)
+        colours = quantised.convert('RGBA')
+        self.assertEqual([colours.getpixel((x, 9))[:3] for x in (5, 15, 25)],
+                         [(255, 0, 0), (0, 255, 0), (0, 0, 255)])
+
+    def test_larger_output_is_not_kept(self):
+        path = os.path.join(self.cache_path, 'dot.png')
+        postprocess.Image.new('L', (1, 1)).save(path)
+        with open(path, 'rb') as fp:
+            original = fp.read()
+        self.assertEqual(postprocess.postprocess_png(path), 0)
+        with open(path, 'rb') as fp:
+            self.assertEqual(fp.read(), original)
+        self.assertEqual(os.listdir(self.cache_path), ['dot.png'])
+
+    def test_steps_change_the_fingerprint(self):
+        fingerprint = cache.render_fingerprint(equation_preamble(), self.container)
+        postprocess.set_steps('optimise')
+        self.assertNotEqual(cache.render_fingerprint(equation_preamble(), self.container),
+                            fingerprint)
+        postprocess.set_steps(())
+        self.assertNotEqual(cache.render_fingerprint(equation_preamble(), self.container),
+                            fingerprint)
+        self.assertRaises(ValueError, postprocess.set_steps, 'trim,shrink')
+
+
+class PngLatexContainer(FakeLatexContainer):
+    """FakeLatexContainer whose Ghostscript writes PNG images a fifth of the dpi wide."""
+
+    def exec_run(self, command, **kwargs):
+        gs = command[2:] if command[0] == 'timeout' else command
+        if gs[0] != 'gs':
+            return super(PngLatexContainer, self).exec_run(command, **kwargs)
+        self.commands.append(gs)
+        options = dict(arg[2:].split('=', 1) for arg in gs if arg.startswith('-s'))
+        dpi = int([arg[2:] for arg in gs if arg.startswith('-r')][0])
+        for page in range(self._pages(gs[-1])):
+            image = postprocess.Image.new('RGBA', (dpi // 5, dpi // 20), (0, 0, 0, 255))
+            image.save(options['OutputFile'] % (page + 1))
+        return 0, ''
+
+
+@skipIf(postprocess.Image is None, 'Pillow is not installed')
+class TestAtlas(FakeLatexContainerTestCase):
+    """Test packing the equation images of a page into atlases."""
+
+    def setUp(self):
+        super(TestAtlas, self).setUp()
+        self.container = PngLatexContainer()
+        backends.set_backend(self.container)
+
+    def page(self, *equations):
+        dom = etree.Element('xml')
+        for equation in equations:
+            span = etree.SubElement(dom, 'span')
+            span.set('class', 'latex-math')
+            span.text = equation
+        return dom
+
+    def test_equations_show_regions_of_the_atlas(self):
+        dom = self.page(r'\(a\)', r'\(b\)', r'\(a\)')
+        replace_latex_with_images(dom, 'latex-math', self.cache_path, '/images', atlas=True)
+        spans = dom.findall('.//span[@class="latex-atlas"]')
+        self.assertEqual(len(spans), 3)
+        self.assertEqual(spans[0].get('style'), spans[2].get('style'))
+        layout = atlas.page_atlas(cache.get_cache(self.cache_path), None, [
+            [codehash for codehash, _ in imageutils.equation_images(latex, (1, 2), 'png')[1]]
+            for latex in [r'\(a\)', r'\(b\)']], (1, 2))
+        # the 2x images are 75 pixels wide, which takes 38 pixels at 1x
+        self.assertEqual(layout['size'], [80, 11])
+        codehash = imageutils.equation_hash(r'\(b\)', 187.5)
+        x, y, width, height = layout['regions'][codehash]
+        self.assertEqual((width, height), (37, 9))
+        self.assertEqual(spans[1].get('style'), (
+            'display:inline-block;width:37px;height:9px;background:url(/images/{0}-1x.png) '
+            '-{1}px -{2}px/80px 11px no-repeat;background-image:-webkit-image-set('
+            'url(/images/{0}-1x.png) 1x, url(/images/{0}-2x.png) 2x);background-image:'
+            'image-set(url(/images/{0}-1x.png) 1x, url(/images/{0}-2x.png) 2x)').format(
+                layout['key'], x, y))
+        image = postprocess.Image.open(os.path.join(self.cache_path, layout['key'] + '-2x.png'))
+        self.assertEqual(image.size, (160, 22))
+        self.assertEqual(image.getpixel((2 * x, 2 * y)), (0, 0, 0, 255))
+        self.assertEqual(image.getpixel((2 * x - 1, 2 * y)), (0, 0, 0, 0))
+
+    def test_layout_is_in_css_pixels(self):
+        dom = self.page(r'\(a\)', r'\(b\)')
+        replace_latex_with_images(dom, 'latex-math', self.cache_path, '/images',
+                                  densities=(2, 3), atlas=True)
+        layout = atlas.page_atlas(cache.get_cache(self.cache_path), None, [
+            [codehash for codehash, _ in imageutils.equation_images(latex, (2, 3), 'png')[1]]
+            for latex in [r'\(a\)', r'\(b\)']], (2, 3))
+        # the 2x images are 75 by 18 pixels and the 3x images 112 by 28
+        codehash = imageutils.equation_hash(r'\(b\)', 187.5 * 2)
+        self.assertEqual(layout['regions'][codehash][2:], [38, 9])
+        self.assertEqual(layout['size'], [80, 12])
+        self.assertIn('width:38px;height:9px;',
+                      dom.find('.//span[@class="latex-atlas"]').get('style'))
+        image = postprocess.Image.open(os.path.join(self.cache_path, layout['key'] + '-2x.png'))
+        self.assertEqual(image.size, (160, 24))
+
+    def test_atlas_is_reused(self):
+        replace_latex_with_images(self.page(r'\(a\)', r'\(b\)'), 'latex-math',
+                                  self.cache_path, '', atlas=True)
+        metrics.reset()
+        dom = self.page(r'\(b\)', r'\(a\)')
+        replace_latex_with_images(dom, 'latex-math', self.cache_path, '', atlas=True)
+        self.assertEqual(len(dom.findall('.//span[@class="latex-atlas"]')), 2)
+        self.assertNotIn('atlas', metrics.stage_totals())
+
+    def test_large_and_lone_equations_keep_their_images(self):
+        dom = self.page(r'\(a\)')
+        replace_latex_with_images(dom, 'latex-math', self.cache_path, '', atlas=True)
+        self.assertEqual(len(dom.findall('.//img')), 1)
+        max_width = atlas.ATLAS_MAX_WIDTH
+        # the 1x images are 37 pixels wide
+        atlas.ATLAS_MAX_WIDTH = 30
+        try:
+            dom = self.page(r'\(a\)', r'\(b\)')
+            replace_latex_with_images(dom, 'latex-math', self.cache_path, '', atlas=True)
+        finally:
+            atlas.ATLAS_MAX_WIDTH = max_width
+        self.assertEqual(len(dom.findall('.//img')), 2)
+
+
+class TestMetrics(FakeLatexContainerTestCase):
+    """Test the counters, gauges and hooks of metrics."""
+
+    def setUp(self):
+        FakeLatexContainerTestCase.setUp(self)
+        metrics.reset()
+        self.events = []
+        metrics.add_hook(self.hook)
+
+    def tearDown(self):
+        metrics.remove_hook(self.hook)
+        FakeLatexContainerTestCase.tearDown(self)
+
+    def hook(self, event, name, value):
+        self.events.append((event, name, value))
+
+    def render(self, latexes):
+        dom = etree.Element('div')
+        for latex in latexes:
+            etree.SubElement(dom, 'span', {'class': 'latex-math'}).text = latex
+        replace_latex_with_images(dom, 'latex-math', self.cache_path, '', workers=2)
+
+    def test_counters(self):
+        self.render([r'\(a\)', r'\(b\)', r'\(\BAD\)'])
+        self.render([r'\(a\)', r'\(c\)'])
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['cache_hits'], 2)
+        self.assertEqual(counters['cache_misses'], 8)
+        self.assertEqual(counters['failures'], {'compile': 1})
+        # the PNGs hold their dpi
+        self.assertEqual(counters['bytes_moved'],
+                         3 * len(STUB_PDF) + 3 * len('187') + 3 * len('375'))
+        self.assertEqual(metrics.snapshot()['gauges'],
+                         {'queue_depth': 0, 'workers': 0, 'busy_workers': 0})
+        self.assertIn(('counter', 'failures.compile', 1), self.events)
+        self.assertIn('copy', [name for event, name, _ in self.events if event == 'stage'])
+        self.assertEqual(json.loads(metrics.dump_json())['counters'], counters)
+
+    def test_prometheus_text(self):
+        metrics.record('compile', 0.5)
+        metrics.increment('cache_hits', 3)
+        metrics.failure('timeout', 'LaTeX timed out')
+        text = metrics.prometheus_text()
+        self.assertIn('latex2image_stage_seconds_total{stage="compile"} 0.5\n', text)
+        self.assertIn('latex2image_cache_hits_total 3\n', text)
+        self.assertIn('# TYPE latex2image_failures_total counter\n'
+                      'latex2image_failures_total{kind="timeout"} 1\n', text)
+
+
+class TestBenchmark(TestCase):
+    """Test the benchmark harness with the stub backend."""
+
+    def test_cold_and_warm_runs(self):
+        equations = [r'\(a\)', r'\(b\)', r'\(a\)']
+        results = benchmark.run_benchmark(equations, benchmark.StubBackend())
+        self.assertEqual(sorted(results), ['document-cold', 'document-warm', 'equations-cold',
+                                           'equations-warm'])
+        self.assertEqual(results['equations-cold']['stages']['compile']['count'], 2)
+        self.assertNotIn('compile', results['equations-warm']['stages'])
+        self.assertNotIn('compile', results['document-warm']['stages'])
+
+    def test_percentile(self):
+        self.assertEqual(benchmark.percentile(range(1, 101), 50), 50)
+        self.assertEqual(benchmark.percentile(range(1, 101), 99), 99)
+        self.assertEqual(benchmark.percentile([], 50), 0.0)
@@ -0,0 +1,213 @@
+"""
+A pdflatex process that stays running and renders one equation after the other.
+
+The worker compiles a document whose body reads lines from the terminal and runs them,
+so the preamble is loaded once and every equation written to the process is typeset in
+an already warm TeX. The document is compiled to DVI, which TeX writes page by page: every
+equation is shipped out as a page, followed by a padding page that pushes the equation
+out of TeX's output buffer, and dvipng rasterises the page while TeX waits for the next
+equation. The worker is restarted after an error, a timeout or max_jobs equations.
+
+The images are cached under the same codehash.png names as those of imageutils.run_latex,
+so clients get the same paths from either route. They differ slightly from the images
+rasterised from PDFs and are cached with a fingerprint of their own: an image that the PDF
+route has already cached is used instead of rendering it again, and the PDF route renders
+the images of the workers again, so a PDF image is never replaced by a worker image.
+"""
+import hashlib
+import os
+import select
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from backends import get_backend
+from cache import get_cache, render_fingerprint
+from equation2png import equation2png
+from formats import get_format
+from imageutils import (LATEX_TIMEOUT, LatexPictureError, batch_preamble, cached_failure,
+                        prepare_code, run_with_timeout, source_hash, store_failure,
+                        write_latex)
+from preambles import equation_preamble
+import metrics
+from metrics import timed
+from postprocess import postprocess_png
+
+# equations rendered by a worker before it is restarted, bounding the size of its DVI file
+MAX_JOBS = 500
+
+# TeX flushes its DVI buffer of 16384 bytes in halves, so a special of this size in the
+# padding page is enough to write out every page before it
+PADDING_SIZE = 16384
+
+WARM_LOOP = r'''\endlinechar=-1\relax
+\def\warmpad{\shipout\hbox{\special{%s}}}
+\def\warmread{\read-1 to\warmline\warmline\warmread}
+\warmread''' % ('x' * PADDING_SIZE)
+
+
+def warm_fingerprint(backend, cache=None, verify=True):
+    """Return the fingerprint of the images rendered by workers running on backend."""
+    return hashlib.md5('warm;' + render_fingerprint(batch_preamble(), backend, cache,
+                                                    verify)).hexdigest()
+
+
+class TexWorker(object):
+    """
+    Render equations in a pdflatex process that keeps running between them.
+
+    pdflatex runs in a subprocess started with command_prefix, e.g. ['docker', 'exec', '-i',
+    'latex'] to run it in the latex container, whose temporary directory must be the one of
+    this process. dvipng runs on backend.
+    """
+
+    def __init__(self, backend=None, command_prefix=None, max_jobs=MAX_JOBS,
+                 timeout=LATEX_TIMEOUT):
+        self.backend = backend if backend is not None else get_backend()
+        self.command_prefix = command_prefix or []
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.process = None
+        self.temp_dir = None
+        self.jobs = 0
+
+    def _start(self):
+        self.temp_dir = tempfile.mkdtemp()
+        preamble = batch_preamble()
+        latex_path = os.path.join(self.temp_dir, 'warm.tex')
+        write_latex(latex_path, preamble, WARM_LOOP)
+        command = ['pdflatex', '-interaction=scrollmode', '-output-format=dvi',
+                   '-output-directory=' + self.temp_dir]
+        fmt = get_format(preamble, self.backend, dvi=True)
+        if fmt is not None:
+            command.append('-fmt=' + fmt)
+        command.append(latex_path)
+        self.process = subprocess.Popen(self.command_prefix + command, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.jobs = 0
+
+    def _read_until(self, marker):
+        """Return the output of pdflatex up to marker, or None if it did not appear in time."""
+        output = ''
+        deadline = time.time() + self.timeout
+        fd = self.process.stdout.fileno()
+        while True:
+            # TeX breaks its terminal lines at 79 characters, which may split the marker
+            if marker in output.replace('\n', ''):
+                return output
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                return None
+            data = os.read(fd, 65536)
+            if not data:
+                return None
+            output += data
+
+    def render(self, latex, dpis):
+        """
+        Render the equation latex, as passed to run_latex, at every dpi.
+
+        Returns the paths of the PNG files, which are removed by the next render after
+        the worker is restarted. Raises LatexPictureError if the equation fails.
+        """
+        with timed('preprocess'):
+            code = ' '.join(prepare_code(equation2png(latex)).split('\n'))
+            if isinstance(code, unicode):
+                code = code.encode('utf-8')
+        with self.lock:
+            if self.process is None or self.process.poll() is not None or \
+                    self.jobs >= self.max_jobs:
+                self.close()
+                self._start()
+            self.jobs += 1
+            # every equation is followed by a padding page
+            page = 2 * self.jobs - 1
+            marker = '[warm %i]' % self.jobs
+            with timed('compile'):
+                try:
+                    # \space keeps the marker out of the input lines shown with errors
+                    self.process.stdin.write(r'\begin{standalone}%s\end{standalone}'
+                                             r'\warmpad\message{[warm\space %i]}' % (
+                                                 code, self.jobs) + '\n')
+                    self.process.stdin.flush()
+                except IOError:
+                    output = None
+                else:
+                    output = self._read_until(marker)
+            if output is None:
+                self.close()
+                raise LatexPictureError('LaTeX timed out after %s seconds or died.\n%s' % (
+                    self.timeout, latex), 'timeout')
+            errors = [line for line in output.splitlines() if line.startswith('!')]
+            if errors:
+                # the state of TeX after an error cannot be trusted
+                self.close()
+                raise LatexPictureError('LaTeX failed to compile the image.\n%s\n%s' % (
+                    '\n'.join(errors), latex), 'compile', '\n'.join(errors))
+            return self._rasterise(page, dpis)
+
+    def _rasterise(self, page, dpis):
+        dvi_path = os.path.join(self.temp_dir, 'warm.dvi')
+        paths = []
+        with timed('rasterise'):
+            for index, dpi in enumerate(dpis):
+                path = os.path.join(self.temp_dir, 'page-%i-%i.png' % (page, index))
+                command = ['dvipng', '--follow', '-q', '-T', 'tight', '-bg', 'Transparent',
+                           '-D', '%i' % dpi, '-p', '=%i' % page, '-l', '=%i' % page, '-o', path,
+                           dvi_path]
+                exit_code = run_with_timeout(self.backend, command, self.timeout)
+                if exit_code != 0 or not os.path.exists(path):
+                    raise LatexPictureError('dvipng failed to rasterise page %i.' % page,
+                                            'rasterise')
+                paths.append(path)
+        for path in paths:
+            postprocess_png(path)
+        return paths
+
+    def close(self):
+        """Stop pdflatex and remove its files."""
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process = None
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
+
+
+def render_images_warm(worker, codetext, cachepath, images):
+    """
+    Render the equation codetext with worker, like render_images.
+
+    images is a list of (codehash, dpi) pairs. Returns the list of the codehash.png image
+    cache paths, or a list of None if the equation failed.
+    """
+    cache = get_cache(cachepath)
+    fingerprint = warm_fingerprint(worker.backend, cache, verify=False)
+    pdf_fingerprint = render_fingerprint(equation_preamble(), worker.backend, cache,
+                                         verify=False)
+    image_cache_paths = [os.path.join(cachepath, codehash + '.png') for codehash, _ in images]
+    missing = [(codehash, dpi) for codehash, dpi in images
+               if not cache.lookup(codehash + '.png', pdf_fingerprint) and
+               not cache.lookup(codehash + '.png', fingerprint)]
+    metrics.increment('cache_hits', len(images) - len(missing))
+    if not missing:
+        return image_cache_paths
+    metrics.increment('cache_misses', len(missing))
+    fingerprint = warm_fingerprint(worker.backend, cache)
+    # failures are recorded under the name of the PDF the other routes would render
+    pdf_name = source_hash('equation', codetext) + '.pdf'
+    if cached_failure(cache, pdf_name, fingerprint):
+        return [None] * len(images)
+    try:
+        paths = worker.render(codetext, [dpi for _, dpi in missing])
+    except LatexPictureError as lpe:
+        store_failure(cache, pdf_name, fingerprint, codetext, lpe)
+        return [None] * len(images)
+    for (codehash, _), path in zip(missing, paths):
+        cache.store(path, codehash + '.png', fingerprint, move=True)
+    return image_cache_paths
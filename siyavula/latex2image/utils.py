@@ -4,8 +4,13 @@ import errno
 import shutil
 import re
 import htmlentitydefs
+import warnings
 
 from htmlutils import repair_equations
+from normalise import Normaliser
+
+_entity_regex = re.compile(r"&#?\w+;")
+_math_snippet_regex = re.compile(r'\$(.*?)\$')
 
 
 def mkdir_p(path):
@@ -28,7 +33,11 @@ def copy_if_newer(src, dest):
     Copy a file from src to  dest if src is newer than dest.
 
     Returns True if success or False if there was a problem.
+
+    Deprecated: rendered files are put into the cache with cache.RenderCache.store.
     """
+    warnings.warn('copy_if_newer is deprecated, use cache.RenderCache.store instead.',
+                  DeprecationWarning, stacklevel=2)
     success = True
     dest_dir = os.path.dirname(dest)
     if (dest_dir is None) or (src is None):
@@ -75,15 +84,18 @@ def unescape(text):
             except KeyError:
                 pass
         return text  # leave as is
-    return re.sub("&#?\w+;", fixup, text)
+    return _entity_regex.sub(fixup, text)
+
+
+def _strip_delimiters(match):
+    r"""Return the $ $ pair of match with the \( \) delimiters inside it replaced by spaces."""
+    return '$%s$' % match.group(1).replace(r'\(', ' ').replace(r'\)', ' ')
 
 
 def cleanup_code(code):
     r"""Remove nested math delimiters of the form \( \) inside $ $ pairs."""
-    result = re.findall(r'\$(.*?)\$', code)
-    for snippet in result:
-        newsnippet = snippet.replace(r'\(', ' ').replace(r'\)', ' ')
-        code = code.replace(snippet, newsnippet)
+    if r'\(' in code or r'\)' in code:
+        code = _math_snippet_regex.sub(_strip_delimiters, code)
 
     code = code.strip()
 
@@ -103,36 +115,37 @@ def cleanup_code(code):
     return code
 
 
+# unicode characters and the latex that replaces them, applied in this order
+UNICODE_OPERATIONS = (
+    # unicode operators
+    ("\xe2\x88\x92", '-'),
+    ("\xc3\x97", r'\times'),
+
+    # unicode_superscripts
+    ("\xc2\xb0", r'\text{$^\circ$}'),
+    ("\xe2\x81\xbb\xc2\xb9", r'^{-1}'),
+    ("\xc2\xb2", r'^{2}'),
+    ("\xc2\xb3", r'^{3}'),
+    ("\xe2\x84\x83", r'^{\circ}C'),
+
+    # unicode_punctation_spacing
+    ("\xc2\xa0", ' '),
+
+    # unicode_symbols
+    ("\xce\xa9", r'\ensuremath{\Omega}'),
+    ("\xe2\x82\xac", r'\euro'),
+
+    # latex_replacements
+    ('\xc2\xb7', r'\ensuremath{\cdot}'),
+    ("\xb7", r'\ensuremath{\cdot}'),
+    ('\xb5', r'\ensuremath{\mu}'),
+    ('\u03bc', r'\ensuremath{\mu}'),
+    ('μ', r'\ensuremath{\mu}'),
+    ('µ', r'\ensuremath{\mu}'))
+
+_unicode_normaliser = Normaliser.from_chain(UNICODE_OPERATIONS)
+
+
 def unicode_replacements(latex):
     """Take in latex and replaces specific unicode characters with latex symbols."""
-    operations = (
-        # unicode operators
-        ("\xe2\x88\x92", '-'),
-        ("\xc3\x97", r'\times'),
-
-        # unicode_superscripts
-        ("\xc2\xb0", r'\text{$^\circ$}'),
-        ("\xe2\x81\xbb\xc2\xb9", r'^{-1}'),
-        ("\xc2\xb2", r'^{2}'),
-        ("\xc2\xb3", r'^{3}'),
-        ("\xe2\x84\x83", r'^{\circ}C'),
-
-        # unicode_punctation_spacing
-        ("\xc2\xa0", ' '),
-
-        # unicode_symbols
-        ("\xce\xa9", r'\ensuremath{\Omega}'),
-        ("\xe2\x82\xac", r'\euro'),
-
-        # latex_replacements
-        ('\xc2\xb7', r'\ensuremath{\cdot}'),
-        ("\xb7", r'\ensuremath{\cdot}'),
-        ('\xb5', r'\ensuremath{\mu}'),
-        ('\u03bc', r'\ensuremath{\mu}'),
-        ('μ', r'\ensuremath{\mu}'),
-        ('µ', r'\ensuremath{\mu}'))
-
-    for old_string, new_string in operations:
-        latex = latex.replace(old_string, new_string)
-
-    return latex
+    return _unicode_normaliser(latex)